@@ -1,76 +1,312 @@
 """
 This script is used to create a gradio interface for the VLLM API. The API is used to interact with the VLLM model
 """
+import asyncio
 import os
 import pickle
+from concurrent.futures import ThreadPoolExecutor
+from math import ceil
 from pathlib import Path
-from typing import List, Tuple, Optional
+from typing import AsyncIterator, List, Tuple, Optional
 
 import gradio as gr
 import openai
 from dotenv import load_dotenv
-from langchain_community.vectorstores.faiss import FAISS
 from langchain_core.documents import Document
 from langchain_huggingface.embeddings import HuggingFaceEndpointEmbeddings
-from openai import OpenAI
 from termcolor import colored
 
+import database_helper as dh
 import file_helper as fh
+import prompt_helper as ph
+import retrieval_cache as rc
+from admission_helper import Rejected, controller_from_env, get_user_id
+from answer_cache import answer_cache_from_env
+from backend_pool import pool_from_env
+from batch_helper import MicroBatcher, batcher_from_env
+from bm25_helper import reciprocal_rank_fusion
+from concurrency_helper import stages_from_env
+from context_builder import builder_from_env
+from faiss_cache import cache_from_env
+from glossary_helper import GlossaryMatcher
+from health_helper import UpstreamUnavailable, breaker_from_env, http_probe, monitor_from_env
+from memory_helper import memory_from_env
+from stream_helper import GenerationTracker, coalescer_from_env, stream_deltas
 
 load_dotenv()
 
-api_key = "EMPTY"
-client = OpenAI(api_key=api_key, base_url=os.environ.get("openai_api"))
+backend_pool = pool_from_env()
 embeddings = HuggingFaceEndpointEmbeddings(model=os.environ.get("embedding_api"))
+faiss_mmap = os.environ.get("faiss_mmap", "true").lower() == "true"
 files = os.listdir(fh.get_faiss_db_path())
 icon = Path(__file__).parent / "public" / "images" / "favicon.ico"
 iba_logo = Path(__file__).parent / "public" / "images" / "iba.png"
 glossary_path = Path(__file__).parent / "public" / "glossary" / "glossary.csv"
-fh.delete_uncatalogued_db()
+glossary_matcher = GlossaryMatcher(glossary_path)
+context_builder = builder_from_env()
+instructions_role = ph.instructions_role_from_env()
+copilot_port = int(os.environ.get("copilot_port", 7860))
+copilot_worker = os.environ.get("copilot_worker")  # Set by serve_copilot.py, which cleans the databases once
+if copilot_worker is None:
+    fh.delete_uncatalogued_db()
 print()
-print(colored("Copilot", "light_cyan"))
+print(colored("Copilot" if copilot_worker is None else f"Copilot worker {copilot_worker}", "light_cyan"))
 print("[CTRL] + Click on the link to open the interface in your browser.")
 
 
-def faiss_db_loader(db_id: str) -> FAISS:
+def faiss_db_loader(db_id: str) -> dh.Database:
     """
-    This function is used to load the faiss database
+    This function is used to load the faiss database and the indexes saved with it
     :param db_id: The id of the database
-    :return: The faiss database
+    :return: The loaded database
     """
-    db_path = str(fh.get_faiss_db_path() / db_id)
     try:
-        db = FAISS.load_local(db_path, embeddings, allow_dangerous_deserialization=True)
+        db = dh.load_database(db_id, embeddings, mmap=faiss_mmap)
     except Exception as e:
         raise Exception(f"Error while loading the database: {e}")
     return db
 
 
-def document_search(message: str, db: FAISS, k: int) -> List[Tuple[Document, float]]:
+db_cache = cache_from_env(faiss_db_loader)
+admission = controller_from_env()
+stages = stages_from_env()
+search_executor = ThreadPoolExecutor(max_workers=stages["search"].limit, thread_name_prefix="faiss_search")
+search_batchers = {}
+hybrid_search = os.environ.get("hybrid_search", "true").lower() == "true"
+exact_match_neighbours = int(os.environ.get("exact_match_neighbours", 0))
+retrieval_cache = rc.cache_from_env(
+    model=os.environ.get("embedding_api", ""),
+    settings=f"hybrid={hybrid_search},neighbours={exact_match_neighbours}",
+)
+stream_coalescer = coalescer_from_env()
+health_monitor = monitor_from_env()
+embedding_api = os.environ.get("embedding_api", "")
+embedding_upstream = health_monitor.add(
+    breaker_from_env("embedding", timeout=float(os.environ.get("embedding_timeout", 10))),
+    http_probe(f"{embedding_api.rstrip('/')}/health") if embedding_api.startswith("http") else None,
+)
+llm_upstream = health_monitor.add(breaker_from_env("llm"), backend_pool.probe)
+health_monitor.start()
+
+
+async def complete(messages: List[dict], max_tokens: int) -> str:
+    """
+    This function is used to get a whole completion from the LLM, for the background tasks.
+    The completion takes an answer slot of the admission controller, after the waiting questions of the users.
+    :param messages: The messages in the OpenAI format
+    :param max_tokens: The maximum number of tokens of the completion
+    :return: The completion
+    :raise Rejected: If the queue of the admission controller is full
+    """
+    ticket = admission.enqueue("background", background=True)
+    try:
+        await ticket.granted.wait()
+        backend, response = await llm_upstream.call(
+            backend_pool.create_stream, messages=messages, temperature=0.0, max_tokens=max_tokens
+        )
+        try:
+            return "".join([delta async for delta in stream_deltas(response)])
+        finally:
+            await response.close()
+            backend_pool.release(backend)
+    finally:
+        admission.release(ticket)
+
+
+conversation_memory = memory_from_env(complete, context_builder.count_tokens)
+answer_cache = answer_cache_from_env()
+generation_tracker = GenerationTracker()
+
+
+def database_search(
+        db_id: str,
+        message: str,
+        k: int
+) -> Tuple[List[Tuple[Document, float]], List[Tuple[Document, float]]]:
+    """
+    This function is used to search the database for the user input in two ways:
+    the chunks of the workitems named in the user input (ibafullpuid or workitem id), found in constant time,
+    and the documents matching the words of the user input in the lexical index of the database. It is blocking.
+    :param db_id: The id of the faiss database
+    :param message: The user input
+    :param k: The number of documents to return by the lexical search
+    :return: The exact matches and the documents found by BM25 score in a tuple
+    """
+    db = db_cache.get(db_id)
+    exact = []
+    for doc_id in db.identifiers.find_in_text(message) if db.identifiers is not None else []:
+        exact.append((db.faiss.docstore.search(doc_id), 0.0))
+        if exact_match_neighbours:
+            exact.extend(db.search_batch([db.get_vector(doc_id)], k=exact_match_neighbours + 1, score_threshold=1)[0])
+    lexical = []
+    if hybrid_search and db.bm25 is not None:
+        lexical = [(db.faiss.docstore.search(doc_id), score) for doc_id, score in db.bm25.search(message, k)]
+    return exact, lexical
+
+
+def dense_search_batch(db_id: str, queries: List[Tuple[List[float], int]]) -> List[List[Tuple[Document, float]]]:
+    """
+    This function is used to search the closest documents of several embeddings with one call to the faiss index.
+    It is blocking.
+    :param db_id: The id of the faiss database
+    :param queries: The embeddings and their number of documents to return
+    :return: The documents found by distance for each embedding
+    """
+    db = db_cache.get(db_id)
+    results = db.search_batch([vector for vector, _ in queries], max(k for _, k in queries), score_threshold=1)
+    return [documents[:k] for documents, (_, k) in zip(results, queries)]
+
+
+def get_search_batcher(db_id: str) -> MicroBatcher:
+    """
+    This function is used to get the micro-batcher gathering the similarity searches of a database
+    """
+    async def process(queries: List[Tuple[List[float], int]]) -> List[List[Tuple[Document, float]]]:
+        async with stages["search"].slot():
+            return await asyncio.get_running_loop().run_in_executor(
+                search_executor, dense_search_batch, db_id, queries
+            )
+
+    if db_id not in search_batchers:
+        search_batchers[db_id] = batcher_from_env(process)
+    return search_batchers[db_id]
+
+
+async def embed_batch(texts: List[str]) -> List[List[float]]:
+    """
+    This function is used to embed several user inputs with one call to the embedding server
+    """
+    async with stages["embedding"].slot():
+        return await embedding_upstream.call(embeddings.aembed_documents, texts)
+
+
+embedding_batcher = batcher_from_env(embed_batch)
+
+
+def merge_search_results(
+        results: List[List[Tuple[Document, float]]],
+        k: int
+) -> List[Tuple[Document, float]]:
+    """
+    This function is used to merge the documents found in several databases into a global top k by distance.
+    A chunk found in several databases (same ibafullpuid and content) is only kept once, with its best distance.
+    :param results: The documents found in each database
+    :param k: The number of documents to return
+    :return: The k documents with the lowest distance
+    """
+    merged = {}
+    found_documents = (found for documents in results for found in documents)
+    for doc, score in sorted(found_documents, key=lambda found: found[1]):
+        merged.setdefault((doc.metadata["ibafullpuid"], doc.page_content), (doc, score))
+    return list(merged.values())[:k]
+
+
+def fuse_search_results(
+        dense: List[Tuple[Document, float]],
+        lexical: List[List[Tuple[Document, float]]],
+        k: int
+) -> List[Tuple[Document, float]]:
+    """
+    This function is used to fuse the dense and the lexical rankings with reciprocal rank fusion.
+    The BM25 scores of two databases aren't comparable (each has its own idf and chunk lengths), so the lexical
+    ranking of every database is fused on its own instead of being merged by score.
+    :param dense: The documents found by distance in all the databases, best first
+    :param lexical: The documents found by BM25 score in each database, best first
+    :param k: The number of documents to return
+    :return: The k documents with the best fused score (higher is better)
+    """
+    documents = {}
+    rankings = []
+    for ranking in [dense, *lexical]:
+        keys = []
+        for doc, _ in ranking:
+            key = (doc.metadata["ibafullpuid"], doc.page_content)
+            documents.setdefault(key, doc)
+            keys.append(key)
+        rankings.append(keys)
+    return [(documents[key], score) for key, score in reciprocal_rank_fusion(rankings, k)]
+
+
+async def embed_question(message: str) -> List[float]:
     """
-    This function is used to search for documents in the database
+    This function is used to get the embedding of the user input, from the retrieval cache or from the embedding server.
+    The concurrent user inputs are embedded in batches, an input already being embedded isn't sent again.
     :param message: the user input
-    :param db: The faiss database
+    :return: The embedding vector
+    """
+    try:
+        return await retrieval_cache.aembed_query(
+            message, lambda text: embedding_batcher.submit(text, key=rc.normalize_query(text))
+        )
+    except UpstreamUnavailable:
+        raise
+    except Exception as e:
+        raise UpstreamUnavailable(f"Error while embedding the question: {e}")
+
+
+async def document_search(message: str, db_ids: List[str], k: int) -> List[Tuple[Document, float]]:
+    """
+    This function is used to search for documents in one or several databases.
+    The embedding is requested asynchronously once, then every database is searched in parallel in a thread pool,
+    the similarity searches of the concurrent requests being gathered in batches. The results are cached.
+    If the embedding server is unavailable, UpstreamUnavailable is raised without waiting for it.
+    When the databases have a lexical index, the dense and lexical results are fused.
+    The chunks of the workitems named in the user input (and their neighbours) come first, with the best score.
+    :param message: the user input
+    :param db_ids: The ids of the faiss databases
     :param k: The number of documents to return
-    :return: The documents found in the database
+    :return: The documents found in the databases
     """
+    async def search(db_id: str) -> Tuple[List[Tuple[Document, float]], ...]:
+        async def lexical_search():
+            async with stages["search"].slot():
+                return await asyncio.get_running_loop().run_in_executor(
+                    search_executor, database_search, db_id, message, k
+                )
+
+        async def run():
+            dense, (exact, lexical) = await asyncio.gather(
+                get_search_batcher(db_id).submit((vector, k), key=(rc.vector_hash(vector), k)),
+                lexical_search(),
+            )
+            return exact, dense, lexical
+
+        return await retrieval_cache.asearch(db_id, db_cache.get_version(db_id), vector, k, run)
+
+    vector = await embed_question(message)
     try:
-        documents = db.similarity_search_with_score(query=message, k=k, score_threshold=1)
+        results = await asyncio.gather(*(search(db_id) for db_id in db_ids))
     except Exception as e:
         raise Exception(f"Error while searching for documents: {e}")
-    return documents
+    dense = merge_search_results([result[1] for result in results], k)
+    lexical = [result[2] for result in results if result[2]]
+    if lexical:
+        documents, best_score = fuse_search_results(dense, lexical, k), 1.0
+    else:
+        documents, best_score = dense, 0.0
+    exact = [(doc, best_score) for result in results for doc, _ in result[0]]
+    if not exact:
+        return documents
+    found = {}
+    for doc, score in exact:
+        found.setdefault((doc.metadata["ibafullpuid"], doc.page_content), (doc, score))
+    exact_count = len(found)
+    for doc, score in documents:
+        found.setdefault((doc.metadata["ibafullpuid"], doc.page_content), (doc, score))
+    return list(found.values())[:max(k, exact_count)]
 
 
 def history_format(history):
     """
-    This function is used to format the history in the OpenAI format
+    This function is used to format the history in the OpenAI format, without the references displayed above the
+    answers
     :param history: The history of the conversation
     :return: The history in the OpenAI format
     """
     history_openai = []
     for human, assistant in history:
         history_openai.append({"role": "user", "content": human})
-        history_openai.append({"role": "assistant", "content": assistant})
+        history_openai.append({"role": "assistant", "content": ph.answer_text(assistant)})
     return history_openai
 
 
@@ -78,168 +314,203 @@ def append_context_to_history(
         documents: Optional[List[Tuple[Document, float]]],
         history_openai_format: list,
         message: str,
-        prebuilt_context: str
+        prebuilt_context: str,
+        summary: Optional[str] = None
 ) -> Tuple[list, str]:
     """
-    This function is used to append the context to the history.
+    This function is used to lay out the prompt: the instructions of the use case first, then the history, then the
+    context and the question, so that the requests share their prefix in the prefix cache of vLLM.
 
     @param documents: The documents found in the database
     @param history_openai_format: The history in the OpenAI format
     @param message: The user input
     @param prebuilt_context: The use case
-    @return: The updated history and the system prompt in a tuple
+    @param summary: [Optional] The summary of the turns missing from the history
+    @return: The messages and the references to display in a tuple
     """
-    glossary = fh.get_glossary(str(glossary_path))
-
     if documents is not None and not isinstance(documents, list):
         raise Exception("The documents should be a list")
     reference_prompt = ""
+    context_prompt = ""
+    abbreviations = ""
     if documents:
-        for doc in documents:
-            doc_content = doc[0].page_content
-            doc_reference = doc[0].metadata["ibafullpuid"]
-            doc_url = doc[0].metadata["url"]
-
+        merged_documents = context_builder.merge_documents(documents)
+        # The rank and not the score, which is a distance, a fused rank or none depending on how the chunk was found
+        for rank, doc in enumerate(merged_documents, 1):
             reference_prompt += (
-                f" - {doc_content} {doc_reference} -- <b><a href='{doc_url}'>LINK</a></b>\n"
+                f" - {doc['content']} {doc['puid']} -- <b><a href='{doc['url']}'>LINK</a></b> <i>(rank {rank})</i>\n"
             )
+        context_prompt = context_builder.build_context(merged_documents)
+        abbreviations = glossary_matcher.format(message, context_prompt)
+    messages = ph.build_messages(
+        prebuilt_context, history_openai_format, message, context_prompt, abbreviations, instructions_role, summary
+    )
+    return messages, reference_prompt
 
-        history_openai_format.append({
-            "role":
-                "user",
-            "content":
-                "You are a helpful assistant. The following CONTEXT might be useful for the question. "
-                "Consider it as knowledge and not provided information, use it to answer the question. "
-                "DO NOT display the links of the CONTEXT. "
-                "Only if the CONTEXT has nothing to do with the QUESTION or is EMPTY, provide the "
-                "answer to the question without using the CONTEXT. "
-                f"ABBREVIATION: {glossary}"
-                "Your might get a specific context, I want you to use it to adapt to the user. "
-                "### Context :"
-                f"{reference_prompt} "
-                "### Question :"
-                f"{message}"
-        })
-    else:
-        if prebuilt_context != "no_use_case":
-            if prebuilt_context == "test_case":
-                prebuilt_context = """
-                Your main goal is to write or modify test steps from a given requirement. 
-                Here are some examples of the provided task.
-                --- Start of example 
-                Requirements to test 
-                • The system shall prevent motion if pit is not secured 
-                • The system shall prevent motion if motion enable button is not pressed 
-                Test steps for the requirements 
-                <table>
-                <thead><tr><th>Step Number</th><th>Step Description</th><th>Expected Result</th></tr></thead>
-                    <tbody>
-                        <tr><td>1</td><td>Unsecure the pit</td><td>Motion enable = OFF</td></tr><tr><td>2</td>
-                        <td>Press motion enable button</td><td>Motion enable = OFF</td></tr><tr><td>3</td>
-                        <td>Stop pressing motion enable button</td><td>Motion enable = OFF</td></tr>
-                        <tr><td>4</td><td>Secure the pit</td><td>Motion enable = OFF</td></tr>
-                        <tr><td>5</td><td>Press motion enable button</td><td>Motion enable = ON</td></tr>
-                        <tr><td>6</td><td>Stop pressing motion enable button</td><td>Motion enable = OFF</td></tr>
-                    </tbody>
-                </table>
-                --- End of example 
-                If the user asks you to write test steps from a requirement, you should provide the test steps with the same logic as the example.
-                If the user asks you to modify the test steps, you should modify the test steps with the same logic as the example.
-                If the users asks you to complete test steps DO NOT modify the provided test steps. DO NOT change the test steps order or provide MINIMUM 2 ways to do it.
-                ALWAYS present your response in a table format with clear headers and neatly organized rows and columns. 
-                Do not replicate the user's structured input directly, even if it looks like a table or structured text. 
-                Instead, reformat all information into a new table with appropriate adjustments as needed.
-                Ensure that:
-                - Each step is listed clearly with step numbers.
-                - The step description is concise and formatted uniformly.
-                - Expected results are accurately represented in their own column.
-                - Headers should be explicitly stated and aligned correctly. 
-                Even if the user provides a structured answer, do not replicate it directly. Instead, format your response in a structured table with clear headers and neatly organized rows and columns.
-                """
-        history_openai_format.append({
-            "role":
-                "user",
-            "content":
-                "You are a helpful and appreciated assistant, answer the question naturally."
-                "Your primary goal is to provide accurate and natural responses to the user's questions."
-                "If a question is ambiguous, ask clarifying questions to better understand the user's needs."
-                "*DO NOT make up information*; if you don't know the answer, it's okay to say so in a polite way."
-                "When applicable, provide **examples** or **references** to support your answer."
-                "### Specific context :"
-                f"{prebuilt_context}"
-                "### Question : "
-                f"{message}"
-        })
-    return history_openai_format, reference_prompt
-
-
-def predict(
+
+async def predict(
         message: str,
         history,
-        db_id: str,
+        db_ids: List[str],
         k: int,
-        user_summary: str
-) -> str:
+        user_summary: str,
+        request: gr.Request = None
+) -> AsyncIterator[str]:
     """
     This function is used to predict the response of the VLLM model.
+    The question first waits for an answer slot of the admission controller, showing its position in the queue,
+    then each stage (embedding, search) waits for a slot of its own concurrency limit.
+    When the LLM server is down the question fails at once, when the embedding server is down it is answered
+    without the databases.
+    With the conversation memory, the oldest turns are replaced by their summary.
+    The retrieved references are displayed as soon as they are found, the answer is then streamed under them.
+    With the answer cache, the answer of a first question already asked on the same databases is replayed.
 
     @param message: The user inputs
     @param history: The history of the conversation
-    @param db_id: The chosen database
+    @param db_ids: The chosen databases
     @param k: The number of documents to retrieve
     @param user_summary: The information about the user
+    @param request: The Gradio request, used to identify the user
     @return: The response of the VLLM model
     """
     if message:
-        if db_id == "no_database":
-            documents = None
-        else:
-            db = faiss_db_loader(db_id)
-            documents = document_search(message, db, k)
-
-
-        history_openai_format = history_format(history)
-        messages, references = append_context_to_history(documents, history_openai_format, message, user_summary)
-
-        try:
-            response = client.chat.completions.create(
-                model="mistralai/Mistral-7B-Instruct-v0.3",
-                messages=messages,
-                temperature=0.5,
-                stream=True,
-            )
-        except openai.AuthenticationError:
-            gr.Warning("The chatbot is currently unavailable. Please try again later.", duration=10)
-            raise Exception("You didn't create and/or fill your .env file...")
-        except Exception as e:
+        if not llm_upstream.available():  # Fail fast instead of waiting for the HTTP timeouts
             gr.Warning("The chatbot is currently unavailable. Please try again later.", duration=10)
-            raise Exception(e, "The remote server is probably down...")
+            raise Exception("The remote server is probably down...")
+        try:
+            ticket = admission.enqueue(get_user_id(request))
+        except Rejected as e:
+            if e.reason == "rate_limited":
+                warning = f"You sent too many questions, please retry in {ceil(e.retry_after)} seconds."
+            else:
+                warning = "The chatbot is overloaded, please try again in a few minutes."
+            gr.Warning(warning, duration=10)
+            yield warning
+            return
 
-        partial_message = ""
         try:
-            if documents:
-                for chunk in response:
-                    if chunk.choices[0].delta.content is not None:
-                        partial_message = partial_message + chunk.choices[0].delta.content
-                        yield partial_message
-                yield partial_message + "\n\n<i><b>References:</b></i>\n" + references
+            while not ticket.granted.is_set():
+                yield queue_status(ticket)
+                try:
+                    await asyncio.wait_for(ticket.granted.wait(), timeout=1)
+                except asyncio.TimeoutError:
+                    pass
+
+            db_ids = [db_id for db_id in (db_ids or []) if db_id != "no_database"]
+            if not db_ids:
+                documents = None
             else:
-                for chunk in response:
-                    if chunk.choices[0].delta.content is not None:
-                        partial_message = partial_message + chunk.choices[0].delta.content
+                try:
+                    documents = await document_search(message, db_ids, k)
+                except UpstreamUnavailable:  # Degraded mode: answer without the databases
+                    gr.Warning("The search server is unavailable, the answer is generated without the databases.",
+                               duration=10)
+                    documents = None
+
+            session = request.session_hash if request is not None else None
+            summary, turns = conversation_memory.apply(session, history) if conversation_memory else (None, history)
+            history_openai_format = history_format(turns)
+            messages, references = append_context_to_history(
+                documents, history_openai_format, message, user_summary, summary
+            )
+            messages = context_builder.trim_history(messages, keep=len(
+                ph.instruction_messages(user_summary, instructions_role) + ph.summary_messages(summary)
+            ))
+            header = ""
+            if documents:  # The references are shown while the answer is generated, they often answer alone
+                header = f"{ph.REFERENCES_HEADER}{references}{ph.ANSWER_HEADER}"
+                yield header
+
+            answer_scope = None
+            if answer_cache is not None and documents and not history:  # Later answers depend on the history
+                versions = [(db_id, db_cache.get_version(db_id)) for db_id in db_ids]
+                answer_scope = answer_cache.scope(versions, user_summary, k, documents)
+                vector = await embed_question(message)
+                answer = answer_cache.get(answer_scope, message, vector)
+                if answer is not None:
+                    async for partial_message in answer_cache.replay(answer, header):
                         yield partial_message
-        except AttributeError:
-            yield "Sorry, the response object does not have the expected structure."
-        except TypeError:
-            yield "Sorry, the documents object is not iterable."
-        except Exception as e:
-            yield f"Sorry, an unexpected error occurred: {str(e)}"
+                    return
+
+            try:
+                backend, response = await llm_upstream.call(
+                    backend_pool.create_stream,
+                    messages=messages,
+                    temperature=0.5,
+                    max_tokens=context_builder.answer_tokens,
+                )
+            except openai.AuthenticationError:
+                gr.Warning("The chatbot is currently unavailable. Please try again later.", duration=10)
+                raise Exception("You didn't create and/or fill your .env file...")
+            except Exception as e:
+                gr.Warning("The chatbot is currently unavailable. Please try again later.", duration=10)
+                raise Exception(e, "The remote server is probably down...")
+
+            partial_message = header
+            generation = generation_tracker.start(response, context_builder.answer_tokens)
+            try:
+                async for partial_message in stream_coalescer.coalesce(generation.deltas(), prefix=header):
+                    yield partial_message
+                if answer_scope is not None and generation.finished:
+                    answer_cache.set(answer_scope, message, partial_message[len(header):], vector)
+                if conversation_memory and generation.finished:  # Summarized after the answer, off the user's path
+                    conversation_memory.schedule(session, list(history) + [[message, partial_message]])
+            except AttributeError:
+                yield "Sorry, the response object does not have the expected structure."
+            except TypeError:
+                yield "Sorry, the documents object is not iterable."
+            except Exception as e:
+                yield f"Sorry, an unexpected error occurred: {str(e)}"
+            finally:  # Also reached when the user stops the generation or leaves: the upstream request is aborted
+                await generation.close()
+                backend_pool.release(backend)
+        finally:  # Frees the answer slot, or leaves the queue if the user stopped while waiting
+            admission.release(ticket)
     else:
         gr.Warning("Please enter a message.")
         yield "Oops! I'd love to help, but I need information to assist you better."
 
-def update_visibility(selected_dropdown: str, gradio_value: str):
-    if selected_dropdown == gradio_value:
+
+def queue_status(ticket) -> str:
+    """
+    This function is used to tell a waiting user their position in the queue and the expected wait
+    """
+    position = admission.position(ticket)
+    expected_wait = admission.expected_wait(position)
+    status = f"<i>You are number {position} in the queue"
+    if expected_wait is not None:
+        status += f", expected wait about {ceil(expected_wait)} seconds"
+    return status + ".</i>"
+
+
+def metrics() -> dict:
+    """
+    This function is used to expose the counters of the admission, of the upstreams, of the caches, of the pipeline
+    stages, of the batching, of the streaming, of the generations, of the conversation memory, of the answer cache and
+    of the inference backends, for tuning purposes. They are the counters of one worker in the multi-worker mode.
+    """
+    return {
+        "worker": copilot_worker,
+        "faiss_cache": db_cache.stats(),
+        "retrieval_cache": retrieval_cache.stats(),
+        "admission": admission.stats(),
+        "upstreams": health_monitor.stats(),
+        "stages": {name: stage.stats() for name, stage in stages.items()},
+        "batching": {
+            "embedding": embedding_batcher.stats(),
+            "search": {db_id: batcher.stats() for db_id, batcher in search_batchers.items()},
+        },
+        "stream": stream_coalescer.stats(),
+        "generations": generation_tracker.stats(),
+        "memory": conversation_memory.stats() if conversation_memory else None,
+        "answer_cache": answer_cache.stats() if answer_cache else None,
+        "backends": backend_pool.stats(),
+    }
+
+
+def update_visibility(selected_dropdown: List[str], gradio_value: str):
+    if not [selected for selected in selected_dropdown or [] if selected != gradio_value]:
         return gr.update(visible=False)
     else:
         return gr.update(visible=True)
@@ -264,7 +535,7 @@ submit_btn = gr.Button(
 use_case_choices = [("No use case","no_use_case"), ("Test case [generation & modification]","test_case")]
 
 # Choices over the database
-choices1 = [("No database", "no_database")]
+choices1 = []
 with open(fh.get_faiss_catalog_path(), "rb") as f:
     databases = pickle.load(f)
 for file in files:
@@ -276,6 +547,8 @@ for file in files:
     db_wi_type = ", ".join(db_wi_type)
     choices1.append((f"{'Group' if db_type == 'group' else 'Project'}: {db_location} - {db_release} ({db_wi_type})",
                      str(file)))
+if os.environ.get("faiss_cache_preload", "false").lower() == "true":
+    db_cache.preload(files)
 # Choices over the number of workitems to retrieve
 choices2 = [n + 1 for n in range(20)]
 
@@ -336,10 +609,11 @@ with gr.Blocks(
                 with gr.Row(equal_height=True):
                     dropdown1 = gr.Dropdown(
                         choices=choices1,
-                        value="no_database",
-                        multiselect=False,
+                        value=[],
+                        multiselect=True,
                         label="Feeding the chatbot",
-                        info="If a database is selected, similarity search will be performed into it before the response is generated.",
+                        info="If databases are selected, similarity search will be performed into them before the response is generated. "
+                             "Leave it empty to chat without database.",
                         show_label=True,
                         interactive=True,
                         elem_id="dropdown_release",
@@ -366,6 +640,9 @@ with gr.Blocks(
                 )
 
     dropdown1.change(fn=update_visibility, inputs=[dropdown1, gr.State("no_database")], outputs=dropdown2)
+    metrics_btn = gr.Button(visible=False)
+    metrics_btn.click(fn=metrics, outputs=gr.JSON(visible=False), api_name="metrics")
 
 if __name__ == '__main__':
-    demo.launch(favicon_path=icon.__str__(), show_error=True, allowed_paths=["."], server_name="127.0.0.1", server_port=7860, root_path="/copilot")
+    demo.queue(default_concurrency_limit=int(os.environ.get("copilot_concurrency", 64)))
+    demo.launch(favicon_path=icon.__str__(), show_error=True, allowed_paths=["."], server_name="127.0.0.1", server_port=copilot_port, root_path="/copilot")
@@ -14,6 +14,7 @@ from termcolor import colored
 from typing import Tuple
 
 import file_helper as fh
+import index_helper as ih
 from WorkitemSaver import WorkitemSaver
 from enhancer import Loader
 from file_helper import faiss_catalog_filled, faiss_db_filled
@@ -164,6 +165,32 @@ if __name__ == "__main__":
                     break
                 except ValueError:
                     print("Invalid input. Please enter at least one of the numbers 1, 2, 3")
+
+            print()
+            print("Choose the type of index of the database: ")
+            print(f"{colored('[1]', 'green')} Flat (exact search)")
+            print(f"{colored('[2]', 'green')} IVF (faster search of large databases, approximate)")
+            print(f"{colored('[3]', 'green')} HNSW (fastest search, approximate, bigger on disk)")
+            index_choice = None
+            while index_choice not in ["", "1", "2", "3"]:
+                index_choice = input(
+                    " \u21AA  Invalid input, retry : "
+                    if index_choice is not None else " \u21AA  Number input or [ENTER] for the default of your .env : ")
+            index_type = ih.INDEX_TYPES[int(index_choice) - 1] if index_choice else None
+
+            print()
+            print("Choose the compression of the vectors of the database: ")
+            print(f"{colored('[1]', 'green')} None (exact vectors)")
+            print(f"{colored('[2]', 'green')} Float16 (half the memory)")
+            print(f"{colored('[3]', 'green')} SQ8 scalar quantization (a quarter of the memory)")
+            print(f"{colored('[4]', 'green')} PQ product quantization (a sixteenth of the memory)")
+            print(f"{colored('[5]', 'green')} PCA reduction (a quarter of the dimensions)")
+            compression_choice = None
+            while compression_choice not in ["", "1", "2", "3", "4", "5"]:
+                compression_choice = input(" \u21AA  Invalid input, retry : " if compression_choice is not None
+                                           else " \u21AA  Number input or [ENTER] for the default of your .env : ")
+            compression = ih.COMPRESSIONS[int(compression_choice) - 1] if compression_choice else None
+            rerank = None
             time = None
             db_id = None
         elif action == "2":  # Update
@@ -184,10 +211,14 @@ if __name__ == "__main__":
             workitem_type = details["workitem_type"]
             release_input = details["release"]
             time = details["last_update"]
+            index = details.get("index", {"type": "flat"})  # Older databases have a flat index
+            index_type = index["type"]
+            compression = index.get("compression", "none")
+            rerank = index.get("rerank", 0)
         else:
             raise ValueError("Invalid input.")
 
-        ws = WorkitemSaver(location, db_type, workitem_type, release_input, time, db_id)
+        ws = WorkitemSaver(location, db_type, workitem_type, release_input, time, db_id, index_type, compression, rerank)
         try:
             ws.caller()
             print("Do you want to continue ? [Y]es / [N]o")
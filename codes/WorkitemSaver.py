@@ -17,9 +17,12 @@ from polarion.polarion import Polarion
 from polarion.workitem import Workitem
 from termcolor import colored
 
+import database_helper as dh
 import file_helper as fh
+import index_helper as ih
 import risk_analysis_helper as ra
 from enhancer import printarrow, Loader
+from upsert_helper import HASH_KEY, content_hash, upsert_chunks
 
 load_dotenv()
 
@@ -35,19 +38,6 @@ def modify_value_in_list_of_dicts(list_of_dicts, value_to_find, new_value):
                 list_of_dicts.append(new_dict)
 
 
-def get_id_from_ibafpuid(faiss_db: FAISS, ibafpuid: str) -> str:
-    """
-    Return the id of a docstore from the ibafullpuid
-    """
-    docstore = getattr(faiss_db, "docstore")
-    index_to_docstore = getattr(faiss_db, "index_to_docstore_id")
-    for v in index_to_docstore.values():
-        vector = docstore.search(v)
-        if vector.metadata["ibafullpuid"] == ibafpuid:
-            return v
-    return ""
-
-
 def str_cleaner(text: str) -> str:
     """
     Clean a string from HTML tags and other characters
@@ -130,7 +120,10 @@ class WorkitemSaver:
             workitem_type: List[str],
             release: Optional[str] = "",
             last_update_date: Optional[datetime] = None,
-            db_id: Optional[str] = None
+            db_id: Optional[str] = None,
+            index_type: Optional[str] = None,
+            compression: Optional[str] = None,
+            rerank: Optional[int] = None
     ):
         self.location_id = location
         self.location_type = location_type
@@ -143,6 +136,9 @@ class WorkitemSaver:
         self.date = last_update_date
         self.workitem_type = workitem_type
         self.db_id = db_id
+        self.index_type = ih.check_index_type(index_type or os.environ.get("faiss_index_type", "flat"))
+        self.compression = ih.check_compression(compression or os.environ.get("faiss_compression", "none"))
+        self.rerank = rerank if rerank is not None else int(os.environ.get("faiss_rerank", 0))
         self.embeddings = HuggingFaceEndpointEmbeddings(model=self.embedding_api, model_kwargs={"truncate": True})
 
     def get_polarion_instance(self) -> Polarion:
@@ -465,27 +461,23 @@ class WorkitemSaver:
         for description, reference in preprocessed_workitems:  # Splitting the descriptions into chunks of 1500 characters
             chunks = [description[i:i + 1500] for i in range(0, len(description), 1500)]
             descriptions.extend(chunks)
-            metadatas.extend([{"ibafullpuid": reference[0], "url": reference[1]}] * len(chunks))
+            metadatas.extend({"ibafullpuid": reference[0], "url": reference[1], HASH_KEY: content_hash(chunk)}
+                             for chunk in chunks)
 
         batch_size = 32  # Creating a batch of 32 descriptions for efficient processing
-        texts = [descriptions[i:i + batch_size] for i in range(0, len(descriptions), batch_size)]
-        metadatas = [metadatas[i:i + batch_size] for i in range(0, len(metadatas), batch_size)]
-        print(metadatas[1])
-        if self.db_id:  # updating a database  --> to check
-            path = str(fh.get_faiss_db_path() / self.db_id)
-            faiss = FAISS.load_local(path, self.embeddings, allow_dangerous_deserialization=True)
+        if self.db_id:  # updating a database: only the chunks that changed are embedded again
+            faiss = dh.load_vector_store(self.db_id, self.embeddings)
             loader = Loader("Precessing embeddings...", "That should be it! Try those with the Copilot",
                             timeout=0.05).start()
-            for i, text in enumerate(texts):
-                for metadata in metadatas[i]:
-                    fullpuid = metadata["ibafullpuid"]
-                    id_index = get_id_from_ibafpuid(faiss, fullpuid)
-                    if id_index:
-                        faiss.delete([id_index])
-                faiss.add_texts(text, metadatas[i])
+            identifiers = dh.load_identifiers(self.db_id, faiss)
+            report = upsert_chunks(faiss, list(zip(descriptions, metadatas)), identifiers, batch_size)
             loader.stop()
-            faiss.save_local(path)
+            print(f"Chunks: {colored(report['skipped'], 'green')} unchanged skipped, {report['replaced']} replaced, "
+                  f"{report['removed']} removed, {report['added']} added.")
+            index = dh.save_database(faiss, self.db_id, self.index_type, self.compression, self.rerank, identifiers)
         else:  # saving a new database
+            texts = [descriptions[i:i + batch_size] for i in range(0, len(descriptions), batch_size)]
+            metadatas = [metadatas[i:i + batch_size] for i in range(0, len(metadatas), batch_size)]
             faiss = FAISS.from_texts(texts=texts[0], metadatas=metadatas[0], embedding=self.embeddings)
             loader = Loader("Precessing embeddings...", "That should be it! Try those with the Copilot",
                             timeout=0.05).start()
@@ -493,8 +485,16 @@ class WorkitemSaver:
                 faiss.add_texts(texts=text, metadatas=metadatas[i])
             loader.stop()
             self.db_id = uuid.uuid4().hex
-            faiss.save_local(str(fh.get_faiss_db_path() / self.db_id))
-        fh.db_to_faiss_catalog(self.db_id, self.location_id, self.release, self.location_type, self.workitem_type, self.now)
+            index = dh.save_database(faiss, self.db_id, self.index_type, self.compression, self.rerank)
+        if "memory_saving" in index:
+            recall = f"recall@10 {index['recall']:.1%}"
+            if "reranked_recall" in index:
+                recall += f" ({index['reranked_recall']:.1%} re-ranking {self.rerank * 10} candidates)"
+            saving = colored(f"{index['memory_saving']:.1%}", "green")
+            print(f"Compressed index ({self.compression}): {saving} of memory saved, {recall} against the uncompressed "
+                  f"{self.index_type} index.")
+        fh.db_to_faiss_catalog(self.db_id, self.location_id, self.release, self.location_type, self.workitem_type, self.now,
+                               index)
 
     def caller(self) -> None:
         workitems = []
@@ -0,0 +1,242 @@
+"""
+Admission control of the Copilot answers.
+A global cap bounds the answers generated at the same time, every user has a token bucket limiting the rate of their
+questions, and the waiting questions are served fairly: the next free slot goes to the user with the fewest answers
+in progress, so one user sending many long generations cannot starve the others.
+"""
+import asyncio
+import itertools
+import os
+import time
+from typing import Dict, List, Optional
+
+
+class Rejected(Exception):
+    """
+    Raised when a question is not admitted
+    :param reason: "rate_limited" or "queue_full"
+    :param retry_after: The time after which the user may retry in seconds
+    """
+
+    def __init__(self, reason: str, retry_after: float = 0.0):
+        super().__init__(reason)
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+class TokenBucket:
+    """
+    Token bucket rate limiter
+    :param rate: The tokens added per second
+    :param burst: The capacity of the bucket
+    """
+
+    def __init__(self, rate: float, burst: int):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+
+    def refill(self, now: float):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def take(self) -> float:
+        """
+        Take a token
+        :return: 0 if a token was taken, otherwise the time until the next token in seconds
+        """
+        self.refill(time.monotonic())
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0.0
+        return (1 - self.tokens) / self.rate if self.rate else float("inf")
+
+
+class Ticket:
+    """
+    A question waiting for, or holding, an answer slot
+    :param background: Whether it is a background request (a summary), served after the questions of the users
+    """
+
+    def __init__(self, user: str, sequence: int, background: bool = False):
+        self.user = user
+        self.sequence = sequence
+        self.background = background
+        self.enqueued = time.perf_counter()
+        self.granted = asyncio.Event()
+        self.started: Optional[float] = None
+
+
+class AdmissionController:
+    """
+    Global cap on the answers in progress, per-user rate limits and a fair queue
+    :param max_active: The maximum number of answers generated at the same time
+    :param max_queue: The maximum number of waiting questions, the next ones are rejected
+    :param user_rate: The questions per minute allowed to every user, 0 to disable the rate limit
+    :param user_burst: The questions a user may send at once before being rate limited
+    """
+
+    def __init__(self, max_active: int = 32, max_queue: int = 128, user_rate: float = 0.0, user_burst: int = 3):
+        self.max_active = max_active
+        self.max_queue = max_queue
+        self.user_rate = user_rate / 60
+        self.user_burst = user_burst
+        self._buckets: Dict[str, TokenBucket] = {}
+        self._waiting: List[Ticket] = []
+        self._active: Dict[str, int] = {}
+        self._sequence = itertools.count()
+        self.admitted = 0
+        self.rejected_rate_limited = 0
+        self.rejected_queue_full = 0
+        self.abandoned = 0
+        self.max_queue_length = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+        self.avg_duration: Optional[float] = None
+
+    @property
+    def active(self) -> int:
+        return sum(self._active.values())
+
+    def _check_rate(self, user: str):
+        if not self.user_rate:
+            return
+        if len(self._buckets) > 4096:  # Forget the users whose bucket is full again
+            now = time.monotonic()
+            for key, bucket in list(self._buckets.items()):
+                bucket.refill(now)
+                if bucket.tokens >= bucket.burst:
+                    del self._buckets[key]
+        bucket = self._buckets.setdefault(user, TokenBucket(self.user_rate, self.user_burst))
+        retry_after = bucket.take()
+        if retry_after:
+            self.rejected_rate_limited += 1
+            raise Rejected("rate_limited", retry_after)
+
+    def _order(self) -> List[Ticket]:
+        """
+        Return the waiting tickets in the order they will be served: a user's n-th waiting question comes after the
+        questions of the users having fewer answers in progress or waiting, then first come first served, the
+        background requests after all the questions
+        """
+        rank = {}
+        keys = {}
+        for ticket in self._waiting:
+            rank[ticket.user] = rank.get(ticket.user, self._active.get(ticket.user, 0)) + 1
+            keys[ticket] = (ticket.background, rank[ticket.user], ticket.sequence)
+        return sorted(self._waiting, key=keys.get)
+
+    def _dispatch(self):
+        while self._waiting and self.active < self.max_active:
+            ticket = self._order()[0]
+            self._waiting.remove(ticket)
+            self._active[ticket.user] = self._active.get(ticket.user, 0) + 1
+            ticket.started = time.perf_counter()
+            wait = ticket.started - ticket.enqueued
+            self.admitted += 1
+            self.total_wait += wait
+            self.max_wait = max(self.max_wait, wait)
+            ticket.granted.set()
+
+    def enqueue(self, user: str, background: bool = False) -> Ticket:
+        """
+        Queue a question of a user, it is granted a slot at once if one is free
+        :param user: The id of the user
+        :param background: Whether it is a background request, not rate limited and served after the questions
+        :raise Rejected: If the user is rate limited or if the queue is full
+        """
+        if len(self._waiting) >= self.max_queue:
+            self.rejected_queue_full += 1
+            raise Rejected("queue_full", self.expected_wait(self.max_queue) or 0.0)
+        if not background:
+            self._check_rate(user)
+        ticket = Ticket(user, next(self._sequence), background)
+        self._waiting.append(ticket)
+        self.max_queue_length = max(self.max_queue_length, len(self._waiting))
+        self._dispatch()
+        return ticket
+
+    def position(self, ticket: Ticket) -> int:
+        """
+        Return the position of a waiting ticket in the queue, starting at 1, or 0 if it was granted
+        """
+        if ticket.granted.is_set():
+            return 0
+        return self._order().index(ticket) + 1
+
+    def expected_wait(self, position: int) -> Optional[float]:
+        """
+        Estimate the wait of a queue position from the average duration of the answers, None until one is known
+        """
+        if self.avg_duration is None:
+            return None
+        return position * self.avg_duration / self.max_active
+
+    def release(self, ticket: Ticket):
+        """
+        Give the slot of a ticket back, or remove it from the queue if it is still waiting
+        """
+        if ticket.started is None:
+            if ticket in self._waiting:
+                self._waiting.remove(ticket)
+                self.abandoned += 1
+            return
+        duration = time.perf_counter() - ticket.started
+        ticket.started = None
+        if not ticket.background:  # The expected wait of the questions
+            self.avg_duration = duration if self.avg_duration is None else 0.9 * self.avg_duration + 0.1 * duration
+        self._active[ticket.user] -= 1
+        if not self._active[ticket.user]:
+            del self._active[ticket.user]
+        self._dispatch()
+
+    def stats(self) -> dict:
+        return {
+            "max_active": self.max_active,
+            "active": self.active,
+            "active_users": len(self._active),
+            "queue_length": len(self._waiting),
+            "max_queue_length": self.max_queue_length,
+            "admitted": self.admitted,
+            "rejected_rate_limited": self.rejected_rate_limited,
+            "rejected_queue_full": self.rejected_queue_full,
+            "abandoned": self.abandoned,
+            "avg_wait_s": round(self.total_wait / self.admitted, 4) if self.admitted else 0.0,
+            "max_wait_s": round(self.max_wait, 4),
+            "avg_answer_s": round(self.avg_duration, 4) if self.avg_duration is not None else None,
+        }
+
+
+def get_user_id(request) -> str:
+    """
+    Return the id of the user of a Gradio request: the login if any, else the client address added to X-Forwarded-For
+    by the reverse proxy (its last address, the previous ones are sent by the client), else the Gradio session
+    :param request: The gr.Request of the event
+    """
+    if request is None:
+        return "anonymous"
+    if getattr(request, "username", None):
+        return request.username
+    forwarded = request.headers.get("x-forwarded-for") if request.headers else None
+    if forwarded and forwarded.split(",")[-1].strip():
+        return forwarded.split(",")[-1].strip()
+    return request.session_hash or "anonymous"
+
+
+def controller_from_env() -> AdmissionController:
+    """
+    Create the admission controller with the settings of the .env file:
+    copilot_llm_concurrency (default 32), copilot_max_queue (default 128),
+    copilot_user_rate (questions per minute, default 0: no rate limit), copilot_user_burst (default 3)
+    """
+    return AdmissionController(
+        max_active=int(os.environ.get("copilot_llm_concurrency", 32)),
+        max_queue=int(os.environ.get("copilot_max_queue", 128)),
+        user_rate=float(os.environ.get("copilot_user_rate", 0)),
+        user_burst=int(os.environ.get("copilot_user_burst", 3)),
+    )
+
+
+if __name__ == '__main__':
+    raise Exception("This file isn't intended to be run directly")
@@ -0,0 +1,153 @@
+"""
+Cache of the answers to the first question of a conversation.
+An answer is keyed by the searched databases and their version (counter of the faiss catalog), the use case,
+the normalized question, k and the retrieved workitems, so it is never served once a database was updated.
+A question can also match a cached one by the similarity of their embeddings, if they retrieved the same workitems.
+"""
+import asyncio
+import hashlib
+import math
+import os
+from collections import OrderedDict
+from typing import AsyncIterator, List, Optional, Tuple
+
+from langchain_core.documents import Document
+
+from retrieval_cache import TTLCache, normalize_query
+
+
+def document_key(doc: Document) -> str:
+    """
+    Return an id of a retrieved chunk: its ibafullpuid and a hash of its content
+    """
+    return f"{doc.metadata.get('ibafullpuid')}:{hashlib.sha1(doc.page_content.encode()).hexdigest()[:12]}"
+
+
+def normalize_vector(vector: List[float]) -> List[float]:
+    norm = math.sqrt(sum(value * value for value in vector)) or 1.0
+    return [value / norm for value in vector]
+
+
+class AnswerCache:
+    """
+    LRU cache of the answers, with a time to live, matched exactly or by similarity
+    :param max_entries: The maximum number of cached answers
+    :param ttl: The time to live of an answer in seconds
+    :param similarity: The cosine similarity above which two questions retrieving the same workitems share their
+    answer, 1 to only match identical (normalized) questions
+    """
+
+    def __init__(self, max_entries: int = 256, ttl: float = 86400, similarity: float = 0.95):
+        self.answers = TTLCache(max_entries, ttl)
+        self.similarity = similarity
+        self.max_entries = max_entries
+        self._questions: "OrderedDict[str, List[Tuple[str, List[float]]]]" = OrderedDict()
+        self.exact_hits = 0
+        self.similar_hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def scope(db_versions: List[Tuple[str, object]], use_case: str, k: int,
+              documents: List[Tuple[Document, float]]) -> str:
+        """
+        Return the part of the key shared by the questions that may share an answer
+        :param db_versions: The searched databases and their version
+        :param use_case: The use case
+        :param k: The number of documents retrieved
+        :param documents: The documents retrieved
+        """
+        parts = [f"{db_id}@{version}" for db_id, version in sorted(db_versions, key=lambda item: item[0])]
+        parts += [use_case, str(k)] + [document_key(doc) for doc, _ in documents]
+        return hashlib.sha1("|".join(parts).encode()).hexdigest()
+
+    def get(self, scope: str, question: str, vector: Optional[List[float]] = None) -> Optional[str]:
+        """
+        Return the cached answer of a question, or None
+        :param scope: The scope of the question, see scope()
+        :param question: The user input
+        :param vector: [Optional] The embedding of the question, for the similarity match
+        """
+        answer = self.answers.get(f"{scope}|{normalize_query(question)}")
+        if answer is not None:
+            self.exact_hits += 1
+            return answer
+        if vector is not None and self.similarity < 1:
+            vector = normalize_vector(vector)
+            for key, cached_vector in self._prune(scope):
+                if sum(a * b for a, b in zip(vector, cached_vector)) >= self.similarity:
+                    answer = self.answers.get(key)
+                    if answer is not None:
+                        self.similar_hits += 1
+                        return answer
+        self.misses += 1
+        return None
+
+    def set(self, scope: str, question: str, answer: str, vector: Optional[List[float]] = None):
+        """
+        Cache the answer of a question
+        """
+        key = f"{scope}|{normalize_query(question)}"
+        self.answers.set(key, answer)
+        if vector is not None and self.similarity < 1:
+            questions = [question for question in self._prune(scope) if question[0] != key]
+            questions.append((key, normalize_vector(vector)))
+            self._questions[scope] = questions[-self.max_entries:]
+            self._questions.move_to_end(scope)
+            while len(self._questions) > self.max_entries:  # The answers of the oldest scopes were evicted
+                self._questions.popitem(last=False)
+
+    def _prune(self, scope: str) -> List[Tuple[str, List[float]]]:
+        """
+        Return the questions of a scope whose answer is still cached, forgetting the others
+        """
+        questions = self._questions.get(scope, [])
+        kept = [question for question in questions if question[0] in self.answers]
+        if len(kept) < len(questions):  # Answers evicted or expired
+            if kept:
+                self._questions[scope] = kept
+            else:
+                del self._questions[scope]
+        return kept
+
+    @staticmethod
+    async def replay(answer: str, prefix: str = "", chunk_chars: int = 64,
+                     interval: float = 0.01) -> AsyncIterator[str]:
+        """
+        Stream a cached answer quickly, so that it is displayed like a generated one
+        :param answer: The cached answer
+        :param prefix: [Optional] A text displayed before the answer
+        :param chunk_chars: The characters added at each update
+        :param interval: The time between two updates in seconds
+        """
+        for end in range(chunk_chars, len(answer) + chunk_chars, chunk_chars):
+            yield prefix + answer[:end]
+            await asyncio.sleep(interval)
+
+    def stats(self) -> dict:
+        total = self.exact_hits + self.similar_hits + self.misses
+        return {
+            "entries": self.answers.stats()["entries"],
+            "exact_hits": self.exact_hits,
+            "similar_hits": self.similar_hits,
+            "misses": self.misses,
+            "hit_rate": round((self.exact_hits + self.similar_hits) / total, 3) if total else 0.0,
+        }
+
+
+def answer_cache_from_env() -> Optional[AnswerCache]:
+    """
+    Create the answer cache with the settings of the .env file, None if it isn't enabled:
+    answer_cache (true or false, default false), answer_cache_size (default 256),
+    answer_cache_ttl (seconds, default 86400), answer_cache_similarity (default 0.95, 1 for exact matches only)
+    """
+    if os.environ.get("answer_cache", "false").lower() != "true":
+        return None
+    return AnswerCache(
+        max_entries=int(os.environ.get("answer_cache_size", 256)),
+        ttl=float(os.environ.get("answer_cache_ttl", 86400)),
+        similarity=float(os.environ.get("answer_cache_similarity", 0.95)),
+    )
+
+
+if __name__ == '__main__':
+    raise Exception("This file isn't intended to be run directly")
@@ -0,0 +1,164 @@
+"""
+Pool of OpenAI-compatible inference backends (vLLM servers).
+Requests are routed to the healthy backend with the least outstanding requests, the backends are probed by the health
+monitor (health_helper.py) for health and latency, and a request failing on a backend is retried on the next one.
+"""
+import os
+import threading
+import time
+from typing import List, Optional, Tuple
+
+import httpx
+import openai
+from openai import AsyncOpenAI
+from termcolor import colored
+
+
+class Backend:
+    """
+    An inference backend
+    :param base_url: The URL of the OpenAI-like API (finishing with "/v1")
+    :param model: The name of the model served by the backend
+    :param api_key: The API key of the backend
+    """
+
+    def __init__(self, base_url: str, model: str, api_key: str = "EMPTY"):
+        self.base_url = base_url.rstrip("/")
+        self.model = model
+        self.api_key = api_key
+        self.client = AsyncOpenAI(api_key=api_key, base_url=self.base_url, max_retries=0,  # The pool fails over instead
+                                  timeout=httpx.Timeout(600.0, connect=5.0))
+        self.healthy = True
+        self.outstanding = 0
+        self.requests = 0
+        self.failures = 0
+        self.latency: Optional[float] = None
+
+    def probe(self, timeout: float = 5.0) -> bool:
+        """
+        Check that the backend answers on /models and update its health and latency
+        """
+        start = time.perf_counter()
+        try:
+            response = httpx.get(f"{self.base_url}/models", timeout=timeout,
+                                 headers={"Authorization": f"Bearer {self.api_key}"})
+            healthy = response.status_code == 200
+        except httpx.HTTPError:
+            healthy = False
+        if healthy:
+            latency = time.perf_counter() - start
+            self.latency = latency if self.latency is None else 0.8 * self.latency + 0.2 * latency
+        self.healthy = healthy
+        return healthy
+
+    def stats(self) -> dict:
+        return {
+            "model": self.model,
+            "healthy": self.healthy,
+            "outstanding": self.outstanding,
+            "requests": self.requests,
+            "failures": self.failures,
+            "latency_s": round(self.latency, 4) if self.latency is not None else None,
+        }
+
+
+class BackendPool:
+    """
+    Least-outstanding-requests routing over several backends, with health checks and failover
+    :param backends: The backends of the pool
+    """
+
+    def __init__(self, backends: List[Backend]):
+        if not backends:
+            raise ValueError("The backend pool needs at least one backend")
+        self.backends = backends
+        self.failovers = 0
+        self._lock = threading.Lock()
+
+    def probe(self) -> bool:
+        """
+        Probe every backend once
+        :return: True if at least one backend is healthy
+        """
+        for backend in self.backends:
+            was_healthy = backend.healthy
+            if backend.probe() != was_healthy:
+                print(colored(f"Inference backend {backend.base_url} is {'up' if backend.healthy else 'down'}.",
+                              "green" if backend.healthy else "yellow"))
+        return any(backend.healthy for backend in self.backends)
+
+    def ranked(self) -> List[Backend]:
+        """
+        Return the backends in order of preference: healthy first, then least outstanding requests, then latency
+        """
+        with self._lock:
+            return sorted(self.backends, key=lambda backend: (
+                not backend.healthy,
+                backend.outstanding,
+                backend.latency if backend.latency is not None else float("inf"),
+            ))
+
+    async def create_stream(self, **kwargs) -> Tuple[Backend, object]:
+        """
+        Start a streamed chat completion on the best backend, failing over to the next ones on errors.
+        The backend must be given back with release() when the stream is over.
+        :param kwargs: The arguments of client.chat.completions.create, without the model
+        :return: The backend and the stream in a tuple
+        """
+        error: Optional[Exception] = None
+        for attempt, backend in enumerate(self.ranked()):
+            with self._lock:
+                backend.outstanding += 1
+                backend.requests += 1
+            try:
+                response = await backend.client.chat.completions.create(model=backend.model, stream=True, **kwargs)
+            except openai.AuthenticationError:
+                self.release(backend)
+                raise
+            except Exception as e:
+                self.release(backend)
+                backend.failures += 1
+                backend.healthy = False  # Until the next successful health check
+                error = e
+                continue
+            except BaseException:  # Cancelled
+                self.release(backend)
+                raise
+            if attempt:
+                self.failovers += 1
+            return backend, response
+        raise error
+
+    def release(self, backend: Backend):
+        """
+        Give a backend back once its stream is over
+        """
+        with self._lock:
+            backend.outstanding -= 1
+
+    def stats(self) -> dict:
+        return {
+            "failovers": self.failovers,
+            "backends": {backend.base_url: backend.stats() for backend in self.backends},
+        }
+
+
+def pool_from_env() -> BackendPool:
+    """
+    Create the backend pool with the settings of the .env file:
+    openai_api (comma separated URLs), openai_model (comma separated model names, one for every backend or
+    one for all, default mistralai/Mistral-7B-Instruct-v0.3)
+    """
+    urls = [url.strip() for url in os.environ.get("openai_api", "").split(",") if url.strip()]
+    if not urls:
+        raise Exception("The openai_api variable of your .env file is empty...")
+    models = [model.strip() for model in
+              os.environ.get("openai_model", "mistralai/Mistral-7B-Instruct-v0.3").split(",") if model.strip()]
+    if len(models) not in (1, len(urls)):
+        raise ValueError("openai_model must contain one model, or one model for every URL of openai_api")
+    backends = [Backend(url, models[i] if len(models) > 1 else models[0]) for i, url in enumerate(urls)]
+    return BackendPool(backends)
+
+
+if __name__ == '__main__':
+    raise Exception("This file isn't intended to be run directly")
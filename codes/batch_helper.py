@@ -0,0 +1,106 @@
+"""
+Micro-batching of the concurrent requests to a batch-friendly backend (embedding server, FAISS index).
+The items submitted within a short window are processed by one call, and identical items in flight are only
+processed once, every caller receiving its own result.
+"""
+import asyncio
+import os
+from typing import Any, Awaitable, Callable, Dict, Hashable, List, Optional, Tuple
+
+
+class MicroBatcher:
+    """
+    Gather the items submitted within a window into one batch
+    :param process: An async function returning the results of a batch of items, in the same order
+    :param window: The time during which the items are gathered in seconds
+    :param max_batch: The number of items processing the batch at once
+    """
+
+    def __init__(self, process: Callable[[List[Any]], Awaitable[List[Any]]], window: float = 0.005,
+                 max_batch: int = 32):
+        self.process = process
+        self.window = window
+        self.max_batch = max_batch
+        self._pending: List[Tuple[Hashable, Any]] = []
+        self._futures: Dict[Hashable, asyncio.Future] = {}
+        self._timer: Optional[asyncio.TimerHandle] = None
+        self._tasks = set()
+        self.items = 0
+        self.deduplicated = 0
+        self.batches = 0
+        self.max_batch_size = 0
+
+    async def submit(self, item: Any, key: Optional[Hashable] = None) -> Any:
+        """
+        Add an item to the next batch and wait for its result
+        :param item: The item
+        :param key: [Optional] The key identifying identical items, the item itself by default
+        """
+        key = item if key is None else key
+        self.items += 1
+        future = self._futures.get(key)
+        if future is not None:  # The same item is already waiting or being processed
+            self.deduplicated += 1
+        else:
+            loop = asyncio.get_running_loop()
+            future = self._futures[key] = loop.create_future()
+            self._pending.append((key, item))
+            if len(self._pending) >= self.max_batch:
+                self._flush()
+            elif self._timer is None:
+                self._timer = loop.call_later(self.window, self._flush)
+        return await asyncio.shield(future)  # A cancelled caller doesn't cancel the others
+
+    def _flush(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        batch, self._pending = self._pending, []
+        if batch:
+            task = asyncio.get_running_loop().create_task(self._run(batch))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    async def _run(self, batch: List[Tuple[Hashable, Any]]):
+        self.batches += 1
+        self.max_batch_size = max(self.max_batch_size, len(batch))
+        try:
+            results = await self.process([item for _, item in batch])
+            for (key, _), result in zip(batch, results):
+                self._futures[key].set_result(result)
+        except BaseException as e:
+            for key, _ in batch:
+                if not self._futures[key].done():
+                    self._futures[key].set_exception(e)
+                    self._futures[key].exception()  # Retrieved by the callers, don't warn if they were cancelled
+            if not isinstance(e, Exception):
+                raise
+        finally:
+            for key, _ in batch:
+                self._futures.pop(key, None)
+
+    def stats(self) -> dict:
+        processed = self.items - self.deduplicated
+        return {
+            "items": self.items,
+            "deduplicated": self.deduplicated,
+            "batches": self.batches,
+            "avg_batch_size": round(processed / self.batches, 2) if self.batches else 0.0,
+            "max_batch_size": self.max_batch_size,
+        }
+
+
+def batcher_from_env(process: Callable[[List[Any]], Awaitable[List[Any]]]) -> MicroBatcher:
+    """
+    Create a micro-batcher with the settings of the .env file:
+    batch_window_ms (default 5), batch_max_size (default 32)
+    """
+    return MicroBatcher(
+        process,
+        window=float(os.environ.get("batch_window_ms", 5)) / 1000,
+        max_batch=int(os.environ.get("batch_max_size", 32)),
+    )
+
+
+if __name__ == '__main__':
+    raise Exception("This file isn't intended to be run directly")
@@ -0,0 +1,180 @@
+"""
+Lexical search over the chunks of a database, with an inverted index scored with BM25.
+It finds the exact signal names, PUIDs and abbreviations that the dense embeddings handle poorly.
+"""
+import hashlib
+import math
+import re
+from pathlib import Path
+from typing import Dict, Hashable, Iterable, List, Optional, Tuple, Union
+
+import numpy as np
+from langchain_community.vectorstores.faiss import FAISS
+
+_token_pattern = re.compile(r"\w+(?:[-.]\w+)*")
+
+
+def tokenize(text: str) -> List[str]:
+    """
+    Split a text in lowercase terms. Compound identifiers (e.g. 'PTS-REQ-12', 'motion.enable') are kept whole
+    and their parts are added as well.
+    """
+    terms = []
+    for token in _token_pattern.findall(text.lower()):
+        terms.append(token)
+        if "-" in token or "." in token:
+            terms.extend(part for part in re.split(r"[-.]", token) if part)
+    return terms
+
+
+def term_hash(term: str) -> int:
+    """
+    Return the 64 bits hash of a term, stable across processes
+    """
+    return int.from_bytes(hashlib.blake2b(term.encode(), digest_size=8).digest(), "little")
+
+
+class BM25Index:
+    """
+    Compact inverted index of the chunks of a database, scored with BM25.
+    The postings are stored in CSR arrays saved in .npy files: the sorted hashes of the terms, the offset of the
+    postings of every term, then the document numbers (uint32) and the term frequencies (uint16) of the postings.
+    The arrays can be memory mapped read-only, so that the Copilot workers share them in the page cache.
+    The terms with a very low idf (found in most chunks) are skipped by the searches.
+    :param arrays: The arrays of the index by name, see ARRAYS
+    :param k1: The term frequency saturation parameter
+    :param b: The length normalization parameter
+    :param min_idf: The idf under which a term of a query is skipped
+    """
+
+    ARRAYS = ("terms", "offsets", "documents", "frequencies", "lengths", "doc_ids")
+
+    def __init__(self, arrays: Dict[str, np.ndarray], k1: float = 1.5, b: float = 0.75, min_idf: float = 0.2):
+        self.k1 = k1
+        self.b = b
+        self.min_idf = min_idf
+        self.terms = arrays["terms"]  # uint64 hashes of the terms, sorted
+        self.offsets = arrays["offsets"]  # int64, the postings of term i are offsets[i]:offsets[i + 1]
+        self.documents = arrays["documents"]  # uint32 document numbers
+        self.frequencies = arrays["frequencies"]  # uint16 term frequencies
+        self.lengths = arrays["lengths"]  # uint32 number of terms of every document
+        self.doc_ids = arrays["doc_ids"]  # docstore id of every document number, as bytes
+        self.doc_count = len(self.lengths)
+        self.average_length = float(self.lengths.sum()) / self.doc_count if self.doc_count else 0.0
+
+    @classmethod
+    def build(cls, documents: Iterable[Tuple[str, str]]) -> "BM25Index":
+        """
+        Build the index of chunks
+        :param documents: The docstore id and the text of every chunk
+        """
+        postings: Dict[int, Dict[int, int]] = {}
+        doc_ids, lengths = [], []
+        for number, (doc_id, text) in enumerate(documents):
+            terms = tokenize(text)
+            doc_ids.append(doc_id)
+            lengths.append(len(terms))
+            for term in terms:
+                term_postings = postings.setdefault(term_hash(term), {})
+                term_postings[number] = term_postings.get(number, 0) + 1
+        terms = sorted(postings)
+        sizes = [len(postings[term]) for term in terms]
+        return cls({
+            "terms": np.array(terms, dtype=np.uint64),
+            "offsets": np.concatenate(([0], np.cumsum(sizes))).astype(np.int64),
+            "documents": np.fromiter((number for term in terms for number in postings[term]), dtype=np.uint32,
+                                     count=sum(sizes)),
+            "frequencies": np.fromiter((min(frequency, 65535) for term in terms
+                                        for frequency in postings[term].values()), dtype=np.uint16, count=sum(sizes)),
+            "lengths": np.array(lengths, dtype=np.uint32),
+            "doc_ids": np.array([doc_id.encode() for doc_id in doc_ids], dtype=bytes),
+        })
+
+    def search(self, query: str, k: int) -> List[Tuple[str, float]]:
+        """
+        Return the k best chunks for a query
+        :param query: The query
+        :param k: The number of chunks to return
+        :return: A list of (docstore id, BM25 score), best first
+        """
+        if not self.doc_count or not len(self.terms):
+            return []
+        hashes = np.array(sorted({term_hash(term) for term in tokenize(query)}), dtype=np.uint64)
+        if not len(hashes):
+            return []
+        rows = np.searchsorted(self.terms, hashes)
+        inside = rows < len(self.terms)
+        rows, hashes = rows[inside], hashes[inside]
+        rows = rows[self.terms[rows] == hashes]  # The terms of the query found in the chunks
+        numbers, contributions = [], []
+        for row in rows:
+            start, end = int(self.offsets[row]), int(self.offsets[row + 1])
+            idf = math.log(1 + (self.doc_count - (end - start) + 0.5) / (end - start + 0.5))
+            if idf < self.min_idf:  # Found in most chunks, it doesn't tell them apart
+                continue
+            documents = self.documents[start:end]
+            frequencies = self.frequencies[start:end].astype(np.float64)
+            norm = self.k1 * (1 - self.b + self.b * self.lengths[documents] / self.average_length)
+            numbers.append(documents)
+            contributions.append(idf * frequencies * (self.k1 + 1) / (frequencies + norm))
+        if not numbers:
+            return []
+        found, inverse = np.unique(np.concatenate(numbers), return_inverse=True)
+        scores = np.bincount(inverse, weights=np.concatenate(contributions))
+        top = np.argpartition(-scores, k - 1)[:k] if len(scores) > k else np.arange(len(scores))
+        best = top[np.argsort(-scores[top], kind="stable")]
+        return [(self.doc_ids[found[i]].decode(), float(scores[i])) for i in best]
+
+    @classmethod
+    def from_faiss(cls, faiss: FAISS) -> "BM25Index":
+        """
+        Build the index of every chunk of a faiss database, with its ibafullpuid
+        """
+        def documents():
+            for doc_id in faiss.index_to_docstore_id.values():
+                doc = faiss.docstore.search(doc_id)
+                yield doc_id, f"{doc.page_content} {doc.metadata.get('ibafullpuid', '')}"
+        return cls.build(documents())
+
+    def save(self, folder: Union[str, Path]):
+        """
+        Save the arrays of the index in the folder of a database
+        """
+        for name in self.ARRAYS:
+            np.save(Path(folder) / f"bm25_{name}.npy", getattr(self, name))
+
+    @classmethod
+    def files(cls, folder: Union[str, Path]) -> List[Path]:
+        return [Path(folder) / f"bm25_{name}.npy" for name in cls.ARRAYS]
+
+    @classmethod
+    def load(cls, folder: Union[str, Path], mmap: bool = False) -> Optional["BM25Index"]:
+        """
+        Load the index saved in the folder of a database, None if it has none
+        :param folder: The folder of the database
+        :param mmap: Whether the arrays are memory mapped read-only instead of read
+        """
+        folder = Path(folder)
+        if all(file.exists() for file in cls.files(folder)):
+            return cls({name: np.load(file, mmap_mode="r" if mmap else None)
+                        for name, file in zip(cls.ARRAYS, cls.files(folder))})
+        return None
+
+
+def reciprocal_rank_fusion(rankings: List[List[Hashable]], k: int, constant: int = 60) -> List[Tuple[Hashable, float]]:
+    """
+    Fuse several rankings of the same items
+    :param rankings: Lists of keys, best first
+    :param k: The number of keys to return
+    :param constant: The RRF constant, dampening the weight of the first ranks
+    :return: A list of (key, fused score), best first
+    """
+    scores: Dict[Hashable, float] = {}
+    for ranking in rankings:
+        for rank, key in enumerate(ranking, start=1):
+            scores[key] = scores.get(key, 0.0) + 1 / (constant + rank)
+    return sorted(scores.items(), key=lambda item: item[1], reverse=True)[:k]
+
+
+if __name__ == '__main__':
+    raise Exception("This file isn't intended to be run directly")
@@ -0,0 +1,77 @@
+"""
+Concurrency limits of the Copilot pipeline stages (embedding, database search).
+The generations are bounded by the admission controller (admission_helper.py).
+Each stage has its own limit and keeps track of its queue depth and of the time spent waiting for a slot.
+"""
+import asyncio
+import os
+import time
+from contextlib import asynccontextmanager
+from typing import Dict
+
+
+class StageLimiter:
+    """
+    Bounded concurrency for one stage of the pipeline
+    :param name: The name of the stage
+    :param limit: The maximum number of concurrent calls to the stage
+    """
+
+    def __init__(self, name: str, limit: int):
+        self.name = name
+        self.limit = limit
+        self.waiting = 0
+        self.active = 0
+        self.calls = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+        self._semaphore = None
+
+    @asynccontextmanager
+    async def slot(self):
+        """
+        Wait for a free slot of the stage and hold it while the context is open
+        """
+        if self._semaphore is None:  # Created lazily so that it belongs to the running event loop
+            self._semaphore = asyncio.Semaphore(self.limit)
+        start = time.perf_counter()
+        self.waiting += 1
+        try:
+            await self._semaphore.acquire()
+        finally:
+            self.waiting -= 1
+        wait = time.perf_counter() - start
+        self.calls += 1
+        self.total_wait += wait
+        self.max_wait = max(self.max_wait, wait)
+        self.active += 1
+        try:
+            yield
+        finally:
+            self.active -= 1
+            self._semaphore.release()
+
+    def stats(self) -> dict:
+        return {
+            "limit": self.limit,
+            "active": self.active,
+            "queue_depth": self.waiting,
+            "calls": self.calls,
+            "avg_wait_s": round(self.total_wait / self.calls, 4) if self.calls else 0.0,
+            "max_wait_s": round(self.max_wait, 4),
+        }
+
+
+def stages_from_env() -> Dict[str, StageLimiter]:
+    """
+    Create the stage limiters with the settings of the .env file:
+    copilot_embedding_concurrency (default 8), copilot_search_concurrency (default 4)
+    """
+    return {
+        "embedding": StageLimiter("embedding", int(os.environ.get("copilot_embedding_concurrency", 8))),
+        "search": StageLimiter("search", int(os.environ.get("copilot_search_concurrency", 4))),
+    }
+
+
+if __name__ == '__main__':
+    raise Exception("This file isn't intended to be run directly")
@@ -0,0 +1,134 @@
+"""
+Token-budgeted assembly of the prompt sent to the LLM.
+Retrieved chunks of the same workitem are merged, the context is cut to a token budget, and the oldest turns of the
+conversation are dropped when the whole prompt wouldn't fit in the context window of the model.
+"""
+import os
+from functools import lru_cache
+from typing import Callable, Dict, List, Optional, Tuple
+
+from langchain_core.documents import Document
+from termcolor import colored
+
+
+def load_token_counter(model: str) -> Callable[[str], int]:
+    """
+    Return a function counting the tokens of a text with the tokenizer of the model.
+    If the tokenizer can't be loaded, the count is estimated to one token every 4 characters.
+    :param model: The HuggingFace ID of the model
+    """
+    try:
+        from tokenizers import Tokenizer
+        tokenizer = Tokenizer.from_pretrained(model)
+
+        def count(text: str) -> int:
+            return len(tokenizer.encode(text, add_special_tokens=False).ids)
+    except Exception as e:
+        print(colored(f"Tokenizer of {model} unavailable, token counts will be estimated: {e}", "yellow"))
+
+        def count(text: str) -> int:
+            return len(text) // 4 + 1
+    return lru_cache(maxsize=4096)(count)
+
+
+class ContextBuilder:
+    """
+    Build the parts of the prompt within token budgets
+    :param count_tokens: A function returning the number of tokens of a text
+    :param context_window: The context window of the model in tokens
+    :param answer_tokens: The number of tokens kept free for the answer
+    :param context_tokens: The maximum number of tokens of the retrieved context
+    """
+    message_overhead = 4  # Tokens added by the chat template around each message
+
+    def __init__(
+            self,
+            count_tokens: Callable[[str], int],
+            context_window: int = 32768,
+            answer_tokens: int = 2048,
+            context_tokens: int = 4096
+    ):
+        self.count_tokens = count_tokens
+        self.context_window = context_window
+        self.answer_tokens = answer_tokens
+        self.context_tokens = context_tokens
+
+    @staticmethod
+    def merge_documents(documents: List[Tuple[Document, float]]) -> List[Dict]:
+        """
+        Merge the chunks belonging to the same workitem, in the order of their best score
+        :param documents: The documents found in the database
+        :return: A list of dict with the puid, the merged content, the url and the best score of each workitem
+        """
+        merged: Dict[str, Dict] = {}
+        for doc, score in documents:
+            puid = doc.metadata["ibafullpuid"]
+            if puid not in merged:
+                merged[puid] = {"puid": puid, "content": doc.page_content, "url": doc.metadata.get("url"),
+                                "score": score}
+            elif doc.page_content not in merged[puid]["content"]:
+                merged[puid]["content"] += " " + doc.page_content
+        return list(merged.values())
+
+    def build_context(self, merged_documents: List[Dict], budget: Optional[int] = None) -> str:
+        """
+        Build the context given to the LLM, without urls, cut to the token budget.
+        The workitems are added by relevance until the budget is reached, the last one may be truncated.
+        :param merged_documents: The merged documents
+        :param budget: [Optional] The token budget, context_tokens by default
+        :return: The context
+        """
+        budget = self.context_tokens if budget is None else budget
+        context = ""
+        used = 0
+        for doc in merged_documents:
+            line = f" - {doc['content']} {doc['puid']}\n"
+            tokens = self.count_tokens(line)
+            if used + tokens > budget:
+                remaining = budget - used
+                if remaining > 32:  # Keep the beginning of the workitem if there is enough room for it
+                    context += f" - {doc['content'][:remaining * 4]}... {doc['puid']}\n"
+                break
+            context += line
+            used += tokens
+        return context
+
+    def count_messages(self, messages: List[dict]) -> int:
+        return sum(self.count_tokens(message["content"]) + self.message_overhead for message in messages)
+
+    def trim_history(self, messages: List[dict], keep: int = 0) -> List[dict]:
+        """
+        Drop the oldest turns of the conversation until the prompt fits in the context window.
+        The first messages (the instructions), leading system messages and the last message (the question) are
+        always kept.
+        :param messages: The messages in the OpenAI format
+        :param keep: The number of first messages to keep
+        :return: The messages that fit in the context window
+        """
+        budget = self.context_window - self.answer_tokens
+        head, messages = messages[:keep], messages[keep:]
+        while len(messages) > 1 and messages[0]["role"] == "system":
+            head.append(messages[0])
+            messages = messages[1:]
+        history, question = messages[:-1], messages[-1:]
+        while history and self.count_messages(head + history + question) > budget:
+            history = history[2:] if history[0]["role"] == "user" and len(history) > 1 else history[1:]
+        return head + history + question
+
+
+def builder_from_env() -> ContextBuilder:
+    """
+    Create the context builder with the settings of the .env file:
+    tokenizer_model (default mistralai/Mistral-7B-Instruct-v0.3), copilot_context_window (default 32768),
+    copilot_answer_tokens (default 2048), copilot_context_tokens (default 4096)
+    """
+    return ContextBuilder(
+        load_token_counter(os.environ.get("tokenizer_model", "mistralai/Mistral-7B-Instruct-v0.3")),
+        context_window=int(os.environ.get("copilot_context_window", 32768)),
+        answer_tokens=int(os.environ.get("copilot_answer_tokens", 2048)),
+        context_tokens=int(os.environ.get("copilot_context_tokens", 4096)),
+    )
+
+
+if __name__ == '__main__':
+    raise Exception("This file isn't intended to be run directly")
@@ -0,0 +1,290 @@
+"""
+Storage of the databases: the faiss index, the SQLite docstore of the chunks and the indexes saved next to them in the
+database folder. The databases saved before the SQLite docstore have a pickled docstore, see migrate_docstore.py.
+The Copilot can memory map the faiss index read-only instead of reading it, so that its processes share the pages of
+the index in the page cache. Every save of a database writes a new version folder, which becomes the current version
+in one atomic step once all its files are written, so that a process loading the database never mixes the files of two
+versions. The processes mapping the files of the former version keep reading them until they load the new one.
+"""
+import operator
+import os
+import pickle
+import re
+import shutil
+from pathlib import Path
+from typing import Dict, List, Mapping, Optional, Tuple
+
+import faiss as faiss_lib
+import numpy as np
+from langchain_community.docstore.base import Docstore
+from langchain_community.vectorstores.faiss import FAISS
+from langchain_community.vectorstores.utils import DistanceStrategy
+from langchain_core.documents import Document
+from langchain_core.embeddings import Embeddings
+from termcolor import colored
+
+import file_helper as fh
+import index_helper as ih
+from bm25_helper import BM25Index
+from docstore_helper import DOCSTORE_FILE, SQLiteDocstore, write_docstore
+from identifier_helper import IdentifierIndex
+
+INDEX_FILE = "index.faiss"  # The names given by FAISS.save_local
+PICKLED_DOCSTORE_FILE = "index.pkl"
+# The inverted lists of an IVF index are mapped, and the vectors or codes of the other indexes, except the graph of an
+# HNSW index which is read. Faiss can't map both in one index.
+MMAP_FLAGS = {
+    "ivf": faiss_lib.IO_FLAG_MMAP | faiss_lib.IO_FLAG_READ_ONLY,
+    "flat": faiss_lib.IO_FLAG_MMAP_IFC | faiss_lib.IO_FLAG_READ_ONLY,
+    "hnsw": faiss_lib.IO_FLAG_MMAP_IFC | faiss_lib.IO_FLAG_READ_ONLY,
+}
+IDENTIFIERS_FILE = "identifiers.pkl"
+VECTORS_FILE = "vectors.npy"  # The exact vectors of a compressed index, memory mapped
+INDEX_INFO_FILE = "index_info.pkl"  # The type and the parameters of the index of the version, as in the faiss catalog
+
+
+class Database:
+    """
+    A loaded database
+    :param db_id: The id of the database
+    :param faiss: The faiss vector store
+    :param bm25: [Optional] The lexical index of the chunks, None for databases saved without it
+    :param identifiers: [Optional] The index of the chunks by workitem identifier
+    :param vectors: [Optional] The exact vectors of a compressed faiss index
+    :param rerank: The candidates re-ranked with the exact vectors, as a multiple of k, 0 to disable
+    :param mapped: Whether the faiss index is memory mapped, it can't be modified then
+    """
+
+    def __init__(
+            self,
+            db_id: str,
+            faiss: FAISS,
+            bm25: Optional[BM25Index] = None,
+            identifiers: Optional[IdentifierIndex] = None,
+            vectors: Optional[np.ndarray] = None,
+            rerank: int = 0,
+            mapped: bool = False
+    ):
+        self.db_id = db_id
+        self.faiss = faiss
+        self.bm25 = bm25
+        self.identifiers = identifiers
+        self.vectors = vectors
+        self.rerank = rerank if vectors is not None else 0
+        self.mapped = mapped
+        self._positions: Optional[Dict[str, int]] = None
+
+    def get_vector(self, doc_id: str) -> List[float]:
+        """
+        Return the vector stored in the faiss index for a chunk
+        :param doc_id: The docstore id of the chunk
+        """
+        if self._positions is None:
+            self._positions = {}
+            if not isinstance(self.faiss.docstore, SQLiteDocstore):
+                self._positions = {v: k for k, v in self.faiss.index_to_docstore_id.items()}
+            ivf = faiss_lib.try_extract_index_ivf(self.faiss.index)
+            if self.vectors is None and ivf is not None:
+                ivf.make_direct_map()
+        if isinstance(self.faiss.docstore, SQLiteDocstore):
+            position = self.faiss.docstore.position(doc_id)
+        else:
+            position = self._positions[doc_id]
+        if self.vectors is not None:
+            return np.asarray(self.vectors[position], dtype=np.float32).tolist()
+        return self.faiss.index.reconstruct(position).tolist()
+
+    def search_batch(
+            self,
+            vectors: List[List[float]],
+            k: int,
+            score_threshold: Optional[float] = None
+    ) -> List[List[Tuple[Document, float]]]:
+        """
+        Search the closest chunks of several vectors with one call to the faiss index, with the same results as
+        FAISS.similarity_search_with_score_by_vector for each of them, re-ranked with the exact vectors if enabled
+        :param vectors: The query vectors
+        :param k: The number of chunks to return for each vector
+        :param score_threshold: [Optional] The worst score kept
+        :return: The chunks and their score, for each vector
+        """
+        queries = np.array(vectors, dtype=np.float32)
+        if self.faiss._normalize_L2:
+            faiss_lib.normalize_L2(queries)
+        scores, indices = ih.search(self.faiss.index, queries, k, self.vectors, self.rerank * k)
+        keep = operator.ge if self.faiss.distance_strategy in (
+            DistanceStrategy.MAX_INNER_PRODUCT, DistanceStrategy.JACCARD
+        ) else operator.le
+        results = []
+        for row_scores, row_indices in zip(scores, indices):
+            documents = []
+            for score, i in zip(row_scores, row_indices):
+                if i == -1:  # Fewer chunks than k in the index
+                    continue
+                if score_threshold is None or keep(score, score_threshold):
+                    documents.append((self.faiss.docstore.search(self.faiss.index_to_docstore_id[i]), score))
+            results.append(documents)
+        return results
+
+
+def get_db_path(db_id: str) -> Path:
+    """
+    Returns /faiss_databases/<db_id>/ absolute path
+    """
+    return fh.get_faiss_db_path() / db_id
+
+
+def save_database(faiss: FAISS, db_id: str, index_type: str = "flat", compression: str = "none",
+                  rerank: int = 0, identifiers: Optional[IdentifierIndex] = None) -> Dict:
+    """
+    Save the faiss vector store and build the indexes saved with it, in a new version of the database.
+    The exact vectors of a compressed index are saved next to it, to re-rank the candidates and to rebuild the index.
+    :param faiss: The faiss vector store, with an exact index
+    :param db_id: The id of the database
+    :param index_type: The type of the faiss index, see index_helper.INDEX_TYPES
+    :param compression: The compression of the faiss index, see index_helper.COMPRESSIONS
+    :param rerank: The candidates re-ranked with the exact vectors, as a multiple of k, 0 to disable
+    :param identifiers: [Optional] The index of the chunks by identifier maintained by an update, built if not given
+    :return: The type and the parameters of the saved faiss index, with the memory saving and the recall of a
+    compressed index, for the faiss catalog
+    """
+    path = get_db_path(db_id)
+    path.mkdir(parents=True, exist_ok=True)
+    versions = [int(match.group(1)) for match in map(re.compile(r"v(\d+)").fullmatch, os.listdir(path)) if match]
+    version = path / f"v{max(versions, default=0) + 1}"
+    version.mkdir()
+    if ih.check_compression(compression) == "none":
+        faiss.index = ih.convert_index(faiss.index, index_type)
+        report = {}
+    else:
+        vectors = ih.reconstruct_vectors(faiss.index)
+        np.save(version / VECTORS_FILE, vectors)
+        faiss.index = ih.build_index(vectors, index_type, faiss.index.metric_type, compression)
+        report = {"rerank": rerank, **ih.compression_report(faiss.index, vectors, rerank)}
+    faiss_lib.write_index(faiss.index, str(version / INDEX_FILE))
+    write_docstore(version / DOCSTORE_FILE, faiss.docstore, faiss.index_to_docstore_id)
+    BM25Index.from_faiss(faiss).save(version)
+    (identifiers or IdentifierIndex.from_faiss(faiss)).save(version / IDENTIFIERS_FILE)
+    info = {**ih.describe_index(faiss.index), **report}
+    fh.write_pkl_file(version / INDEX_INFO_FILE, info)  # Read with the version, the catalog is updated after it
+    fh.set_db_version(db_id, version.name)
+    # The former versions, the files of a database saved before the versions and the folders of interrupted saves.
+    # A folder still open by a process on Windows is deleted by the next save.
+    for entry in path.iterdir():
+        if entry.is_dir() and entry != version:
+            shutil.rmtree(entry, ignore_errors=True)
+        elif entry.is_file() and entry.name != fh.DB_VERSION_FILE:
+            entry.unlink(missing_ok=True)
+    return info
+
+
+def get_files_path(db_id: str) -> Path:
+    """
+    Returns the folder holding the files of the current version of a database, see file_helper.get_db_files_path
+    """
+    return fh.get_db_files_path(db_id)
+
+
+def exact_index(files: Path, index: faiss_lib.Index) -> faiss_lib.Index:
+    """
+    Return a flat index holding the exact vectors of a database, which vectors can be added to and removed from
+    :param files: The folder of the files of the database, see get_files_path
+    :param index: The loaded faiss index of the database
+    """
+    path = files / VECTORS_FILE
+    if path.exists():  # The index is compressed
+        return ih.build_index(np.load(path), "flat", index.metric_type)
+    return ih.convert_index(index, "flat")
+
+
+def get_index_info(db_id: str, files: Optional[Path] = None) -> Dict:
+    """
+    Return the type and the parameters of the faiss index of a database, saved with its files or, for the databases
+    saved before, recorded in the faiss catalog
+    :param db_id: The id of the database
+    :param files: [Optional] The folder of the files of the database, see get_files_path
+    """
+    if files is not None and (files / INDEX_INFO_FILE).exists():
+        return fh.open_pkl_file_rb(files / INDEX_INFO_FILE)
+    return fh.open_pkl_file_rb(fh.get_faiss_catalog_path()).get(db_id, {}).get("index", {"type": "flat"})
+
+
+def read_index(db_id: str, files: Path, mmap: bool = False) -> Tuple[faiss_lib.Index, bool]:
+    """
+    Read the faiss index of a database
+    :param db_id: The id of the database
+    :param files: The folder of the files of the database, see get_files_path
+    :param mmap: Whether the index is memory mapped read-only instead of read
+    :return: The index, and whether it is memory mapped in a tuple
+    """
+    path = files / INDEX_FILE
+    if mmap:
+        try:
+            return faiss_lib.read_index(str(path), MMAP_FLAGS[get_index_info(db_id, files)["type"]]), True
+        except RuntimeError as e:
+            print(colored(f"The index of database {db_id} can't be memory mapped, it is read in memory: {e}", "yellow"))
+    return faiss_lib.read_index(str(path)), False
+
+
+def read_docstore(files: Path, in_memory: bool = False) -> Tuple[Docstore, Mapping[int, str]]:
+    """
+    Read the docstore of a database
+    :param files: The folder of the files of the database, see get_files_path
+    :param in_memory: Whether every chunk is read, to modify the vector store, instead of the SQLite docstore being
+    read when the chunks are searched
+    :return: The docstore, and the docstore id of every position of the faiss index in a tuple
+    """
+    if (files / DOCSTORE_FILE).exists():
+        docstore = SQLiteDocstore(files / DOCSTORE_FILE)
+        if not in_memory:
+            return docstore, docstore.index_map()
+        try:
+            return docstore.to_memory()
+        finally:
+            docstore.close()
+    with open(files / PICKLED_DOCSTORE_FILE, "rb") as f:  # Databases saved before the SQLite docstore
+        return pickle.load(f)
+
+
+def load_vector_store(db_id: str, embeddings: Embeddings) -> FAISS:
+    """
+    Load the faiss vector store of a database with an exact index and an in memory docstore, to modify it
+    :param db_id: The id of the database
+    :param embeddings: The embeddings of the database
+    """
+    files = get_files_path(db_id)
+    index, _ = read_index(db_id, files)
+    docstore, index_to_docstore_id = read_docstore(files, in_memory=True)
+    return FAISS(embeddings, exact_index(files, index), docstore, index_to_docstore_id)
+
+
+def load_identifiers(db_id: str, faiss: FAISS, files: Optional[Path] = None) -> IdentifierIndex:
+    """
+    Load the index of the chunks of a database by identifier
+    :param db_id: The id of the database
+    :param faiss: The faiss vector store of the database, to build the index of the databases saved without it
+    :param files: [Optional] The folder of the files of the database, its current version if not given
+    """
+    path = (files or get_files_path(db_id)) / IDENTIFIERS_FILE
+    return IdentifierIndex.load(path) if path.exists() else IdentifierIndex.from_faiss(faiss)
+
+
+def load_database(db_id: str, embeddings: Embeddings, mmap: bool = False) -> Database:
+    """
+    Load a database and the indexes saved with it
+    :param db_id: The id of the database
+    :param embeddings: The embeddings used to query the database
+    :param mmap: Whether the faiss index and the arrays of the BM25 index are memory mapped read-only instead of read
+    """
+    files = get_files_path(db_id)  # Once, a new version may become current while the database is loaded
+    index, mapped = read_index(db_id, files, mmap)
+    docstore, index_to_docstore_id = read_docstore(files)
+    faiss = FAISS(embeddings, index, docstore, index_to_docstore_id)
+    bm25 = BM25Index.load(files, mmap)
+    identifiers = load_identifiers(db_id, faiss, files)
+    vectors = np.load(files / VECTORS_FILE, mmap_mode="r") if (files / VECTORS_FILE).exists() else None
+    return Database(db_id, faiss, bm25, identifiers, vectors, get_index_info(db_id, files).get("rerank", 0), mapped)
+
+
+if __name__ == '__main__':
+    raise Exception("This file isn't intended to be run directly")
@@ -0,0 +1,165 @@
+"""
+On-disk docstore of a database: a SQLite file holding the chunks with their position in the faiss index, read lazily.
+A search only reads the content and the metadata of its hits, instead of unpickling every chunk when the database is
+loaded. The metadata are stored compactly: the Polarion url of a chunk is rebuilt from its project and workitem id.
+"""
+import json
+import re
+import sqlite3
+import threading
+from collections import Counter
+from pathlib import Path
+from typing import Dict, Iterator, List, Mapping, Tuple, Union
+
+from langchain_community.docstore.base import Docstore
+from langchain_community.docstore.in_memory import InMemoryDocstore
+from langchain_core.documents import Document
+
+DOCSTORE_FILE = "docstore.sqlite"
+_url_pattern = re.compile(r"^(?P<base>.*)/#/project/(?P<project>[^/?#]+)/workitem\?id=(?P<workitem>[^&#]+)$")
+
+
+def make_url(base_url: str, project: str, workitem: str) -> str:
+    return f"{base_url}/#/project/{project}/workitem?id={workitem}"
+
+
+def write_docstore(path: Path, docstore: Docstore, index_to_docstore_id: Dict[int, str]):
+    """
+    Write the chunks of a vector store in a new SQLite docstore
+    :param path: The path of the SQLite file, replaced if it exists
+    :param docstore: The docstore of the vector store
+    :param index_to_docstore_id: The docstore id of every position of the faiss index
+    """
+    documents = [(position, doc_id, docstore.search(doc_id)) for position, doc_id in index_to_docstore_id.items()]
+    bases = Counter(match.group("base") for match in (
+        _url_pattern.match(doc.metadata.get("url") or "") for _, _, doc in documents) if match)
+    base_url = bases.most_common(1)[0][0] if bases else ""
+    projects: Dict[str, int] = {}
+    rows = []
+    for position, doc_id, doc in documents:
+        metadata = dict(doc.metadata)
+        puid = metadata.pop("ibafullpuid", None)
+        url = metadata.pop("url", None)
+        project = workitem = None
+        match = _url_pattern.match(url or "")
+        if match and match.group("base") == base_url:  # Rebuilt from the project and the workitem id
+            project = projects.setdefault(match.group("project"), len(projects))
+            workitem = match.group("workitem")
+            url = None
+        extra = json.dumps(metadata) if metadata else None
+        rows.append((position, doc_id, puid, project, workitem, url, extra, doc.page_content))
+
+    path.unlink(missing_ok=True)
+    db = sqlite3.connect(str(path))
+    try:
+        db.executescript("""
+            CREATE TABLE meta (key TEXT PRIMARY KEY, value TEXT);
+            CREATE TABLE projects (id INTEGER PRIMARY KEY, name TEXT NOT NULL);
+            CREATE TABLE chunks (
+                position INTEGER PRIMARY KEY, id TEXT NOT NULL UNIQUE, puid TEXT, project INTEGER, workitem TEXT,
+                url TEXT, extra TEXT, content TEXT NOT NULL
+            );
+            CREATE INDEX chunks_puid ON chunks (puid);
+        """)
+        db.execute("INSERT INTO meta VALUES ('base_url', ?)", (base_url,))
+        db.executemany("INSERT INTO projects VALUES (?, ?)", [(i, name) for name, i in projects.items()])
+        db.executemany("INSERT INTO chunks VALUES (?, ?, ?, ?, ?, ?, ?, ?)", rows)
+        db.commit()
+    finally:
+        db.close()
+
+
+class SQLiteDocstore(Docstore):
+    """
+    Read-only docstore reading the chunks from a SQLite docstore when they are searched, thread-safe
+    :param path: The path of the SQLite file
+    """
+
+    def __init__(self, path: Path):
+        self.path = path
+        self._db = sqlite3.connect(f"{path.absolute().as_uri()}?mode=ro", uri=True, check_same_thread=False)
+        self._lock = threading.Lock()
+        self.base_url = self._db.execute("SELECT value FROM meta WHERE key = 'base_url'").fetchone()[0]
+        self.projects = dict(self._db.execute("SELECT id, name FROM projects"))
+
+    def _document(self, row: tuple) -> Document:
+        doc_id, puid, project, workitem, url, extra, content = row
+        metadata = json.loads(extra) if extra else {}
+        if puid is not None:
+            metadata["ibafullpuid"] = puid
+        if project is not None:
+            url = make_url(self.base_url, self.projects[project], workitem)
+        if url is not None:
+            metadata["url"] = url
+        return Document(id=doc_id, page_content=content, metadata=metadata)
+
+    def _query(self, sql: str, parameters: tuple = ()) -> List[tuple]:
+        with self._lock:
+            return self._db.execute(sql, parameters).fetchall()
+
+    def search(self, search: str) -> Union[str, Document]:
+        """
+        Return the chunk of a docstore id, or an error message as InMemoryDocstore does
+        """
+        rows = self._query("SELECT id, puid, project, workitem, url, extra, content FROM chunks WHERE id = ?", (search,))
+        return self._document(rows[0]) if rows else f"ID {search} not found."
+
+    def position(self, doc_id: str) -> int:
+        """
+        Return the position of a chunk in the faiss index
+        """
+        rows = self._query("SELECT position FROM chunks WHERE id = ?", (doc_id,))
+        if not rows:
+            raise KeyError(doc_id)
+        return rows[0][0]
+
+    def index_map(self) -> "SQLiteIndexMap":
+        return SQLiteIndexMap(self)
+
+    def to_memory(self) -> Tuple[InMemoryDocstore, Dict[int, str]]:
+        """
+        Read every chunk, to modify the vector store
+        :return: An in memory docstore and the docstore id of every position of the faiss index in a tuple
+        """
+        rows = self._query("SELECT position, id, puid, project, workitem, url, extra, content FROM chunks "
+                           "ORDER BY position")
+        documents = {row[1]: self._document(row[1:]) for row in rows}
+        return InMemoryDocstore(documents), {row[0]: row[1] for row in rows}
+
+    def __len__(self) -> int:
+        return self._query("SELECT COUNT(*) FROM chunks")[0][0]
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+
+class SQLiteIndexMap(Mapping):
+    """
+    Read-only mapping from the positions of the faiss index to the docstore ids, read from a SQLite docstore
+    """
+
+    def __init__(self, docstore: SQLiteDocstore):
+        self.docstore = docstore
+
+    def __getitem__(self, position: int) -> str:
+        rows = self.docstore._query("SELECT id FROM chunks WHERE position = ?", (int(position),))
+        if not rows:
+            raise KeyError(position)
+        return rows[0][0]
+
+    def __iter__(self) -> Iterator[int]:
+        return iter(row[0] for row in self.docstore._query("SELECT position FROM chunks ORDER BY position"))
+
+    def __len__(self) -> int:
+        return len(self.docstore)
+
+    def items(self) -> List[Tuple[int, str]]:
+        return self.docstore._query("SELECT position, id FROM chunks ORDER BY position")
+
+    def values(self) -> List[str]:
+        return [doc_id for _, doc_id in self.items()]
+
+
+if __name__ == '__main__':
+    raise Exception("This file isn't intended to be run directly")
@@ -0,0 +1,182 @@
+"""
+Process-wide cache of the FAISS databases loaded by the Copilot.
+Loading a database reads (or memory maps) the index from disk and opens its docstore (or unpickles the whole docstore of
+the former databases), so it is only done once per database and kept in memory until the budget is exceeded or the
+catalog says it changed. Every Copilot worker has its own cache, they all reload a database when its version counter in
+the catalog is incremented by an update.
+"""
+import os
+import threading
+from collections import OrderedDict
+from pathlib import Path
+from typing import Any, Callable, Dict, Iterable, Optional
+
+from termcolor import colored
+
+import file_helper as fh
+from bm25_helper import BM25Index
+from database_helper import INDEX_FILE, VECTORS_FILE, Database
+from docstore_helper import DOCSTORE_FILE
+
+
+def get_db_size(db_id: str, mapped: bool = False) -> int:
+    """
+    Estimate the private memory needed by a loaded database from the size of its files on disk. The files read lazily,
+    the SQLite docstore, the exact vectors of a compressed index, and the index and the BM25 arrays if they are mapped,
+    are in the shared page cache.
+    :param db_id: The id of the database
+    :param mapped: Whether the faiss index and the BM25 arrays are memory mapped
+    :return: The size in bytes
+    """
+    db_path = fh.get_faiss_db_path() / db_id
+    if db_path.is_file():
+        return db_path.stat().st_size
+    db_path = fh.get_db_files_path(db_id)  # Not the former versions still being deleted
+    skipped = {DOCSTORE_FILE, VECTORS_FILE}
+    if mapped:
+        skipped |= {INDEX_FILE} | {file.name for file in BM25Index.files(db_path)}
+    return sum(file.stat().st_size for file in db_path.rglob("*") if file.is_file() and file.name not in skipped)
+
+
+class FaissCache:
+    """
+    Thread-safe LRU cache of loaded FAISS databases, keyed by database id.
+    An entry is reloaded when the version of its database changes in the faiss catalog.
+    :param loader: A function loading a database from its id
+    :param max_size_mb: The memory budget of the cache in megabytes, the least recently used databases are evicted first
+    """
+
+    def __init__(self, loader: Callable[[str], Database], max_size_mb: int = 4096):
+        self.loader = loader
+        self.max_size = max_size_mb * 1024 * 1024
+        self._entries: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+        self._lock = threading.RLock()
+        self._load_locks: Dict[str, threading.Lock] = {}
+        self._catalog: dict = {}
+        self._catalog_mtime: Optional[float] = None
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @property
+    def size(self) -> int:
+        """
+        The estimated memory used by the cached databases in bytes
+        """
+        with self._lock:
+            return sum(entry["size"] for entry in self._entries.values())
+
+    def get_version(self, db_id: str):
+        """
+        Return the version of a database, the counter incremented by every save or the 'last_update' of the databases
+        saved before it. The faiss catalog is only read again when it changed on disk.
+        :param db_id: The id of the database
+        """
+        catalog_path: Path = fh.get_faiss_catalog_path()
+        mtime = catalog_path.stat().st_mtime
+        with self._lock:
+            if mtime != self._catalog_mtime:
+                self._catalog = fh.open_pkl_file_rb(catalog_path)
+                self._catalog_mtime = mtime
+            infos = self._catalog.get(db_id)
+        return infos.get("version", infos["last_update"]) if infos else None
+
+    def get(self, db_id: str) -> Database:
+        """
+        Return the database, loading it if it isn't cached or if it is outdated
+        :param db_id: The id of the database
+        :return: The loaded database
+        """
+        version = self.get_version(db_id)
+        with self._lock:
+            entry = self._entries.get(db_id)
+            if entry is not None and entry["version"] == version:
+                self._entries.move_to_end(db_id)
+                self.hits += 1
+                return entry["db"]
+            load_lock = self._load_locks.setdefault(db_id, threading.Lock())
+
+        with load_lock:  # Only one thread loads a given database, the others wait for it
+            with self._lock:
+                entry = self._entries.get(db_id)
+                if entry is not None and entry["version"] == version:
+                    self._entries.move_to_end(db_id)
+                    self.hits += 1
+                    return entry["db"]
+                self.misses += 1
+            db = self.loader(db_id)
+            with self._lock:
+                self._entries[db_id] = {"db": db, "version": version, "size": get_db_size(db_id, db.mapped)}
+                self._entries.move_to_end(db_id)
+                self._evict(keep=db_id)
+        return db
+
+    def _evict(self, keep: str):
+        """
+        Evict the least recently used databases until the cache fits in its budget
+        :param keep: The id of a database that must not be evicted
+        """
+        while self.size > self.max_size and len(self._entries) > 1:
+            oldest = next(iter(self._entries))
+            if oldest == keep:
+                self._entries.move_to_end(oldest)
+                oldest = next(iter(self._entries))
+            del self._entries[oldest]
+            self.evictions += 1
+
+    def invalidate(self, db_id: Optional[str] = None):
+        """
+        Remove a database from the cache, or all of them if no id is given
+        :param db_id: The id of the database
+        """
+        with self._lock:
+            if db_id is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(db_id, None)
+
+    def preload(self, db_ids: Iterable[str]) -> threading.Thread:
+        """
+        Load databases in a background thread so that the first questions don't pay the loading time
+        :param db_ids: The ids of the databases to load
+        :return: The started thread
+        """
+        db_ids = list(db_ids)
+
+        def _preload():
+            for db_id in db_ids:
+                try:
+                    self.get(db_id)
+                except Exception as e:
+                    print(colored(f"Preloading of database {db_id} failed: {e}", "yellow"))
+            print(colored(f"{len(self._entries)} database(s) preloaded.", "green"))
+
+        thread = threading.Thread(target=_preload, daemon=True)
+        thread.start()
+        return thread
+
+    def stats(self) -> dict:
+        """
+        Return the counters of the cache
+        """
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "size_mb": round(self.size / (1024 * 1024), 1),
+                "max_size_mb": round(self.max_size / (1024 * 1024), 1),
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+            }
+
+
+def cache_from_env(loader: Callable[[str], Database]) -> FaissCache:
+    """
+    Create the cache with the settings of the .env file:
+    faiss_cache_size_mb (default 4096)
+    """
+    return FaissCache(loader, max_size_mb=int(os.environ.get("faiss_cache_size_mb", 4096)))
+
+
+if __name__ == '__main__':
+    raise Exception("This file isn't intended to be run directly")
@@ -2,7 +2,7 @@ import os
 import pickle
 from datetime import datetime
 from pathlib import Path
-from typing import List, Union
+from typing import List, Optional, Union
 
 import pandas as pd
 from termcolor import colored
@@ -14,6 +14,8 @@ _catalog_path = current_path.parent.parent / "catalog"
 _cache_path = current_path.parent.parent / ".cache"
 _cache_catalog_path = current_path.parent.parent / "catalog" / ".cache.pkl"
 _faiss_catalog_path = current_path.parent.parent / "catalog" / ".faiss_db.pkl"
+_retrieval_cache_path = current_path.parent.parent / "catalog" / ".retrieval_cache.sqlite"
+DB_VERSION_FILE = "current"  # Names the folder of the current version of a database, in the database folder
 
 
 def get_faiss_catalog_path() -> Path:
@@ -32,7 +34,6 @@ def get_faiss_catalog_path() -> Path:
         raise Exception(f"Error : {e}")
 
 
-
 def get_cache_catalog_path() -> Path:
     """
     Returns /catalog/.cache.pkl absolute path
@@ -49,6 +50,17 @@ def get_cache_catalog_path() -> Path:
         raise Exception(f"Error : {e}")
 
 
+def get_retrieval_cache_path() -> Path:
+    """
+    Returns /catalog/.retrieval_cache.sqlite absolute path
+    """
+    try:
+        get_catalog_path()
+        return Path(_retrieval_cache_path).absolute()
+    except Exception as e:
+        raise Exception(f"Error : {e}")
+
+
 def get_catalog_path() -> Path:
     """
     Returns /catalog/ absolute path
@@ -75,6 +87,33 @@ def get_faiss_db_path() -> Path:
         raise Exception(f"Error : {e}")
 
 
+def get_db_files_path(db_id: str) -> Path:
+    """
+    Returns the folder holding the files of the current version of a database, the database folder itself for the
+    databases saved before the versions
+    """
+    db_path = get_faiss_db_path() / db_id
+    try:
+        return db_path / (db_path / DB_VERSION_FILE).read_text().strip()
+    except FileNotFoundError:
+        return db_path
+
+
+def set_db_version(db_id: str, version: str):
+    """
+    Make a version folder of a database its current version, atomically: a reader sees the former or the new version
+    :param version: The name of the version folder, in the database folder
+    """
+    db_path = get_faiss_db_path() / db_id
+    staging = db_path / f"{DB_VERSION_FILE}.tmp{os.getpid()}"
+    try:
+        staging.write_text(version)
+        os.replace(staging, db_path / DB_VERSION_FILE)
+    except BaseException:
+        staging.unlink(missing_ok=True)
+        raise
+
+
 def get_cache_path() -> Path:
     """
     Returns /.cache/ absolute path
@@ -118,7 +157,8 @@ def faiss_catalog_filled():
         raise Exception(f"Error while checking update file: {e}")
 
 
-def db_to_faiss_catalog(db_id: str, pr_name: str, release: str, pr_type: str, wi_type: List[str], update_date: datetime):
+def db_to_faiss_catalog(db_id: str, pr_name: str, release: str, pr_type: str, wi_type: List[str], update_date: datetime,
+                        index: Optional[dict] = None):
     """
     Add a database to the faiss catalog.
 
@@ -128,21 +168,24 @@ def db_to_faiss_catalog(db_id: str, pr_name: str, release: str, pr_type: str, wi
     :param pr_type: The type of the database (project or group)
     :param wi_type: The type of workitems in the database
     :param update_date: The date of the last update
+    :param index: [Optional] The type and the parameters of the faiss index, a flat index by default
     """
     abs_update_path = get_faiss_catalog_path()
     with open(abs_update_path, 'rb') as f:
         infos = pickle.load(f)
 
+    version = infos.get(db_id, {}).get("version", 0) + 1
     infos[db_id] = {
             "location": pr_name,
             "release": release if release else "All releases",
             "type": pr_type,
             "workitem_type": wi_type,
-            "last_update": update_date
+            "last_update": update_date,
+            "index": index or {"type": "flat"},
+            "version": version
         }
 
-    with open(abs_update_path, 'wb') as f:
-        pickle.dump(infos, f)
+    write_pkl_file(abs_update_path, infos)
 
     print(f"Database {colored(db_id, 'green')} updated : {colored(update_date, 'green')}.")
 
@@ -162,6 +205,20 @@ def delete_from_cache_file(db_id: str):
         pickle.dump(infos, f)
 
 
+def write_pkl_file(path: Path, data):
+    """
+    Replace the pkl file atomically, so that the Copilot workers reading it never see a partly written file
+    """
+    staging = path.with_name(f"{path.name}.tmp{os.getpid()}")
+    try:
+        with open(staging, 'wb') as f:
+            pickle.dump(data, f)
+        os.replace(staging, path)
+    except BaseException:
+        staging.unlink(missing_ok=True)
+        raise
+
+
 def open_pkl_file_rb(path: Path):
     """
     Open the pkl file in read binary mode
@@ -197,8 +254,7 @@ def delete_uncatalogued_db():
         for db in catalog_copy.keys():
             if db not in dbs:
                 del catalog[db]
-        with open(get_faiss_catalog_path(), 'wb') as f:
-            pickle.dump(catalog, f)
+        write_pkl_file(get_faiss_catalog_path(), catalog)
     except Exception as e:
         raise Exception(f"Error while deleting databases: {e}")
 
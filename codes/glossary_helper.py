@@ -0,0 +1,127 @@
+"""
+Abbreviation matcher built on the glossary file.
+The glossary is parsed once into an Aho-Corasick automaton so that only the abbreviations found in a text
+are given to the model, instead of the whole glossary. The automaton is rebuilt when the file changes.
+"""
+import threading
+from collections import deque
+from pathlib import Path
+from typing import Dict, List, Union
+
+import file_helper as fh
+
+
+class AhoCorasick:
+    """
+    Multi-pattern matcher finding every occurrence of a set of words in a single pass over a text
+    :param patterns: The words to find
+    """
+
+    def __init__(self, patterns: List[str]):
+        self.goto: List[Dict[str, int]] = [{}]
+        self.fail: List[int] = [0]
+        self.output: List[List[str]] = [[]]
+        for pattern in patterns:
+            self._add(pattern)
+        self._build()
+
+    def _add(self, pattern: str):
+        state = 0
+        for char in pattern:
+            if char not in self.goto[state]:
+                self.goto.append({})
+                self.fail.append(0)
+                self.output.append([])
+                self.goto[state][char] = len(self.goto) - 1
+            state = self.goto[state][char]
+        self.output[state].append(pattern)
+
+    def _build(self):
+        queue = deque(self.goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for char, next_state in self.goto[state].items():
+                queue.append(next_state)
+                fallback = self.fail[state]
+                while fallback and char not in self.goto[fallback]:
+                    fallback = self.fail[fallback]
+                self.fail[next_state] = self.goto[fallback].get(char, 0)
+                self.output[next_state] = self.output[next_state] + self.output[self.fail[next_state]]
+
+    def find_words(self, text: str) -> List[str]:
+        """
+        Return the patterns found in the text as whole words, in order of first appearance
+        :param text: The text to search in
+        """
+        found = {}
+        state = 0
+        for i, char in enumerate(text):
+            while state and char not in self.goto[state]:
+                state = self.fail[state]
+            state = self.goto[state].get(char, 0)
+            for pattern in self.output[state]:
+                start = i - len(pattern) + 1
+                before = text[start - 1] if start > 0 else " "
+                after = text[i + 1] if i + 1 < len(text) else " "
+                if not before.isalnum() and not after.isalnum():
+                    found.setdefault(pattern, None)
+        return list(found)
+
+
+class GlossaryMatcher:
+    """
+    Give the definitions of the glossary abbreviations present in a text.
+    The glossary file is read again only when its modification time changes.
+    :param path: The path to the glossary file ('definition;ABBREVIATION' rows)
+    """
+
+    def __init__(self, path: Union[str, Path]):
+        self.path = Path(path)
+        self._mtime = None
+        self._definitions: Dict[str, List[str]] = {}
+        self._automaton = AhoCorasick([])
+        self._lock = threading.Lock()
+
+    def _reload_if_changed(self):
+        mtime = self.path.stat().st_mtime
+        if mtime == self._mtime:
+            return
+        with self._lock:
+            if mtime == self._mtime:
+                return
+            definitions: Dict[str, List[str]] = {}
+            for definition, abbreviation in fh.get_glossary(self.path).items():
+                if not isinstance(definition, str) or not isinstance(abbreviation, str):
+                    continue
+                definition, abbreviation = definition.strip().lstrip("\ufeff"), abbreviation.strip()
+                if len(abbreviation) > 1 and definition:  # Single letters would match every capitalised 'A'
+                    definitions.setdefault(abbreviation, []).append(definition)
+            self._automaton = AhoCorasick(list(definitions))
+            self._definitions = definitions
+            self._mtime = mtime
+
+    def match(self, *texts: str) -> Dict[str, List[str]]:
+        """
+        Return the abbreviations found in the texts with their definitions
+        :param texts: The texts to search in (question, retrieved context...)
+        """
+        self._reload_if_changed()
+        automaton, definitions = self._automaton, self._definitions
+        matches = {}
+        for text in texts:
+            for abbreviation in automaton.find_words(text or ""):
+                matches.setdefault(abbreviation, definitions[abbreviation])
+        return matches
+
+    def format(self, *texts: str) -> str:
+        """
+        Return the abbreviations found in the texts formatted for the prompt, or an empty string
+        :param texts: The texts to search in (question, retrieved context...)
+        """
+        return "; ".join(
+            f"{abbreviation}: {' / '.join(definitions)}" for abbreviation, definitions in self.match(*texts).items()
+        )
+
+
+if __name__ == '__main__':
+    raise Exception("This file isn't intended to be run directly")
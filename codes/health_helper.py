@@ -0,0 +1,249 @@
+"""
+Health of the upstream servers of the Copilot (embedding API and LLM API).
+Every upstream has a circuit breaker, opened by failed calls or by the background probes, so that the Copilot stops
+waiting for HTTP timeouts when a tunnel is down, and the latencies of the calls are kept to report their percentiles.
+"""
+import asyncio
+import os
+import threading
+import time
+from collections import deque
+from typing import Awaitable, Callable, Dict, Optional
+
+import httpx
+from termcolor import colored
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+
+class UpstreamUnavailable(Exception):
+    """
+    Raised when the circuit breaker of an upstream is open
+    """
+
+
+class CircuitBreaker:
+    """
+    Circuit breaker and latency window of an upstream
+    :param name: The name of the upstream
+    :param failure_threshold: The consecutive failed calls opening the circuit
+    :param reset_timeout: The time after which an open circuit lets one trial call through in seconds
+    :param timeout: The maximum duration of a call in seconds, None for no limit
+    :param window: The number of call latencies kept for the percentiles
+    """
+
+    def __init__(self, name: str, failure_threshold: int = 3, reset_timeout: float = 30.0,
+                 timeout: Optional[float] = None, window: int = 1000):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.timeout = timeout
+        self.state = CLOSED
+        self.consecutive_failures = 0
+        self.opened_at = 0.0
+        self.calls = 0
+        self.failures = 0
+        self.rejected = 0
+        self.probe_latency: Optional[float] = None
+        self.latencies = deque(maxlen=window)
+        self._lock = threading.Lock()
+
+    def _set_state(self, state: str):
+        if state != self.state:
+            print(colored(f"The {self.name} upstream is {'up' if state == CLOSED else 'down'}.",
+                          "green" if state == CLOSED else "yellow"))
+        self.state = state
+
+    def available(self) -> bool:
+        """
+        Tell whether the upstream is expected to answer, without using the trial call of an open circuit
+        """
+        return self.state == CLOSED or (self.state == OPEN and time.monotonic() - self.opened_at >= self.reset_timeout)
+
+    def allow(self) -> bool:
+        """
+        Tell whether a call may be sent to the upstream, an open circuit lets one trial through after the reset timeout
+        """
+        with self._lock:
+            if self.state == CLOSED:
+                return True
+            if self.state == OPEN and time.monotonic() - self.opened_at >= self.reset_timeout:
+                self.state = HALF_OPEN
+                return True
+            self.rejected += 1
+            return False
+
+    def record_success(self, latency: Optional[float] = None, probe: bool = False):
+        with self._lock:
+            if latency is not None:
+                if probe:
+                    self.probe_latency = latency
+                else:
+                    self.latencies.append(latency)
+            self.consecutive_failures = 0
+            self._set_state(CLOSED)
+
+    def record_failure(self, probe: bool = False):
+        """
+        Record a failed call. A failed probe opens the circuit at once, failed calls after failure_threshold of them.
+        """
+        with self._lock:
+            if not probe:
+                self.failures += 1
+            self.consecutive_failures += 1
+            if probe or self.state == HALF_OPEN or self.consecutive_failures >= self.failure_threshold:
+                self.opened_at = time.monotonic()
+                self._set_state(OPEN)
+
+    def release_trial(self):
+        """
+        Give back the trial call of an open circuit that ended without a result, the next call being the trial
+        """
+        with self._lock:
+            if self.state == HALF_OPEN:
+                self.state = OPEN
+
+    async def call(self, function: Callable[..., Awaitable], *args, **kwargs):
+        """
+        Call the upstream through the circuit breaker, with the call timeout
+        :raise UpstreamUnavailable: If the circuit is open
+        """
+        if not self.allow():
+            raise UpstreamUnavailable(f"The {self.name} server is unavailable")
+        trial = self.state == HALF_OPEN
+        self.calls += 1
+        start = time.perf_counter()
+        try:
+            result = await asyncio.wait_for(function(*args, **kwargs), timeout=self.timeout)
+        except Exception:
+            self.record_failure()
+            raise
+        except BaseException:  # Cancelled (the answer was stopped): the upstream didn't fail, nor answer
+            if trial:
+                self.release_trial()
+            raise
+        self.record_success(time.perf_counter() - start)
+        return result
+
+    def percentile(self, q: float) -> Optional[float]:
+        """
+        Return a percentile of the latencies of the recent calls in seconds
+        :param q: The percentile, between 0 and 100
+        """
+        latencies = sorted(self.latencies)
+        if not latencies:
+            return None
+        return latencies[min(len(latencies) - 1, int(round(q / 100 * (len(latencies) - 1))))]
+
+    def stats(self) -> dict:
+        def rounded(value):
+            return round(value, 4) if value is not None else None
+
+        return {
+            "state": self.state,
+            "calls": self.calls,
+            "failures": self.failures,
+            "rejected": self.rejected,
+            "p50_s": rounded(self.percentile(50)),
+            "p95_s": rounded(self.percentile(95)),
+            "p99_s": rounded(self.percentile(99)),
+            "probe_latency_s": rounded(self.probe_latency),
+        }
+
+
+class HealthMonitor:
+    """
+    Background probes of the upstreams, feeding their circuit breakers
+    :param interval: The time between two probes in seconds
+    """
+
+    def __init__(self, interval: float = 5.0):
+        self.interval = interval
+        self.breakers: Dict[str, CircuitBreaker] = {}
+        self._probes: Dict[str, Optional[Callable[[], bool]]] = {}
+        self._thread: Optional[threading.Thread] = None
+
+    def add(self, breaker: CircuitBreaker, probe: Optional[Callable[[], bool]] = None) -> CircuitBreaker:
+        """
+        Monitor an upstream
+        :param breaker: The circuit breaker of the upstream
+        :param probe: [Optional] A function returning whether the upstream is reachable, else only the calls count
+        """
+        self.breakers[breaker.name] = breaker
+        self._probes[breaker.name] = probe
+        return breaker
+
+    def probe(self):
+        """
+        Probe every upstream once
+        """
+        for name, probe in self._probes.items():
+            if probe is None:
+                continue
+            start = time.perf_counter()
+            try:
+                healthy = probe()
+            except Exception:
+                healthy = False
+            if healthy:
+                self.breakers[name].record_success(time.perf_counter() - start, probe=True)
+            else:
+                self.breakers[name].record_failure(probe=True)
+
+    def start(self) -> threading.Thread:
+        """
+        Probe the upstreams periodically in a background thread
+        """
+        def _probe():
+            while True:
+                self.probe()
+                time.sleep(self.interval)
+
+        if self._thread is None:
+            self._thread = threading.Thread(target=_probe, daemon=True)
+            self._thread.start()
+        return self._thread
+
+    def stats(self) -> dict:
+        return {name: breaker.stats() for name, breaker in self.breakers.items()}
+
+
+def http_probe(url: str, timeout: float = 3.0) -> Callable[[], bool]:
+    """
+    Return a probe considering an HTTP server reachable if it answers without a server error
+    :param url: The URL to request
+    :param timeout: The timeout of the request in seconds
+    """
+    def probe() -> bool:
+        try:
+            return httpx.get(url, timeout=timeout).status_code < 500
+        except httpx.HTTPError:
+            return False
+    return probe
+
+
+def monitor_from_env() -> HealthMonitor:
+    """
+    Create the health monitor with the settings of the .env file:
+    health_probe_interval (seconds, default 5)
+    """
+    return HealthMonitor(interval=float(os.environ.get("health_probe_interval", 5)))
+
+
+def breaker_from_env(name: str, timeout: Optional[float] = None) -> CircuitBreaker:
+    """
+    Create a circuit breaker with the settings of the .env file:
+    circuit_failure_threshold (default 3), circuit_reset_timeout (seconds, default 30)
+    """
+    return CircuitBreaker(
+        name,
+        failure_threshold=int(os.environ.get("circuit_failure_threshold", 3)),
+        reset_timeout=float(os.environ.get("circuit_reset_timeout", 30)),
+        timeout=timeout,
+    )
+
+
+if __name__ == '__main__':
+    raise Exception("This file isn't intended to be run directly")
@@ -0,0 +1,113 @@
+"""
+Hash index from the workitem identifiers (ibafullpuid and Polarion workitem id) to the docstore ids of their chunks.
+It gives the chunks of a workitem named in a question in constant time, where a similarity search often misses it, and
+the stored chunks of the updated workitems. It is saved with the database and maintained when chunks are added and
+deleted by an update.
+"""
+import pickle
+import re
+from pathlib import Path
+from typing import Dict, List, Optional, Union
+
+from langchain_community.vectorstores.faiss import FAISS
+
+_candidate_pattern = re.compile(r"\w[\w\-./]*\w|\w")
+_workitem_id_pattern = re.compile(r"[?&]id=([^&#]+)")
+
+
+def get_workitem_id(url: Optional[str]) -> Optional[str]:
+    """
+    Return the workitem id of a Polarion workitem url
+    """
+    match = _workitem_id_pattern.search(url or "")
+    return match.group(1) if match else None
+
+
+class IdentifierIndex:
+    """
+    Index of the chunks of a database by ibafullpuid and by workitem id, case-insensitive
+    """
+
+    def __init__(self):
+        self.puids: Dict[str, List[str]] = {}
+        self.workitem_ids: Dict[str, List[str]] = {}
+
+    def add(self, doc_id: str, metadata: dict):
+        """
+        Index a chunk
+        :param doc_id: The docstore id of the chunk
+        :param metadata: The metadata of the chunk
+        """
+        puid = metadata.get("ibafullpuid")
+        if puid:
+            self.puids.setdefault(str(puid).lower(), []).append(doc_id)
+        workitem_id = get_workitem_id(metadata.get("url"))
+        if workitem_id:
+            self.workitem_ids.setdefault(workitem_id.lower(), []).append(doc_id)
+
+    def remove(self, doc_id: str, metadata: dict):
+        """
+        Remove a deleted chunk from the index
+        :param doc_id: The docstore id of the chunk
+        :param metadata: The metadata of the chunk
+        """
+        for index, identifier in ((self.puids, metadata.get("ibafullpuid")),
+                                  (self.workitem_ids, get_workitem_id(metadata.get("url")))):
+            doc_ids = index.get(str(identifier).lower()) if identifier else None
+            if doc_ids and doc_id in doc_ids:
+                doc_ids.remove(doc_id)
+                if not doc_ids:
+                    del index[str(identifier).lower()]
+
+    def find(self, identifier: str) -> List[str]:
+        """
+        Return the docstore ids of the chunks of a workitem
+        :param identifier: An ibafullpuid or a workitem id
+        """
+        identifier = identifier.lower()
+        return self.puids.get(identifier) or self.workitem_ids.get(identifier) or []
+
+    def find_puid(self, puid: str) -> List[str]:
+        """
+        Return the docstore ids of the chunks of an ibafullpuid
+        """
+        return list(self.puids.get(puid.lower(), []))
+
+    def find_in_text(self, text: str) -> List[str]:
+        """
+        Return the docstore ids of the chunks of every workitem named in a text, in order of appearance
+        :param text: The text, for example a question
+        """
+        doc_ids = {}
+        for candidate in _candidate_pattern.findall(text):
+            for doc_id in self.find(candidate):
+                doc_ids.setdefault(doc_id, None)
+        return list(doc_ids)
+
+    @classmethod
+    def from_faiss(cls, faiss: FAISS) -> "IdentifierIndex":
+        """
+        Build the index of every chunk of a faiss database
+        """
+        index = cls()
+        for doc_id in faiss.index_to_docstore_id.values():
+            index.add(doc_id, faiss.docstore.search(doc_id).metadata)
+        return index
+
+    def save(self, path: Union[str, Path]):
+        """
+        Save the index as plain python structures, so that it doesn't depend on the module path
+        """
+        with open(path, "wb") as f:
+            pickle.dump(vars(self), f)
+
+    @classmethod
+    def load(cls, path: Union[str, Path]) -> "IdentifierIndex":
+        index = cls()
+        with open(path, "rb") as f:
+            vars(index).update(pickle.load(f))
+        return index
+
+
+if __name__ == '__main__':
+    raise Exception("This file isn't intended to be run directly")
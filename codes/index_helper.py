@@ -0,0 +1,321 @@
+"""
+Types of the faiss index of a database: exact (flat), inverted lists (IVF) or graph (HNSW), storing the vectors as they
+are or compressed (float16, 8 bits scalar quantization, product quantization, or a PCA reduction).
+The vectors are always added to a flat index by LangChain, then rebuilt into the chosen index in the same order before
+the database is saved, so the positions of the docstore stay valid. A compressed index can re-rank a few candidates
+with the exact vectors, kept on disk next to it. The benchmark measures the recall@k of an index against an exact search
+of the same vectors, with its query latency.
+"""
+import math
+import time
+from typing import Dict, List, Optional, Tuple
+
+import faiss
+import numpy as np
+
+INDEX_TYPES = ("flat", "ivf", "hnsw")
+COMPRESSIONS = ("none", "fp16", "sq8", "pq", "pca")
+IVF_MIN_POINTS_PER_LIST = 39  # Below this, faiss warns that the training of the centroids is unreliable
+MAX_TRAINING_POINTS_PER_CENTROID = 256  # Faiss samples the training set down to this
+HNSW_M = 32
+HNSW_EF_CONSTRUCTION = 200
+HNSW_EF_SEARCH = 64
+PQ_BYTES_RATIO = 16  # A product quantization code is 16 times smaller than the float32 vector
+PCA_REDUCTION = 4  # A PCA reduction keeps a quarter of the dimensions
+
+
+def check_index_type(index_type: str) -> str:
+    index_type = (index_type or "flat").lower()
+    if index_type not in INDEX_TYPES:
+        raise ValueError(f"Unknown index type '{index_type}', choose one of {', '.join(INDEX_TYPES)}")
+    return index_type
+
+
+def check_compression(compression: str) -> str:
+    compression = (compression or "none").lower()
+    if compression not in COMPRESSIONS:
+        raise ValueError(f"Unknown compression '{compression}', choose one of {', '.join(COMPRESSIONS)}")
+    return compression
+
+
+def ivf_lists(count: int) -> int:
+    """
+    Return the number of inverted lists of an IVF index of count vectors, 0 if there are too few vectors to train it
+    """
+    nlist = min(int(4 * math.sqrt(count)), count // IVF_MIN_POINTS_PER_LIST)
+    return nlist if nlist >= 2 else 0
+
+
+def pq_code(count: int, dimension: int) -> Optional[Tuple[int, int]]:
+    """
+    Return the sub-quantizers and the bits per sub-quantizer of a product quantization of count vectors,
+    None if there are too few vectors to train it
+    """
+    nbits = min(8, int(math.log2(max(count // IVF_MIN_POINTS_PER_LIST, 1))))
+    if nbits < 4:
+        return None
+    target = max(1, dimension * 4 // PQ_BYTES_RATIO * 8 // nbits)  # The number of sub-quantizers giving the ratio
+    m = max(m for m in range(1, min(target, dimension) + 1) if dimension % m == 0)
+    return m, nbits
+
+
+def index_factory_string(count: int, dimension: int, index_type: str, compression: str) -> str:
+    """
+    Return the faiss index factory string of an index type and a compression, degraded to what count vectors can train
+    """
+    prefix = ""
+    codec = {"fp16": "SQfp16", "sq8": "SQ8"}.get(compression, "Flat")
+    if compression == "pca" and count >= dimension:
+        dimension //= PCA_REDUCTION
+        prefix = f"PCA{dimension},"
+    elif compression == "pq":
+        code = pq_code(count, dimension)
+        codec = f"PQ{code[0]}x{code[1]}" if code else "SQ8"
+    nlist = ivf_lists(count)
+    if index_type == "ivf" and nlist:
+        return f"{prefix}IVF{nlist},{codec}"
+    if index_type == "hnsw":
+        return f"{prefix}HNSW{HNSW_M}_{codec}" if codec.startswith("PQ") else f"{prefix}HNSW{HNSW_M},{codec}"
+    return f"{prefix}{codec}"  # Flat, or IVF with too few vectors to train the centroids
+
+
+def get_hnsw(index: faiss.Index) -> Optional[faiss.IndexHNSW]:
+    """
+    Return the HNSW index of an index, behind its PCA reduction if any
+    """
+    if isinstance(index, faiss.IndexPreTransform):
+        index = faiss.downcast_index(index.index)
+    return index if isinstance(index, faiss.IndexHNSW) else None
+
+
+def build_index(vectors: np.ndarray, index_type: str = "flat", metric: int = faiss.METRIC_L2,
+                compression: str = "none") -> faiss.Index:
+    """
+    Build an index of the given type holding the vectors, in their order
+    :param vectors: The vectors as a float32 matrix
+    :param index_type: "flat", "ivf" or "hnsw"
+    :param metric: The faiss metric of the vector store
+    :param compression: "none", "fp16", "sq8", "pq" or "pca"
+    """
+    index_type = check_index_type(index_type)
+    vectors = np.ascontiguousarray(vectors, dtype=np.float32)
+    count, dimension = vectors.shape
+    index = faiss.index_factory(dimension, index_factory_string(count, dimension, index_type,
+                                                                check_compression(compression)), metric)
+    hnsw = get_hnsw(index)
+    if hnsw is not None:
+        hnsw.hnsw.efConstruction = HNSW_EF_CONSTRUCTION
+        hnsw.hnsw.efSearch = HNSW_EF_SEARCH
+    if not index.is_trained:
+        training = vectors
+        ivf = faiss.try_extract_index_ivf(index)
+        max_points = max(ivf.nlist if ivf is not None else 0, 256) * MAX_TRAINING_POINTS_PER_CENTROID
+        if count > max_points:
+            sample = np.random.default_rng(0).choice(count, max_points, replace=False)
+            training = vectors[np.sort(sample)]
+        index.train(training)
+        if ivf is not None:
+            ivf.nprobe = min(ivf.nlist, max(8, ivf.nlist // 32))
+    if count:
+        index.add(vectors)
+    return index
+
+
+def reconstruct_vectors(index: faiss.Index) -> np.ndarray:
+    """
+    Return the vectors of an index, in their order, decompressed if the index is compressed
+    """
+    ivf = faiss.try_extract_index_ivf(index)
+    if ivf is not None:
+        ivf.make_direct_map()
+    return index.reconstruct_n(0, index.ntotal)
+
+
+def convert_index(index: faiss.Index, index_type: str, compression: str = "none",
+                  vectors: Optional[np.ndarray] = None) -> faiss.Index:
+    """
+    Return the index rebuilt into the given type, or the index itself if it is already a flat index
+    :param index: The index
+    :param index_type: The type of the new index
+    :param compression: The compression of the new index
+    :param vectors: [Optional] The exact vectors of the index, read from the index by default
+    """
+    index_type = check_index_type(index_type)
+    compression = check_compression(compression)
+    if vectors is None and index_type == "flat" and compression == "none" and describe_index(index) == {
+            "type": "flat", "compression": "none"}:
+        return index
+    return build_index(reconstruct_vectors(index) if vectors is None else vectors, index_type, index.metric_type,
+                       compression)
+
+
+def describe_index(index: faiss.Index) -> Dict:
+    """
+    Return the type, the compression and the parameters of an index, as recorded in the faiss catalog
+    """
+    description = {"type": "flat", "compression": "none"}
+    if isinstance(index, faiss.IndexPreTransform):
+        description.update(compression="pca", pca_dimension=index.index.d)
+        index = faiss.downcast_index(index.index)
+    codes = index
+    ivf = faiss.try_extract_index_ivf(index)
+    hnsw = get_hnsw(index)
+    if ivf is not None:
+        description.update(type="ivf", nlist=ivf.nlist, nprobe=ivf.nprobe)
+    elif hnsw is not None:
+        description.update(type="hnsw", M=hnsw.hnsw.nb_neighbors(1), efConstruction=hnsw.hnsw.efConstruction,
+                           efSearch=hnsw.hnsw.efSearch)
+        codes = faiss.downcast_index(hnsw.storage)
+    if isinstance(codes, (faiss.IndexScalarQuantizer, faiss.IndexIVFScalarQuantizer)):
+        description["compression"] = "fp16" if codes.sq.qtype == faiss.ScalarQuantizer.QT_fp16 else "sq8"
+    elif isinstance(codes, (faiss.IndexPQ, faiss.IndexIVFPQ)):
+        description.update(compression="pq", pq=f"{codes.pq.M}x{codes.pq.nbits}")
+    return description
+
+
+def index_bytes(index: faiss.Index) -> int:
+    """
+    Return the memory taken by an index, the size of its serialization
+    """
+    return faiss.serialize_index(index).nbytes
+
+
+def set_search_parameter(index: faiss.Index, value: Optional[int]):
+    """
+    Set the speed/recall trade-off of an index: nprobe of an IVF index, efSearch of an HNSW index
+    """
+    ivf = faiss.try_extract_index_ivf(index)
+    hnsw = get_hnsw(index)
+    if value is None:
+        return
+    if ivf is not None:
+        ivf.nprobe = value
+    elif hnsw is not None:
+        hnsw.hnsw.efSearch = value
+
+
+def search_parameter_values(index: faiss.Index) -> List[Optional[int]]:
+    """
+    Return the values of the search parameter worth benchmarking, [None] for an exact index
+    """
+    description = describe_index(index)
+    if description["type"] == "ivf":
+        return sorted({n for n in (1, 4, 8, 16, 32, 64, 128, description["nprobe"]) if n <= description["nlist"]})
+    if description["type"] == "hnsw":
+        return sorted({16, 32, 64, 128, 256, description["efSearch"]})
+    return [None]
+
+
+def search(index: faiss.Index, queries: np.ndarray, k: int, vectors: Optional[np.ndarray] = None,
+           candidates: int = 0) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Search an index, re-ranking the candidates found with the exact vectors if they are given
+    :param index: The index
+    :param queries: The query vectors as a float32 matrix
+    :param k: The number of neighbours searched
+    :param vectors: [Optional] The exact vectors of the index, a memory map of their file
+    :param candidates: The number of candidates re-ranked, no re-ranking if it isn't above k
+    :return: The distances and the positions of the neighbours, as faiss returns them
+    """
+    if vectors is None or candidates <= k:
+        return index.search(queries, k)
+    _, positions = index.search(queries, candidates)
+    inner_product = index.metric_type == faiss.METRIC_INNER_PRODUCT
+    scores = np.full((len(queries), k), -np.inf if inner_product else np.inf, dtype=np.float32)
+    indices = np.full((len(queries), k), -1, dtype=np.int64)
+    for row, (query, found) in enumerate(zip(queries, positions)):
+        found = np.sort(found[found >= 0])  # Sorted positions read the memory map sequentially
+        exact = np.asarray(vectors[found], dtype=np.float32)
+        distances = exact @ query if inner_product else ((exact - query) ** 2).sum(axis=1)
+        order = np.argsort(-distances if inner_product else distances, kind="stable")[:k]
+        scores[row, :len(order)] = distances[order]
+        indices[row, :len(order)] = found[order]
+    return scores, indices
+
+
+def perturbed_queries(vectors: np.ndarray, positions: np.ndarray, seed: int = 0) -> np.ndarray:
+    """
+    Return queries close to stored vectors but not stored themselves, so that a benchmark doesn't measure how an index
+    finds the query itself (always in its own IVF list): every vector is moved in a random direction by the distance
+    to its nearest stored neighbour
+    :param vectors: The stored vectors
+    :param positions: The positions of the vectors the queries are made from
+    :param seed: The seed of the random directions
+    """
+    stored = np.ascontiguousarray(vectors, dtype=np.float32)
+    queries = stored[positions]
+    exact = faiss.IndexFlatL2(stored.shape[1])
+    exact.add(stored)
+    distances, _ = exact.search(queries, 2)  # The vector itself, then its nearest neighbour
+    directions = np.random.default_rng(seed).standard_normal(queries.shape).astype(np.float32)
+    directions /= np.linalg.norm(directions, axis=1, keepdims=True)
+    return queries + directions * np.sqrt(np.maximum(distances[:, 1:2], 0))
+
+
+def benchmark_index(index: faiss.Index, queries: np.ndarray, k: int = 10, parameter: Optional[int] = None,
+                    vectors: Optional[np.ndarray] = None, candidates: int = 0,
+                    reference: Optional[faiss.Index] = None) -> Dict:
+    """
+    Measure the recall@k of an index against an exact search of its vectors, and its latency per query
+    :param index: The index
+    :param queries: The query vectors as a float32 matrix
+    :param k: The number of neighbours searched
+    :param parameter: [Optional] The nprobe or efSearch used, the saved one by default
+    :param vectors: [Optional] The exact vectors of the index, read from the index by default
+    :param candidates: The number of candidates re-ranked with the exact vectors, see search()
+    :param reference: [Optional] The index whose neighbours are the expected ones, instead of the exact search
+    """
+    queries = np.ascontiguousarray(queries, dtype=np.float32)
+    if reference is None:
+        reference = faiss.IndexFlat(queries.shape[1], index.metric_type)
+        reference.add(np.ascontiguousarray(reconstruct_vectors(index) if vectors is None else vectors,
+                                           dtype=np.float32))
+    _, truth = reference.search(queries, k)
+    saved = describe_index(index)
+    set_search_parameter(index, parameter)
+    latencies = []
+    found = 0
+    try:
+        for i in range(len(queries)):  # One query at a time, as the Copilot searches
+            start = time.perf_counter()
+            _, ids = search(index, queries[i:i + 1], k, vectors, candidates)
+            latencies.append(time.perf_counter() - start)
+            expected = {int(j) for j in truth[i] if j >= 0}
+            found += len(expected & {int(j) for j in ids[0] if j >= 0}) / (len(expected) or 1)
+    finally:
+        set_search_parameter(index, saved.get("nprobe", saved.get("efSearch")))
+    latencies.sort()
+    return {
+        "recall": found / len(queries) if len(queries) else 0.0,
+        "p50_ms": latencies[len(latencies) // 2] * 1000 if latencies else 0.0,
+        "p95_ms": latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))] * 1000 if latencies else 0.0,
+    }
+
+
+def compression_report(index: faiss.Index, vectors: np.ndarray, rerank: int = 0, k: int = 10,
+                       queries: int = 200) -> Dict:
+    """
+    Measure what the compression of an index saves and loses against the uncompressed index of the same type built
+    with the same vectors: its memory, and its recall@k of the neighbours found by the uncompressed index without and
+    with re-ranking, the stored vectors being the queries. The loss of an IVF or HNSW index itself isn't counted.
+    :param index: The compressed index
+    :param vectors: The exact vectors of the index
+    :param rerank: The candidates re-ranked, as a multiple of k
+    :param k: The number of neighbours searched
+    :param queries: The number of queries
+    """
+    uncompressed = build_index(vectors, describe_index(index)["type"], index.metric_type, "none")
+    sample = np.random.default_rng(0).choice(len(vectors), min(queries, len(vectors)), replace=False)
+    report = {
+        "memory_saving": round(1 - index_bytes(index) / max(index_bytes(uncompressed), 1), 3),
+        "recall": round(benchmark_index(index, vectors[sample], k, vectors=vectors,
+                                        reference=uncompressed)["recall"], 3),
+    }
+    if rerank:
+        report["reranked_recall"] = round(benchmark_index(index, vectors[sample], k, vectors=vectors,
+                                                          candidates=rerank * k, reference=uncompressed)["recall"], 3)
+    return report
+
+
+if __name__ == '__main__':
+    raise Exception("This file isn't intended to be run directly")
@@ -80,5 +80,5 @@ If ($MyInvocation.InvocationName -ne ".")
 
     # Run Python scripts
     python .\codes\before_code.py
-    python .\codes\Copilot.py
+    python .\codes\serve_copilot.py
 }
\ No newline at end of file
@@ -63,4 +63,4 @@ pip install -r ./requirements.txt -q
 echo ""
 echo -e "\e[92mUse the command 'screen -r Copilot' to attach to the app.\e[0m"
 echo -e "\e[92mTo detach use Ctrl + A > D \e[0m"
-screen -dmS Copilot bash -c 'python3 ./codes/before_code.py; python3 ./codes/Copilot.py; exec bash'
\ No newline at end of file
+screen -dmS Copilot bash -c 'python3 ./codes/before_code.py; python3 ./codes/serve_copilot.py; exec bash'
\ No newline at end of file
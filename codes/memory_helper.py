@@ -0,0 +1,168 @@
+"""
+Rolling summary of the long conversations.
+Once the turns of a conversation not covered by its summary pass a token threshold, they are summarized (with the
+former summary) in the background after the answer is streamed, and the next prompts carry the summary instead of
+these turns. The summaries are kept per session, with a fingerprint of the turns they cover so that a summary is only
+used if the conversation still starts with these turns (the chat can be cleared, retried or undone).
+"""
+import asyncio
+import hashlib
+import os
+import time
+from collections import OrderedDict
+from typing import Awaitable, Callable, Dict, List, Optional, Set, Tuple
+
+from termcolor import colored
+
+import prompt_helper as ph
+
+SUMMARY_INSTRUCTIONS = (
+    "Summarize the following conversation between a user and an assistant working on Polarion workitems. "
+    "Keep every requirement, workitem id, PUID, decision, test step and user preference that may be needed to "
+    "continue the conversation. Write the summary in the third person, without any introduction."
+)
+
+
+def fingerprint(turns: List[List[str]]) -> str:
+    """
+    Return a fingerprint of the turns of a conversation
+    :param turns: The turns as [user message, assistant answer] pairs
+    """
+    digest = hashlib.sha1()
+    for human, assistant in turns:
+        digest.update(f"{len(human)}:{human}{len(assistant or '')}:{assistant or ''}".encode())
+    return digest.hexdigest()
+
+
+def format_turns(turns: List[List[str]]) -> str:
+    """
+    Return the turns of a conversation to summarize, without the references displayed above the answers
+    """
+    return "\n".join(f"User: {human}\nAssistant: {ph.answer_text(assistant)}" for human, assistant in turns)
+
+
+class ConversationMemory:
+    """
+    Per session cache of the conversation summaries
+    :param summarize: An async function returning the completion of the given messages, in at most the given tokens
+    :param count_tokens: A function counting the tokens of a text
+    :param threshold: The tokens of the unsummarized turns above which they are summarized
+    :param keep_turns: The number of last turns always sent as they are
+    :param max_sessions: The number of sessions whose summary is kept, the least recently used are forgotten first
+    :param max_summary_tokens: The maximum number of tokens of a summary
+    """
+
+    def __init__(self, summarize: Callable[[List[dict], int], Awaitable[str]], count_tokens: Callable[[str], int],
+                 threshold: int = 4096, keep_turns: int = 2, max_sessions: int = 1024,
+                 max_summary_tokens: int = 1024):
+        self.summarize = summarize
+        self.max_summary_tokens = max_summary_tokens
+        self.count_tokens = count_tokens
+        self.threshold = threshold
+        self.keep_turns = keep_turns
+        self.max_sessions = max_sessions
+        self._summaries: "OrderedDict[str, Dict]" = OrderedDict()
+        self._running: Dict[str, asyncio.Task] = {}
+        self._tasks: Set[asyncio.Task] = set()
+        self.summaries = 0
+        self.failures = 0
+        self.applied = 0
+        self.summarized_tokens = 0
+        self.summary_tokens = 0
+        self.summarization_time = 0.0
+
+    def _tokens(self, turns: List[List[str]]) -> int:
+        return sum(self.count_tokens(human) + self.count_tokens(ph.answer_text(assistant) or "")
+                   for human, assistant in turns)
+
+    def apply(self, session: Optional[str], history: List[List[str]]) -> Tuple[Optional[str], List[List[str]]]:
+        """
+        Replace the turns covered by the summary of the session
+        :param session: The id of the session
+        :param history: The turns of the conversation
+        :return: The summary, or None, and the turns not covered by it in a tuple
+        """
+        entry = self._summaries.get(session) if session else None
+        if entry is None or len(history) < entry["turns"]:
+            return None, history
+        if fingerprint(history[:entry["turns"]]) != entry["fingerprint"]:  # The conversation was edited
+            return None, history
+        self._summaries.move_to_end(session)
+        self.applied += 1
+        return entry["summary"], history[entry["turns"]:]
+
+    def schedule(self, session: Optional[str], history: List[List[str]]):
+        """
+        Summarize the conversation in the background if its unsummarized turns pass the threshold.
+        Must be called from the event loop, once the answer is complete.
+        :param session: The id of the session
+        :param history: The turns of the conversation, including the last answer
+        """
+        if not session or session in self._running:
+            return
+        summary, turns = self.apply(session, history)
+        if len(turns) <= self.keep_turns or self._tokens(turns) <= self.threshold:
+            return
+        task = asyncio.create_task(self._update(session, history, summary, len(history) - len(turns)))
+        self._running[session] = task
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _update(self, session: str, history: List[List[str]], summary: Optional[str], covered: int):
+        end = len(history) - self.keep_turns
+        turns = history[covered:end]
+        content = ""
+        if summary:
+            content += f"### Summary of the beginning of the conversation :\n{summary}\n"
+        content += f"### Conversation :\n{format_turns(turns)}"
+        start = time.perf_counter()
+        try:
+            new_summary = await self.summarize(
+                [{"role": "user", "content": f"{SUMMARY_INSTRUCTIONS}\n{content}"}], self.max_summary_tokens
+            )
+        except Exception as e:
+            self.failures += 1
+            print(colored(f"Summarization of a conversation failed: {e}", "yellow"))
+            return
+        finally:
+            self._running.pop(session, None)
+        self.summarization_time += time.perf_counter() - start
+        self.summaries += 1
+        self.summarized_tokens += self._tokens(history[:end])
+        self.summary_tokens += self.count_tokens(new_summary)
+        self._summaries[session] = {"turns": end, "fingerprint": fingerprint(history[:end]), "summary": new_summary}
+        self._summaries.move_to_end(session)
+        while len(self._summaries) > self.max_sessions:
+            self._summaries.popitem(last=False)
+
+    def stats(self) -> dict:
+        return {
+            "sessions": len(self._summaries),
+            "running": len(self._running),
+            "summaries": self.summaries,
+            "failures": self.failures,
+            "applied": self.applied,
+            "compression_ratio": round(self.summarized_tokens / self.summary_tokens, 2) if self.summary_tokens else 0.0,
+            "avg_summarization_s": round(self.summarization_time / self.summaries, 4) if self.summaries else 0.0,
+        }
+
+
+def memory_from_env(summarize: Callable[[List[dict], int], Awaitable[str]],
+                    count_tokens: Callable[[str], int]) -> Optional[ConversationMemory]:
+    """
+    Create the conversation memory with the settings of the .env file, None if it isn't enabled:
+    conversation_memory (true or false, default false), memory_threshold_tokens (default 4096),
+    memory_keep_turns (default 2)
+    """
+    if os.environ.get("conversation_memory", "false").lower() != "true":
+        return None
+    return ConversationMemory(
+        summarize,
+        count_tokens,
+        threshold=int(os.environ.get("memory_threshold_tokens", 4096)),
+        keep_turns=int(os.environ.get("memory_keep_turns", 2)),
+    )
+
+
+if __name__ == '__main__':
+    raise Exception("This file isn't intended to be run directly")
@@ -0,0 +1,70 @@
+"""
+Conversion of the databases saved with a pickled docstore (index.pkl) to the SQLite docstore read lazily by the Copilot.
+Every chunk is read back from the SQLite docstore and compared with the pickled one before the pickle is deleted.
+
+Usage (from the codes folder):
+    python migrate_docstore.py                 # Every database of the faiss catalog
+    python migrate_docstore.py <DB_ID> [...]   # Some databases
+"""
+import argparse
+import os
+import pickle
+
+from termcolor import colored
+
+import database_helper as dh
+import file_helper as fh
+from docstore_helper import DOCSTORE_FILE, SQLiteDocstore, write_docstore
+
+
+def migrate_database(db_id: str) -> bool:
+    """
+    Convert the pickled docstore of a database to a SQLite docstore
+    :param db_id: The id of the database
+    :return: Whether the database was converted, False if it already has a SQLite docstore
+    """
+    path = dh.get_files_path(db_id)
+    pickled = path / dh.PICKLED_DOCSTORE_FILE
+    if not pickled.exists():
+        return False
+    with open(pickled, "rb") as f:
+        docstore, index_to_docstore_id = pickle.load(f)
+    staging = path / f"{DOCSTORE_FILE}.tmp"
+    write_docstore(staging, docstore, index_to_docstore_id)
+    converted = SQLiteDocstore(staging)
+    try:
+        for position, doc_id in index_to_docstore_id.items():
+            doc, copy = docstore.search(doc_id), converted.search(doc_id)
+            if (copy.page_content, copy.metadata) != (doc.page_content, doc.metadata) or \
+                    converted.position(doc_id) != position:
+                raise Exception(f"The chunk {doc_id} of database {db_id} differs once converted")
+    except BaseException:
+        converted.close()
+        staging.unlink()
+        raise
+    converted.close()
+    before = pickled.stat().st_size
+    os.replace(staging, path / DOCSTORE_FILE)
+    pickled.unlink()
+    after = (path / DOCSTORE_FILE).stat().st_size
+    print(f"Database {colored(db_id, 'green')}: {len(index_to_docstore_id)} chunks, "
+          f"{before / 1e6:.1f} MB pickled -> {after / 1e6:.1f} MB in SQLite.")
+    return True
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Convert the pickled docstores of the databases to SQLite")
+    parser.add_argument("db_ids", nargs="*", help="Ids of the databases, every catalogued database if omitted")
+    args = parser.parse_args()
+    db_ids = args.db_ids or list(fh.open_pkl_file_rb(fh.get_faiss_catalog_path()).keys())
+    converted = 0
+    for db_id in db_ids:
+        try:
+            converted += migrate_database(db_id)
+        except Exception as e:
+            print(colored(f"Conversion of database {db_id} failed, it keeps its pickled docstore: {e}", "red"))
+    print(f"{converted} database(s) converted, {len(db_ids) - converted} left as they were.")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,114 @@
+"""
+Benchmark of the time to first token with the former prompt layout (instructions and context in the last message)
+and with the prefix caching friendly layout of prompt_helper.py.
+
+Usage (from the codes folder):
+    python prompt_benchmark.py                      # Against the stub server, simulating vLLM prefix caching
+    python prompt_benchmark.py --url <URL>/v1       # Against a real vLLM server (--enable-prefix-caching)
+"""
+import argparse
+import asyncio
+import statistics
+import time
+import uuid
+from typing import Callable, Dict, List
+
+from openai import AsyncOpenAI
+from termcolor import colored
+
+import prompt_helper as ph
+from stub_server import StubServer
+
+ANSWER = ("The requirement is verified by the test steps of the table above, the expected results are listed "
+          "in their own column. ") * 6
+
+
+def legacy_layout(use_case: str, history: List[dict], message: str, context: str) -> List[dict]:
+    """
+    The former layout: the history, then one message holding the instructions, the context and the question
+    """
+    return history + [{
+        "role": "user",
+        "content": f"{ph.get_instructions(use_case)} ### Context :{context} ### Question :{message}",
+    }]
+
+
+LAYOUTS: Dict[str, Callable[[str, List[dict], str, str], List[dict]]] = {
+    "legacy": legacy_layout,
+    "prefix (user instructions)": lambda use_case, history, message, context: ph.build_messages(
+        use_case, history, message, context, role="user"),
+    "prefix (system instructions)": lambda use_case, history, message, context: ph.build_messages(
+        use_case, history, message, context, role="system"),
+}
+
+
+def make_context(run: str, conversation: int, turn: int, workitems: int) -> str:
+    """
+    Synthetic retrieved workitems, different for every question
+    """
+    return "".join(
+        f" - The system shall handle the case {run}-{conversation}-{turn}-{i} of the beam line within the safety "
+        f"limits defined for the treatment room and report any deviation to the operator. PTS-REQ-{turn}{i}\n"
+        for i in range(workitems)
+    )
+
+
+async def conversation(client: AsyncOpenAI, model: str, layout: Callable, run: str, index: int, turns: int,
+                       workitems: int) -> List[float]:
+    """
+    Play a conversation and return the time to first token of every turn
+    """
+    use_case = "test_case" if index % 2 else "no_use_case"
+    history = []
+    ttfts = []
+    for turn in range(turns):
+        message = f"Write the test steps of the requirement {run}-{index}-{turn}."
+        messages = layout(use_case, history, message, make_context(run, index, turn, workitems))
+        start = time.perf_counter()
+        response = await client.chat.completions.create(model=model, messages=messages, max_tokens=8, stream=True)
+        async for chunk in response:
+            if chunk.choices and chunk.choices[0].delta.content:
+                ttfts.append(time.perf_counter() - start)
+                break
+        await response.close()
+        history += [{"role": "user", "content": message}, {"role": "assistant", "content": ANSWER}]
+    return ttfts
+
+
+async def benchmark(url: str, model: str, conversations: int, turns: int, workitems: int, layout: Callable) -> list:
+    client = AsyncOpenAI(api_key="EMPTY", base_url=url)
+    run = uuid.uuid4().hex[:8]  # The runs don't share their prompts, so they don't reuse each other's cache
+    results = await asyncio.gather(*(
+        conversation(client, model, layout, run, index, turns, workitems) for index in range(conversations)
+    ))
+    return [ttft for ttfts in results for ttft in ttfts]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Time to first token of the prompt layouts")
+    parser.add_argument("--url", help="URL of an OpenAI like API, a stub server is started if omitted")
+    parser.add_argument("--model", default="mistralai/Mistral-7B-Instruct-v0.3")
+    parser.add_argument("--conversations", type=int, default=8)
+    parser.add_argument("--turns", type=int, default=4)
+    parser.add_argument("--workitems", type=int, default=30, help="Retrieved workitems per question")
+    parser.add_argument("--prefill-ms", type=float, default=0.1, help="Stub prefill time per uncached token")
+    args = parser.parse_args()
+
+    for name, layout in LAYOUTS.items():
+        stub = None
+        url = args.url
+        if url is None:
+            stub = StubServer(token_delay=0.001, model=args.model, prefill_delay=args.prefill_ms / 1000).start()
+            url = stub.url
+        ttfts = asyncio.run(benchmark(url, args.model, args.conversations, args.turns, args.workitems, layout))
+        ttfts.sort()
+        print(colored(name, "light_cyan"))
+        print(f"  Time to first token: mean {statistics.mean(ttfts) * 1000:.1f} ms, "
+              f"p50 {ttfts[len(ttfts) // 2] * 1000:.1f} ms, p95 {ttfts[int(len(ttfts) * 0.95)] * 1000:.1f} ms")
+        if stub is not None:
+            print(f"  Prompt tokens found in the prefix cache: {stub.cached_tokens / stub.prompt_tokens:.1%}")
+            stub.stop()
+
+
+if __name__ == '__main__':
+    main()
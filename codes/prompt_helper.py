@@ -0,0 +1,167 @@
+"""
+Layout of the prompts sent to the LLM.
+The messages always start with the same instructions for a given use case, followed by the history of the
+conversation, then the retrieved context and the question. Two requests of the same use case share the instructions
+as a prefix, and two turns of the same conversation share everything up to the new question, so vLLM's automatic
+prefix caching reuses their KV blocks instead of computing them again.
+"""
+import os
+import textwrap
+from typing import Dict, List, Optional
+
+GENERAL_INSTRUCTIONS = (
+    "You are a helpful and appreciated assistant, answer the question naturally. "
+    "Your primary goal is to provide accurate and natural responses to the user's questions. "
+    "If a question is ambiguous, ask clarifying questions to better understand the user's needs. "
+    "*DO NOT make up information*; if you don't know the answer, it's okay to say so in a polite way. "
+    "When applicable, provide **examples** or **references** to support your answer. "
+    "A question might come with a CONTEXT that might be useful for the question. "
+    "Consider it as knowledge and not provided information, use it to answer the question. "
+    "Only if the CONTEXT has nothing to do with the QUESTION or is EMPTY, provide the "
+    "answer to the question without using the CONTEXT. "
+    "The ABBREVIATION list, if any, gives the meaning of the abbreviations of the question and of the CONTEXT."
+)
+
+TEST_CASE_INSTRUCTIONS = textwrap.dedent("""
+    Your main goal is to write or modify test steps from a given requirement.
+    Here are some examples of the provided task.
+    --- Start of example
+    Requirements to test
+    • The system shall prevent motion if pit is not secured
+    • The system shall prevent motion if motion enable button is not pressed
+    Test steps for the requirements
+    <table>
+    <thead><tr><th>Step Number</th><th>Step Description</th><th>Expected Result</th></tr></thead>
+        <tbody>
+            <tr><td>1</td><td>Unsecure the pit</td><td>Motion enable = OFF</td></tr><tr><td>2</td>
+            <td>Press motion enable button</td><td>Motion enable = OFF</td></tr><tr><td>3</td>
+            <td>Stop pressing motion enable button</td><td>Motion enable = OFF</td></tr>
+            <tr><td>4</td><td>Secure the pit</td><td>Motion enable = OFF</td></tr>
+            <tr><td>5</td><td>Press motion enable button</td><td>Motion enable = ON</td></tr>
+            <tr><td>6</td><td>Stop pressing motion enable button</td><td>Motion enable = OFF</td></tr>
+        </tbody>
+    </table>
+    --- End of example
+    If the user asks you to write test steps from a requirement, you should provide the test steps with the same logic as the example.
+    If the user asks you to modify the test steps, you should modify the test steps with the same logic as the example.
+    If the users asks you to complete test steps DO NOT modify the provided test steps. DO NOT change the test steps order or provide MINIMUM 2 ways to do it.
+    ALWAYS present your response in a table format with clear headers and neatly organized rows and columns.
+    Do not replicate the user's structured input directly, even if it looks like a table or structured text.
+    Instead, reformat all information into a new table with appropriate adjustments as needed.
+    Ensure that:
+    - Each step is listed clearly with step numbers.
+    - The step description is concise and formatted uniformly.
+    - Expected results are accurately represented in their own column.
+    - Headers should be explicitly stated and aligned correctly.
+    Even if the user provides a structured answer, do not replicate it directly. Instead, format your response in a structured table with clear headers and neatly organized rows and columns.
+    """)
+
+USE_CASES: Dict[str, str] = {
+    "no_use_case": GENERAL_INSTRUCTIONS,
+    "test_case": f"{GENERAL_INSTRUCTIONS}\n### Specific context :{TEST_CASE_INSTRUCTIONS}",
+}
+
+INSTRUCTIONS_ACKNOWLEDGEMENT = "Understood, I will follow these instructions."
+SUMMARY_ACKNOWLEDGEMENT = "Understood, I will take the beginning of the conversation into account."
+# The references displayed above an answer in the chat, removed from the history sent to the LLM
+REFERENCES_HEADER = "<i><b>References:</b></i>\n"
+ANSWER_HEADER = "\n<i><b>Answer:</b></i>\n"
+
+
+def get_instructions(use_case: str) -> str:
+    """
+    Return the instructions of a use case, the general ones for an unknown use case
+    """
+    return USE_CASES.get(use_case, GENERAL_INSTRUCTIONS)
+
+
+def instruction_messages(use_case: str, role: str = "user") -> List[dict]:
+    """
+    Return the leading messages carrying the instructions of a use case.
+    The chat template of Mistral moves the system message into the last user message, which breaks the shared prefix,
+    so by default the instructions are sent as a first user message acknowledged by the assistant.
+    :param use_case: The use case
+    :param role: "user" for a first exchange, "system" for a system message
+    """
+    if role == "system":
+        return [{"role": "system", "content": get_instructions(use_case)}]
+    return [
+        {"role": "user", "content": get_instructions(use_case)},
+        {"role": "assistant", "content": INSTRUCTIONS_ACKNOWLEDGEMENT},
+    ]
+
+
+def answer_text(assistant: Optional[str]) -> Optional[str]:
+    """
+    Return an answer of the history without the references displayed above it
+    :param assistant: The answer as displayed in the chat
+    """
+    if assistant and assistant.startswith(REFERENCES_HEADER) and ANSWER_HEADER in assistant:
+        return assistant.split(ANSWER_HEADER, 1)[1]
+    return assistant
+
+
+def summary_messages(summary: Optional[str]) -> List[dict]:
+    """
+    Return the messages carrying the summary of the turns replaced by the conversation memory, if any
+    """
+    if not summary:
+        return []
+    return [
+        {"role": "user", "content": f"### Summary of the beginning of the conversation :\n{summary}"},
+        {"role": "assistant", "content": SUMMARY_ACKNOWLEDGEMENT},
+    ]
+
+
+def question_message(message: str, context: str = "", abbreviations: str = "") -> dict:
+    """
+    Return the last message: the retrieved context, the abbreviations and the question
+    :param message: The user input
+    :param context: [Optional] The retrieved workitems
+    :param abbreviations: [Optional] The meaning of the abbreviations of the question and of the context
+    """
+    content = ""
+    if context:
+        content += f"### Context :\n{context}\n"
+    if abbreviations:
+        content += f"### Abbreviation :\n{abbreviations}\n"
+    return {"role": "user", "content": f"{content}### Question :\n{message}"}
+
+
+def build_messages(
+        use_case: str,
+        history: List[dict],
+        message: str,
+        context: str = "",
+        abbreviations: str = "",
+        role: str = "user",
+        summary: Optional[str] = None
+) -> List[dict]:
+    """
+    Lay out the prompt: instructions of the use case, summary of the oldest turns, history, context and question
+    :param use_case: The use case
+    :param history: The history in the OpenAI format
+    :param message: The user input
+    :param context: [Optional] The retrieved workitems
+    :param abbreviations: [Optional] The meaning of the abbreviations of the question and of the context
+    :param role: The role of the instructions, see instruction_messages
+    :param summary: [Optional] The summary of the turns missing from the history
+    :return: The messages in the OpenAI format
+    """
+    return (instruction_messages(use_case, role) + summary_messages(summary) + history
+            + [question_message(message, context, abbreviations)])
+
+
+def instructions_role_from_env() -> str:
+    """
+    Return the role of the instructions from the .env file:
+    prompt_instructions_role ("user" or "system", default "user")
+    """
+    role = os.environ.get("prompt_instructions_role", "user")
+    if role not in ("user", "system"):
+        raise ValueError("prompt_instructions_role must be 'user' or 'system'")
+    return role
+
+
+if __name__ == '__main__':
+    raise Exception("This file isn't intended to be run directly")
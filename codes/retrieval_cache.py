@@ -0,0 +1,301 @@
+"""
+Caches used by the Copilot retrieval: query embeddings and similarity search results.
+Both are bounded LRU caches with a time to live, optionally persisted in a SQLite file so that a restart
+of the Copilot doesn't start cold. The SQLite file is only accessed by a thread of each cache, so that the event loop
+never waits for it: the new entries are written in batches and the file is trimmed to the size of the cache from time
+to time.
+"""
+import asyncio
+import hashlib
+import os
+import pickle
+import re
+import sqlite3
+import threading
+import time
+from array import array
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Any, Awaitable, Callable, List, Optional, Tuple
+
+from langchain_core.documents import Document
+
+import file_helper as fh
+
+TRIM_INTERVAL = 60  # Seconds between two deletions of the oldest and expired entries of the SQLite file
+
+
+def normalize_query(text: str) -> str:
+    """
+    Normalize a question so that trivial variations share the same cache entry
+    (case, surrounding punctuation and repeated whitespaces)
+    """
+    text = re.sub(r"\s+", " ", text.lower()).strip()
+    return text.strip(" ?!.")
+
+
+def vector_hash(vector: List[float]) -> str:
+    """
+    Return a short hash of an embedding vector
+    """
+    return hashlib.sha1(array("f", vector).tobytes()).hexdigest()
+
+
+class TTLCache:
+    """
+    Thread-safe LRU cache whose entries expire after a time to live
+    :param max_entries: The maximum number of entries kept in memory
+    :param ttl: The time to live of an entry in seconds
+    :param sqlite_path: [Optional] A SQLite file in which the entries are also persisted, by a thread of the cache
+    :param table: The table used in the SQLite file
+    """
+
+    def __init__(self, max_entries: int = 1024, ttl: float = 86400, sqlite_path: Optional[Path] = None,
+                 table: str = "cache"):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.table = table
+        self.hits = 0
+        self.misses = 0
+        self._entries: "OrderedDict[str, Tuple[float, Any]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._db = None
+        self._executor = None
+        self._pending: List[Tuple[str, float, Any]] = []
+        self._trimmed = time.monotonic()
+        if sqlite_path is not None:
+            # Shared by the Copilot workers: they wait for each other's writes instead of failing
+            self._db = sqlite3.connect(str(sqlite_path), timeout=30, check_same_thread=False)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute(f"CREATE TABLE IF NOT EXISTS {table} (key TEXT PRIMARY KEY, created REAL, value BLOB)")
+            self._db.execute(f"CREATE INDEX IF NOT EXISTS {table}_created ON {table} (created)")
+            self._db.execute(f"DELETE FROM {table} WHERE created < ?", (time.time() - ttl,))
+            self._db.commit()
+            self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix=f"{table}_cache")
+
+    def _lookup(self, key: str, row: Optional[tuple] = None) -> Optional[Any]:
+        """
+        Return the value of a key from the memory, or from the row read in the SQLite file
+        """
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None and row is not None:
+                entry = (row[0], pickle.loads(row[1]))
+                self._entries[key] = entry
+                while len(self._entries) > self.max_entries:
+                    self._entries.popitem(last=False)
+            if entry is None or now - entry[0] > self.ttl:
+                self._entries.pop(key, None)
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def _cached(self, key: str) -> bool:
+        with self._lock:
+            return key in self._entries
+
+    def _read(self, key: str) -> Optional[tuple]:
+        """
+        Read the row of a key in the SQLite file, in the thread of the cache
+        """
+        return self._db.execute(f"SELECT created, value FROM {self.table} WHERE key = ?", (key,)).fetchone()
+
+    def _write(self):
+        """
+        Write the pending entries in the SQLite file in one transaction, in the thread of the cache, and delete the
+        expired and the oldest entries every TRIM_INTERVAL
+        """
+        with self._lock:
+            pending, self._pending = self._pending, []
+        if not pending:
+            return
+        self._db.executemany(f"INSERT OR REPLACE INTO {self.table} VALUES (?, ?, ?)",
+                             [(key, created, pickle.dumps(value)) for key, created, value in pending])
+        if time.monotonic() - self._trimmed > TRIM_INTERVAL:
+            self._trimmed = time.monotonic()
+            self._db.execute(f"DELETE FROM {self.table} WHERE created < ?", (time.time() - self.ttl,))
+            self._db.execute(  # The index on created finds the newest entries kept
+                f"DELETE FROM {self.table} WHERE created < "
+                f"(SELECT created FROM {self.table} ORDER BY created DESC LIMIT 1 OFFSET ?)", (self.max_entries - 1,))
+        self._db.commit()
+
+    def __contains__(self, key: str) -> bool:
+        """
+        Whether a key is cached in memory and not expired, without counting a hit or a miss
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            return entry is not None and time.time() - entry[0] <= self.ttl
+
+    def get(self, key: str) -> Optional[Any]:
+        """
+        Return the value of a key, or None if it isn't cached or expired
+        """
+        if self._db is None or self._cached(key):
+            return self._lookup(key)
+        return self._lookup(key, self._executor.submit(self._read, key).result())
+
+    async def aget(self, key: str) -> Optional[Any]:
+        """
+        Asynchronous version of get, the SQLite file being read in the thread of the cache
+        """
+        if self._db is None or self._cached(key):
+            return self._lookup(key)
+        return self._lookup(key, await asyncio.get_running_loop().run_in_executor(self._executor, self._read, key))
+
+    def set(self, key: str, value: Any):
+        """
+        Add or replace a key, evicting the least recently used entries. The entry is written in the SQLite file by
+        the thread of the cache, without waiting for it
+        """
+        created = time.time()
+        with self._lock:
+            self._entries[key] = (created, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+            if self._db is None:
+                return
+            self._pending.append((key, created, value))
+            if len(self._pending) > 1:  # Already scheduled
+                return
+        self._executor.submit(self._write)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._pending.clear()
+        if self._db is not None:
+            self._executor.submit(self._clear).result()
+
+    def _clear(self):
+        self._db.execute(f"DELETE FROM {self.table}")
+        self._db.commit()
+
+    def stats(self) -> dict:
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / total, 3) if total else 0.0,
+            }
+
+
+class RetrievalCache:
+    """
+    Two-level cache of the retrieval: (embedding model, normalized query) -> embedding vector, then
+    (db_id, index version, search settings, embedding hash, k) -> documents found in the database
+    :param max_entries: The maximum number of entries of each level
+    :param ttl: The time to live of an entry in seconds
+    :param persist: Whether the entries are also saved in a SQLite file of the catalog folder
+    :param model: The embedding model (or the API serving it), so that the persisted embeddings of another model
+    aren't used
+    :param settings: The search settings changing the documents found, so that the persisted results of other
+    settings aren't used
+    """
+
+    def __init__(self, max_entries: int = 1024, ttl: float = 86400, persist: bool = False, model: str = "",
+                 settings: str = ""):
+        self.model = model
+        self.settings = settings
+        sqlite_path = fh.get_retrieval_cache_path() if persist else None
+        self.embeddings = TTLCache(max_entries, ttl, sqlite_path, "embeddings")
+        self.results = TTLCache(max_entries, ttl, sqlite_path, "results")
+
+    def embed_query(self, message: str, embed: Callable[[str], List[float]]) -> List[float]:
+        """
+        Return the embedding of a question, computed only if it isn't cached
+        :param message: The user input
+        :param embed: The function computing the embedding
+        """
+        key = f"{self.model}|{normalize_query(message)}"
+        vector = self.embeddings.get(key)
+        if vector is None:
+            vector = embed(message)
+            self.embeddings.set(key, vector)
+        return vector
+
+    async def aembed_query(self, message: str, aembed: Callable[[str], Awaitable[List[float]]]) -> List[float]:
+        """
+        Asynchronous version of embed_query
+        :param message: The user input
+        :param aembed: The coroutine function computing the embedding
+        """
+        key = f"{self.model}|{normalize_query(message)}"
+        vector = await self.embeddings.aget(key)
+        if vector is None:
+            vector = await aembed(message)
+            self.embeddings.set(key, vector)
+        return vector
+
+    def search(
+            self,
+            db_id: str,
+            version: Any,
+            vector: List[float],
+            k: int,
+            search: Callable[[], List[Tuple[Document, float]]]
+    ) -> List[Tuple[Document, float]]:
+        """
+        Return the documents found for an embedding, searched only if they aren't cached
+        :param db_id: The id of the database
+        :param version: The version of the database (its last update)
+        :param vector: The embedding of the question
+        :param k: The number of documents to return
+        :param search: The function searching the database
+        """
+        key = f"{db_id}|{version}|{self.settings}|{vector_hash(vector)}|{k}"
+        documents = self.results.get(key)
+        if documents is None:
+            documents = search()
+            self.results.set(key, documents)
+        return documents
+
+    async def asearch(
+            self,
+            db_id: str,
+            version: Any,
+            vector: List[float],
+            k: int,
+            search: Callable[[], Awaitable[Any]]
+    ) -> Any:
+        """
+        Asynchronous version of search
+        :param search: The coroutine function searching the database
+        """
+        key = f"{db_id}|{version}|{self.settings}|{vector_hash(vector)}|{k}"
+        documents = await self.results.aget(key)
+        if documents is None:
+            documents = await search()
+            self.results.set(key, documents)
+        return documents
+
+    def stats(self) -> dict:
+        return {"embeddings": self.embeddings.stats(), "results": self.results.stats()}
+
+
+def cache_from_env(model: str = "", settings: str = "") -> RetrievalCache:
+    """
+    Create the cache with the settings of the .env file:
+    retrieval_cache_size (default 1024), retrieval_cache_ttl (seconds, default 86400),
+    retrieval_cache_persist (default false)
+    :param model: The embedding model, see RetrievalCache
+    :param settings: The search settings, see RetrievalCache
+    """
+    return RetrievalCache(
+        max_entries=int(os.environ.get("retrieval_cache_size", 1024)),
+        ttl=float(os.environ.get("retrieval_cache_ttl", 86400)),
+        persist=os.environ.get("retrieval_cache_persist", "false").lower() == "true",
+        model=model,
+        settings=settings,
+    )
+
+
+if __name__ == '__main__':
+    raise Exception("This file isn't intended to be run directly")
@@ -0,0 +1,136 @@
+"""
+Load test of the retrieval stage of the Copilot with 1 to N worker processes, to check that it scales with the cores as
+with serve_copilot.py. Every worker loads the database as a Copilot worker does (index memory mapped if faiss_mmap,
+SQLite docstore) and runs the searches of the questions as fast as it can: the similarity search, the lexical search,
+the exact matches and the reading of the chunks found. The questions are made of the chunks of the database, their
+embedding being the vector of the chunk, so that no embedding server is needed.
+With --threads, the workers are threads of one process, as the Copilot was served before, to compare.
+
+Usage (from the codes folder):
+    python retrieval_load_test.py <DB_ID>                           # 1, 2, 4... workers up to the number of cores
+    python retrieval_load_test.py <DB_ID> --workers 1 2 4 8 --duration 20
+    python retrieval_load_test.py <DB_ID> --threads
+"""
+import argparse
+import multiprocessing
+import os
+import queue
+import random
+import statistics
+import threading
+import time
+from typing import List, Tuple
+
+from dotenv import load_dotenv
+from langchain_core.embeddings import FakeEmbeddings
+from termcolor import colored
+
+import database_helper as dh
+
+
+def load(db_id: str) -> dh.Database:
+    mmap = os.environ.get("faiss_mmap", "true").lower() == "true"
+    return dh.load_database(db_id, FakeEmbeddings(size=1), mmap=mmap)  # The questions are searched by vector
+
+
+def make_questions(db: dh.Database, count: int, seed: int) -> List[Tuple[List[float], str]]:
+    """
+    Return questions made of random chunks of the database: the vector of the chunk and its first words
+    """
+    rng = random.Random(seed)
+    positions = rng.sample(range(db.faiss.index.ntotal), min(count, db.faiss.index.ntotal))
+    questions = []
+    for position in positions:
+        doc_id = db.faiss.index_to_docstore_id[position]
+        text = " ".join(db.faiss.docstore.search(doc_id).page_content.split()[:12])
+        questions.append((db.get_vector(doc_id), text))
+    return questions
+
+
+def retrieve(db: dh.Database, vector: List[float], text: str, k: int):
+    """
+    The searches of one question in one database, see database_search and dense_search_batch in Copilot.py
+    """
+    db.search_batch([vector], k)
+    for doc_id in db.identifiers.find_in_text(text) if db.identifiers is not None else []:
+        db.faiss.docstore.search(doc_id)
+    if db.bm25 is not None:
+        for doc_id, _ in db.bm25.search(text, k):
+            db.faiss.docstore.search(doc_id)
+
+
+def run_worker(db, db_id: str, index: int, k: int, questions: int, duration: float, barrier, results):
+    """
+    Search questions until the end of the test and put the latencies of the searches in the results
+    :param db: The loaded database (threads), None to load it (processes)
+    """
+    db = db or load(db_id)
+    batch = make_questions(db, questions, seed=index)
+    barrier.wait()
+    latencies = []
+    end = time.perf_counter() + duration
+    while time.perf_counter() < end:
+        vector, text = batch[len(latencies) % len(batch)]
+        start = time.perf_counter()
+        retrieve(db, vector, text, k)
+        latencies.append(time.perf_counter() - start)
+    results.put(latencies)
+
+
+def load_test(db_id: str, workers: int, k: int, questions: int, duration: float, threads: bool) -> List[float]:
+    """
+    Run the workers at the same time
+    :return: The latencies of all the searches in seconds
+    """
+    if threads:
+        barrier, results = threading.Barrier(workers), queue.Queue()
+        db = load(db_id)
+        runners = [threading.Thread(target=run_worker, args=(db, db_id, i, k, questions, duration, barrier, results))
+                   for i in range(workers)]
+    else:
+        context = multiprocessing.get_context("spawn")
+        barrier, results = context.Barrier(workers), context.Queue()
+        runners = [context.Process(target=run_worker, args=(None, db_id, i, k, questions, duration, barrier, results))
+                   for i in range(workers)]
+    for runner in runners:
+        runner.start()
+    latencies = []
+    for _ in runners:
+        latencies.extend(results.get())
+    for runner in runners:
+        runner.join()
+    return latencies
+
+
+def main():
+    load_dotenv()
+    cores = os.cpu_count() or 1
+    default_workers = sorted({2 ** i for i in range(cores.bit_length()) if 2 ** i <= cores} | {cores})
+    parser = argparse.ArgumentParser(description="Load test of the retrieval stage with several workers")
+    parser.add_argument("db_id", help="The id of the database searched")
+    parser.add_argument("--workers", type=int, nargs="+", default=default_workers, help="The numbers of workers tested")
+    parser.add_argument("--k", type=int, default=10, help="The number of chunks retrieved")
+    parser.add_argument("--questions", type=int, default=200, help="The distinct questions of every worker")
+    parser.add_argument("--duration", type=float, default=10, help="The duration of every test in seconds")
+    parser.add_argument("--threads", action="store_true", help="Threads of one process instead of processes")
+    args = parser.parse_args()
+
+    print(colored(f"Retrieval load test of database {args.db_id}, {'threads' if args.threads else 'processes'}, "
+                  f"{cores} core(s)", "light_cyan"))
+    print(f"{'workers':>8} {'questions/s':>12} {'speedup':>8} {'efficiency':>11} {'p50 ms':>8} {'p95 ms':>8}")
+    baseline = None
+    for workers in args.workers:
+        latencies = load_test(args.db_id, workers, args.k, args.questions, args.duration, args.threads)
+        throughput = len(latencies) / args.duration
+        baseline = baseline or throughput / workers
+        latencies.sort()
+        p95 = latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))]
+        print(f"{workers:>8} {throughput:>12.1f} {throughput / baseline:>7.2f}x "
+              f"{throughput / baseline / workers:>10.0%} {statistics.median(latencies) * 1000:>8.2f} "
+              f"{p95 * 1000:>8.2f}")
+    if max(args.workers) > cores:
+        print(colored(f"The tests with more workers than the {cores} core(s) can't scale further.", "yellow"))
+
+
+if __name__ == '__main__':
+    main()
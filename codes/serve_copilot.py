@@ -0,0 +1,326 @@
+"""
+Multi-worker serving of the Copilot: N processes running Copilot.py on their own port, behind one front end listening
+on the port of the Copilot. Every worker has its own GIL, event loop and search threads, so the chats are served on
+all the cores of the machine.
+The requests of a Gradio session (its queue, its event stream, its heartbeat) are always sent to the same worker, which
+keeps the state of the session, by rendezvous hashing of the session hash over the workers that are up. With the rate
+limit of the users (copilot_user_rate), the sessions of a client address are all sent to the same worker instead, so
+that its rate is not multiplied by the workers. The other requests (pages, assets) are sent to the worker with the
+fewest open connections.
+The limits of the .env file (WORKER_LIMITS) are shared by the workers, each of them getting its part of the total so that
+the whole Copilot admits as many answers, queued questions and chats as a single process would.
+The workers map the faiss indexes read-only (faiss_mmap) so that they share them in the page cache, and reload a
+database when its version counter is incremented in the faiss catalog by an update. A worker that exits is restarted.
+
+Usage (from the repository root, as Launcher_copilot.sh does):
+    python3 ./codes/serve_copilot.py
+"""
+import asyncio
+import hashlib
+import ipaddress
+import math
+import os
+import re
+import signal
+import subprocess
+import sys
+import time
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+from dotenv import load_dotenv
+from termcolor import colored
+
+import file_helper as fh
+
+HEAD_LIMIT = 64 * 1024
+BODY_LIMIT = 1024 * 1024  # The larger bodies (uploads) are streamed to the worker without looking for their session
+RESTART_DELAY = 5  # Seconds between two starts of a worker
+_session_patterns = [
+    re.compile(rb"[?&]session_hash=([\w-]+)"),  # /queue/data (event stream)
+    re.compile(rb"/heartbeat/([\w-]+)"),
+    re.compile(rb'"session_hash"\s*:\s*"([\w-]+)"'),  # /queue/join, /cancel
+]
+DEFAULT_WORKERS = 2
+# The limits of the whole Copilot and their defaults, see controller_from_env, limiters_from_env and Copilot.py
+WORKER_LIMITS = {
+    "copilot_llm_concurrency": 32,
+    "copilot_max_queue": 128,
+    "copilot_concurrency": 64,
+    "copilot_embedding_concurrency": 8,
+}
+_hop_by_hop_headers = {b"connection", b"keep-alive", b"proxy-connection"}
+
+
+def session_key(request_line: bytes, body: bytes) -> Optional[bytes]:
+    """
+    Return the session hash of a Gradio request, None for the requests that don't belong to a session
+    :param request_line: The first line of the request, holding the path and the query
+    :param body: The body of the request, empty if it wasn't read
+    """
+    for pattern in _session_patterns:
+        match = pattern.search(request_line) or pattern.search(body)
+        if match:
+            return match.group(1)
+    return None
+
+
+class Worker:
+    """
+    A Copilot process serving the chats on its own port
+    :param index: The number of the worker
+    :param port: The port of its Gradio server
+    :param limits: The limits of the worker, set in its environment
+    """
+
+    def __init__(self, index: int, port: int, limits: Optional[Dict[str, str]] = None):
+        self.index = index
+        self.port = port
+        self.limits = limits or {}
+        self.process: Optional[subprocess.Popen] = None
+        self.ready = False
+        self.started = 0.0
+        self.connections = 0
+        self.restarts = 0
+
+    @property
+    def alive(self) -> bool:
+        return self.process is not None and self.process.poll() is None
+
+    def start(self):
+        env = dict(os.environ, **self.limits, copilot_port=str(self.port), copilot_worker=str(self.index))
+        self.process = subprocess.Popen([sys.executable, str(Path(__file__).parent / "Copilot.py")], env=env)
+        self.ready = False
+        self.started = time.monotonic()
+
+    def stop(self):
+        if self.alive:
+            self.process.terminate()
+            try:
+                self.process.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                self.process.kill()
+
+
+class FrontEnd:
+    """
+    Supervisor of the workers and front end forwarding the requests to them
+    :param workers: The number of worker processes
+    :param host: The address of the front end
+    :param port: The port of the front end, the workers listen on the next ports
+    :param route_users: Whether the sessions of a client address are sent to the same worker
+    """
+
+    def __init__(self, workers: int, host: str = "127.0.0.1", port: int = 7860, route_users: bool = False):
+        self.host = host
+        self.port = port
+        self.route_users = route_users
+        limits = worker_limits(workers)
+        self.workers = [Worker(i, port + 1 + i, limits) for i in range(workers)]
+
+    def candidates(self, key: Optional[bytes]) -> List[Worker]:
+        """
+        Return the workers that are up in their order of preference for a request
+        :param key: The session hash of the request, None if it doesn't belong to a session
+        """
+        ready = [worker for worker in self.workers if worker.ready]
+        if key is None:
+            return sorted(ready, key=lambda worker: worker.connections)
+        # Rendezvous hashing: only the sessions of a worker going down move to the others
+        return sorted(ready, key=lambda worker: hashlib.sha1(key + b"|%d" % worker.index).digest(), reverse=True)
+
+    async def supervise(self):
+        """
+        Start the workers, restart the ones that exit and mark the ones accepting connections as ready
+        """
+        while True:
+            for worker in self.workers:
+                if not worker.alive:
+                    worker.ready = False
+                    if time.monotonic() - worker.started < RESTART_DELAY:
+                        continue
+                    if worker.process is not None:
+                        worker.restarts += 1
+                        print(colored(f"Worker {worker.index} exited with code {worker.process.returncode}, "
+                                      f"restarting it.", "yellow"))
+                    worker.start()
+                elif not worker.ready:
+                    try:
+                        _, writer = await asyncio.open_connection("127.0.0.1", worker.port)
+                        writer.close()
+                        worker.ready = True
+                        print(colored(f"Worker {worker.index} ready on port {worker.port}.", "green"))
+                    except OSError:
+                        pass
+            await asyncio.sleep(1)
+
+    async def handle(self, client_reader: asyncio.StreamReader, client_writer: asyncio.StreamWriter):
+        """
+        Forward a request to a worker and its response back, one request per connection to the worker
+        """
+        upstream_writer = None
+        worker = None
+        try:
+            try:
+                head = await client_reader.readuntil(b"\r\n\r\n")
+            except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError):
+                return
+            request_line, headers = parse_head(head)
+            length = int(next((value for name, value in headers if name == b"content-length"), b"0"))
+            body = await client_reader.readexactly(length) if 0 < length <= BODY_LIMIT else b""
+
+            peer = client_writer.get_extra_info("peername")
+            forwarded = forwarded_for(headers, peer[0] if peer else None)
+            key = session_key(request_line, body)
+            if key is not None and self.route_users and forwarded:
+                key = forwarded.split(b",")[-1].strip()
+
+            upstream_reader = None
+            for worker in self.candidates(key):
+                try:
+                    upstream_reader, upstream_writer = await asyncio.open_connection("127.0.0.1", worker.port)
+                    break
+                except OSError:
+                    worker.ready = False
+            if upstream_writer is None:
+                worker = None
+                client_writer.write(b"HTTP/1.1 503 Service Unavailable\r\nContent-Length: 0\r\n"
+                                    b"Retry-After: 5\r\nConnection: close\r\n\r\n")
+                await client_writer.drain()
+                return
+
+            worker.connections += 1
+            upstream_writer.write(rewrite_head(request_line, headers, forwarded) + body)
+            await upstream_writer.drain()
+            upload = asyncio.create_task(pipe(client_reader, upstream_writer, half_close=True))
+            try:
+                await pipe(upstream_reader, client_writer)
+            finally:
+                upload.cancel()
+        except (ConnectionError, asyncio.IncompleteReadError, ValueError):
+            pass
+        finally:
+            if worker is not None and upstream_writer is not None:
+                worker.connections -= 1
+            for writer in (upstream_writer, client_writer):
+                if writer is not None:
+                    writer.close()
+
+    async def serve(self):
+        fh.delete_uncatalogued_db()  # Once for all the workers
+        try:  # Stopped by a SIGTERM as by a Ctrl+C, the workers are stopped with it
+            asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, asyncio.current_task().cancel)
+        except NotImplementedError:  # Windows
+            pass
+        supervisor = asyncio.create_task(self.supervise())
+        server = await asyncio.start_server(self.handle, self.host, self.port, limit=HEAD_LIMIT)
+        print(colored(f"Copilot front end on {self.host}:{self.port}, {len(self.workers)} worker(s).", "light_cyan"))
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            supervisor.cancel()
+            for worker in self.workers:
+                worker.stop()
+
+
+def worker_limits(workers: int) -> Dict[str, str]:
+    """
+    Return the limits of every worker: its part of the total set in the .env file, rounded up
+    :param workers: The number of worker processes
+    """
+    return {name: str(math.ceil(int(os.environ.get(name, default)) / workers))
+            for name, default in WORKER_LIMITS.items()}
+
+
+def parse_head(head: bytes) -> Tuple[bytes, List[Tuple[bytes, bytes]]]:
+    """
+    Split the head of an HTTP request into its first line and its headers, the header names in lowercase
+    """
+    request_line, *lines = head[:-4].split(b"\r\n")
+    headers = []
+    for line in lines:
+        name, _, value = line.partition(b":")
+        headers.append((name.strip().lower(), value.strip()))
+    return request_line, headers
+
+
+def forwarded_for(headers: List[Tuple[bytes, bytes]], client: Optional[str]) -> Optional[bytes]:
+    """
+    Return the X-Forwarded-For of a request forwarded to a worker, whose last address is the one of the client.
+    The X-Forwarded-For of the reverse proxy running on this machine is kept as it is, its last address being the
+    one it added, the address of a client connecting from elsewhere is added after the ones it sent.
+    None if the client isn't known (local connection without X-Forwarded-For), the users being then their sessions
+    :param client: The address of the client connected to the front end
+    """
+    forwarded = next((value for name, value in headers if name == b"x-forwarded-for"), None)
+    if client is None:
+        return forwarded
+    try:
+        local = ipaddress.ip_address(client).is_loopback
+    except ValueError:
+        local = False
+    if local:
+        return forwarded
+    return forwarded + b", " + client.encode() if forwarded else client.encode()
+
+
+def rewrite_head(request_line: bytes, headers: List[Tuple[bytes, bytes]], forwarded: Optional[bytes]) -> bytes:
+    """
+    Return the head of a request forwarded to a worker: the connection is closed after the response (except for a
+    websocket), so that every request of a keep-alive connection is routed on its own
+    :param forwarded: The X-Forwarded-For of the request, see forwarded_for
+    """
+    upgrade = any(name == b"upgrade" for name, _ in headers)
+    lines = [request_line]
+    for name, value in headers:
+        if name in _hop_by_hop_headers or name == b"x-forwarded-for":
+            continue
+        lines.append(name + b": " + value)
+    if forwarded:
+        lines.append(b"x-forwarded-for: " + forwarded)
+    lines.append(b"connection: upgrade" if upgrade else b"connection: close")
+    return b"\r\n".join(lines) + b"\r\n\r\n"
+
+
+async def pipe(reader: asyncio.StreamReader, writer: asyncio.StreamWriter, half_close: bool = False):
+    """
+    Copy a stream to another until its end
+    :param half_close: Whether the end of the stream is forwarded, so that the worker sees a client leaving
+    """
+    try:
+        while True:
+            data = await reader.read(65536)
+            if not data:
+                break
+            writer.write(data)
+            await writer.drain()
+        if half_close and writer.can_write_eof():
+            writer.write_eof()
+    except (ConnectionError, OSError):
+        pass
+
+
+def front_end_from_env() -> FrontEnd:
+    """
+    Create the front end with the settings of the .env file:
+    copilot_workers (default 2), copilot_port (default 7860, the workers use the next ports),
+    copilot_user_rate (the sessions of a client address go to the same worker if set)
+    """
+    return FrontEnd(
+        workers=max(1, int(os.environ.get("copilot_workers", DEFAULT_WORKERS))),
+        port=int(os.environ.get("copilot_port", 7860)),
+        route_users=float(os.environ.get("copilot_user_rate", 0)) > 0,
+    )
+
+
+def main():
+    load_dotenv()
+    try:
+        asyncio.run(front_end_from_env().serve())
+    except (KeyboardInterrupt, asyncio.CancelledError):
+        pass
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,186 @@
+"""
+Adapter between the LLM token stream and the Gradio chat.
+The deltas are buffered and the growing message is only sent to the interface on a time or size cadence,
+instead of re-rendering the whole message for every token.
+When the chat stops reading the stream (stop button, closed tab), the upstream request is closed so that the
+inference server stops generating.
+"""
+import os
+import time
+from typing import AsyncIterator
+
+
+async def stream_deltas(response) -> AsyncIterator[str]:
+    """
+    Yield the text deltas of an OpenAI chat completion stream
+    :param response: The stream returned by client.chat.completions.create(stream=True)
+    """
+    async for chunk in response:
+        if chunk.choices and chunk.choices[0].delta.content is not None:
+            yield chunk.choices[0].delta.content
+
+
+class Generation:
+    """
+    A streamed generation, closed upstream if it isn't read until the end
+    :param tracker: The tracker recording the outcome of the generation
+    :param response: The stream returned by client.chat.completions.create(stream=True)
+    :param max_tokens: The maximum number of tokens requested for the generation
+    """
+
+    def __init__(self, tracker: "GenerationTracker", response, max_tokens: int):
+        self.tracker = tracker
+        self.response = response
+        self.max_tokens = max_tokens
+        self.tokens = 0
+        self.finished = False
+        self.failed = False
+        self.closed = False
+
+    async def deltas(self) -> AsyncIterator[str]:
+        """
+        Yield the text deltas of the stream, counting them
+        """
+        try:
+            async for delta in stream_deltas(self.response):
+                self.tokens += 1
+                yield delta
+        except Exception:
+            self.failed = True
+            raise
+        self.finished = True
+
+    async def close(self):
+        """
+        Record the outcome of the generation and abort the upstream request if it is still running.
+        Closing the HTTP stream makes vLLM abort the request and free its slot.
+        """
+        if self.closed:
+            return
+        self.closed = True
+        if self.finished:
+            self.tracker.completed += 1
+            self.tracker.completed_tokens += self.tokens
+            return
+        await self.response.close()
+        if self.failed:
+            self.tracker.failed += 1
+        else:
+            self.tracker.record_cancellation(self.tokens, self.max_tokens)
+
+
+class GenerationTracker:
+    """
+    Counters of the generations: completed, failed, and cancelled by the user with the tokens saved by closing them.
+    The saved tokens are estimated from the average length of the completed answers, bounded by max_tokens.
+    """
+
+    def __init__(self):
+        self.completed = 0
+        self.completed_tokens = 0
+        self.failed = 0
+        self.cancelled = 0
+        self.cancelled_tokens = 0
+        self.saved_tokens = 0
+
+    def start(self, response, max_tokens: int) -> Generation:
+        """
+        Track a new streamed generation
+        :param response: The stream returned by client.chat.completions.create(stream=True)
+        :param max_tokens: The maximum number of tokens requested for the generation
+        """
+        return Generation(self, response, max_tokens)
+
+    def record_cancellation(self, tokens: int, max_tokens: int):
+        expected = self.completed_tokens / self.completed if self.completed else max_tokens
+        self.cancelled += 1
+        self.cancelled_tokens += tokens
+        self.saved_tokens += int(max(min(expected, max_tokens) - tokens, 0))
+
+    def stats(self) -> dict:
+        return {
+            "completed": self.completed,
+            "failed": self.failed,
+            "cancelled": self.cancelled,
+            "tokens_generated_before_cancel": self.cancelled_tokens,
+            "tokens_saved_estimate": self.saved_tokens,
+        }
+
+
+class StreamCoalescer:
+    """
+    Coalesce the deltas of a stream into periodic updates of the full message
+    :param interval: The minimum time between two updates in seconds
+    :param max_chars: The number of buffered characters forcing an update, 0 to only use the interval
+    """
+
+    def __init__(self, interval: float = 0.05, max_chars: int = 512):
+        self.interval = interval
+        self.max_chars = max_chars
+        self.streams = 0
+        self.tokens = 0
+        self.flushes = 0
+        self.generation_time = 0.0
+        self.first_token_time = 0.0
+
+    async def coalesce(self, deltas: AsyncIterator[str], prefix: str = "") -> AsyncIterator[str]:
+        """
+        Yield the message built from the deltas, at most once per interval
+        :param deltas: The text deltas
+        :param prefix: [Optional] A text displayed before the message
+        """
+        start = time.perf_counter()
+        first_token = None
+        last_flush = start
+        message = prefix
+        pending = []
+        pending_chars = 0
+        tokens = 0
+        try:
+            async for delta in deltas:
+                now = time.perf_counter()
+                if first_token is None:
+                    first_token = now
+                tokens += 1
+                pending.append(delta)
+                pending_chars += len(delta)
+                if now - last_flush >= self.interval or (self.max_chars and pending_chars >= self.max_chars):
+                    message += "".join(pending)
+                    pending, pending_chars, last_flush = [], 0, now
+                    self.flushes += 1
+                    yield message
+            if pending:
+                message += "".join(pending)
+                self.flushes += 1
+                yield message
+        finally:
+            self.streams += 1
+            self.tokens += tokens
+            if first_token is not None:
+                self.first_token_time += first_token - start
+                self.generation_time += time.perf_counter() - first_token
+
+    def stats(self) -> dict:
+        return {
+            "streams": self.streams,
+            "tokens": self.tokens,
+            "flushes": self.flushes,
+            "tokens_per_flush": round(self.tokens / self.flushes, 2) if self.flushes else 0.0,
+            "tokens_per_s": round(self.tokens / self.generation_time, 2) if self.generation_time else 0.0,
+            "avg_time_to_first_token_s": round(self.first_token_time / self.streams, 4) if self.streams else 0.0,
+        }
+
+
+def coalescer_from_env() -> StreamCoalescer:
+    """
+    Create the stream coalescer with the settings of the .env file:
+    stream_flush_interval_ms (default 50), stream_flush_chars (default 512)
+    """
+    return StreamCoalescer(
+        interval=float(os.environ.get("stream_flush_interval_ms", 50)) / 1000,
+        max_chars=int(os.environ.get("stream_flush_chars", 512)),
+    )
+
+
+if __name__ == '__main__':
+    raise Exception("This file isn't intended to be run directly")
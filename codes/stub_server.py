@@ -0,0 +1,176 @@
+"""
+Minimal OpenAI-compatible inference server, to test the Copilot without a GPU machine.
+It answers /v1/models and streams a fixed answer on /v1/chat/completions, one word per chunk.
+It can simulate the prefill time of the prompt and the automatic prefix caching of vLLM: the tokens of the prompt
+(estimated as 4 characters) cost prefill_delay each, except the blocks already seen as the prefix of a former prompt.
+
+Usage (from the codes folder):
+    python stub_server.py [port] [token delay in ms]
+then set openai_api=http://localhost:<port>/v1 in the .env file (several stubs can be listed, comma separated).
+"""
+import hashlib
+import json
+import sys
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Thread
+from typing import List, Optional
+
+ANSWER = ("This answer comes from the stub inference server. It streams one word per chunk so that the Copilot "
+          "can be tested without the remote GPU machine. ") * 4
+
+
+def render_prompt(messages: List[dict]) -> str:
+    """
+    Render the messages like the chat template of Mistral-7B-Instruct-v0.3, which puts the system message in the
+    last user message
+    """
+    system = messages[0]["content"] if messages and messages[0]["role"] == "system" else None
+    messages = messages[1:] if system is not None else messages
+    last_user = max((i for i, message in enumerate(messages) if message["role"] == "user"), default=-1)
+    prompt = "<s>"
+    for i, message in enumerate(messages):
+        if message["role"] == "user":
+            content = message["content"]
+            if system is not None and i == last_user:
+                content = f"{system}\n\n{content}"
+            prompt += f"[INST] {content}[/INST]"
+        else:
+            prompt += f" {message['content']}</s>"
+    return prompt
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    """
+    Request handler of the stub server. The server object holds the settings (token_delay, model, answer).
+    """
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send_json(self, status: int, body: dict):
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        if self.path.rstrip("/").endswith("/models"):
+            self._send_json(200, {"object": "list", "data": [{"id": self.server.model, "object": "model"}]})
+        else:
+            self._send_json(404, {"error": "not found"})
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length", 0))
+        request = json.loads(self.rfile.read(length) or b"{}")
+        if not self.path.rstrip("/").endswith("/chat/completions"):
+            self._send_json(404, {"error": "not found"})
+            return
+        self.server.requests += 1
+        words = self.server.answer.split(" ")[:request.get("max_tokens") or None]
+        time.sleep(self.server.first_token_delay(request))
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Connection", "close")
+        self.end_headers()
+        completion_id = f"chatcmpl-{uuid.uuid4().hex}"
+        try:
+            for word in words:
+                chunk = {
+                    "id": completion_id,
+                    "object": "chat.completion.chunk",
+                    "created": int(time.time()),
+                    "model": self.server.model,
+                    "choices": [{"index": 0, "delta": {"content": word + " "}, "finish_reason": None}],
+                }
+                self.wfile.write(f"data: {json.dumps(chunk)}\n\n".encode())
+                self.wfile.flush()
+                time.sleep(self.server.token_delay)
+            self.wfile.write(b"data: [DONE]\n\n")
+            self.wfile.flush()
+        except (BrokenPipeError, ConnectionResetError):  # The client closed the stream
+            self.server.aborted += 1
+        self.close_connection = True
+
+
+class StubServer(ThreadingHTTPServer):
+    """
+    The stub server
+    :param port: The port to listen on (0 for a free port)
+    :param token_delay: The time between two streamed words in seconds
+    :param model: The model name announced by the server
+    :param prefill_delay: The prefill time of one prompt token not found in the prefix cache in seconds
+    :param block_size: The number of tokens of a cached block, as in vLLM
+    """
+    daemon_threads = True
+
+    def __init__(self, port: int = 0, token_delay: float = 0.01, model: str = "mistralai/Mistral-7B-Instruct-v0.3",
+                 prefill_delay: float = 0.0, block_size: int = 16):
+        super().__init__(("127.0.0.1", port), StubHandler)
+        self.token_delay = token_delay
+        self.model = model
+        self.prefill_delay = prefill_delay
+        self.block_size = block_size
+        self.prompt_tokens = 0
+        self.cached_tokens = 0
+        self._blocks = set()
+        self.answer = ANSWER.strip()
+        self.requests = 0
+        self.aborted = 0
+        self._thread: Optional[Thread] = None
+
+    @property
+    def url(self) -> str:
+        return f"http://127.0.0.1:{self.server_address[1]}/v1"
+
+    def prefill(self, prompt: str) -> int:
+        """
+        Look the blocks of a prompt up in the prefix cache and add the missing ones
+        :return: The number of prompt tokens computed, i.e. not found in the cache
+        """
+        block_chars = self.block_size * 4
+        tokens = len(prompt) // 4 + 1
+        cached = 0
+        digest = hashlib.sha1()
+        hit = True
+        for start in range(0, len(prompt) - block_chars + 1, block_chars):  # Only the full blocks are cached
+            digest.update(prompt[start:start + block_chars].encode())
+            key = digest.hexdigest()
+            if hit and key in self._blocks:
+                cached += self.block_size
+            else:
+                hit = False
+                self._blocks.add(key)
+        self.prompt_tokens += tokens
+        self.cached_tokens += cached
+        return tokens - cached
+
+    def first_token_delay(self, request: dict) -> float:
+        """
+        The time before the first streamed word: the prefill of the uncached prompt tokens and one token delay
+        """
+        computed = self.prefill(render_prompt(request.get("messages", []))) if self.prefill_delay else 0
+        return computed * self.prefill_delay + self.token_delay
+
+    def start(self) -> "StubServer":
+        """
+        Serve in a background thread
+        """
+        self._thread = Thread(target=self.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+if __name__ == '__main__':
+    server = StubServer(int(sys.argv[1]) if len(sys.argv) > 1 else 8000,
+                        float(sys.argv[2]) / 1000 if len(sys.argv) > 2 else 0.01)
+    print(f"Stub inference server listening on {server.url}")
+    server.serve_forever()
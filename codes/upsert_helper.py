@@ -0,0 +1,86 @@
+"""
+Incremental update of a database: every chunk is stored with a hash of its content, and the new chunks of each updated
+workitem are compared with the chunks stored for its ibafullpuid. Only the chunks that changed are deleted and
+embedded again, the stale chunks of a workitem that got shorter are deleted.
+"""
+import hashlib
+from typing import Dict, List, Tuple
+
+from langchain_community.vectorstores.faiss import FAISS
+from langchain_core.documents import Document
+
+from identifier_helper import IdentifierIndex
+
+HASH_KEY = "content_hash"
+
+
+def content_hash(text: str) -> str:
+    """
+    Return the hash of the content of a chunk, stored in its metadata
+    """
+    return hashlib.sha1(text.encode()).hexdigest()
+
+
+def upsert_chunks(
+        faiss: FAISS,
+        chunks: List[Tuple[str, dict]],
+        identifiers: IdentifierIndex,
+        batch_size: int = 32
+) -> Dict[str, int]:
+    """
+    Replace the stored chunks of the updated workitems by their new chunks, only embedding the new contents.
+    A stored chunk whose content is unchanged is kept with its vector, its metadata being updated if they changed.
+    :param faiss: The vector store, with an in memory docstore and an exact index
+    :param chunks: The new chunks of the updated workitems and their metadata (ibafullpuid, url)
+    :param identifiers: The index of the stored chunks by identifier, updated with the chunks added and deleted
+    :param batch_size: The number of chunks embedded at once
+    :return: The number of chunks skipped (unchanged), replaced, removed and added
+    """
+    new_chunks: Dict[str, List[Tuple[str, dict]]] = {}
+    for text, metadata in chunks:
+        new_chunks.setdefault(metadata["ibafullpuid"], []).append((text, {**metadata, HASH_KEY: content_hash(text)}))
+
+    report = {"skipped": 0, "replaced": 0, "removed": 0, "added": 0}
+    stale, texts, metadatas = [], [], []
+    for puid, new in new_chunks.items():
+        stored: Dict[str, List[str]] = {}
+        for doc_id in identifiers.find_puid(str(puid)):
+            doc = faiss.docstore.search(doc_id)
+            if doc.metadata.get("ibafullpuid") == puid:  # The identifiers are case-insensitive
+                stored.setdefault(doc.metadata.get(HASH_KEY) or content_hash(doc.page_content), []).append(doc_id)
+        added = 0
+        for text, metadata in new:
+            unchanged = stored.get(metadata[HASH_KEY])
+            if unchanged:
+                doc_id = unchanged.pop()
+                doc = faiss.docstore.search(doc_id)
+                if doc.metadata != metadata:  # Moved workitem, or saved before the hashes
+                    identifiers.remove(doc_id, doc.metadata)
+                    faiss.docstore.delete([doc_id])
+                    faiss.docstore.add({doc_id: Document(id=doc_id, page_content=text, metadata=metadata)})
+                    identifiers.add(doc_id, metadata)
+                report["skipped"] += 1
+            else:
+                texts.append(text)
+                metadatas.append(metadata)
+                added += 1
+        removed = [doc_id for doc_ids in stored.values() for doc_id in doc_ids]
+        stale.extend(removed)
+        replaced = min(added, len(removed))
+        report["replaced"] += replaced
+        report["removed"] += len(removed) - replaced
+        report["added"] += added - replaced
+
+    if stale:
+        for doc_id in stale:
+            identifiers.remove(doc_id, faiss.docstore.search(doc_id).metadata)
+        faiss.delete(stale)
+    for i in range(0, len(texts), batch_size):
+        doc_ids = faiss.add_texts(texts[i:i + batch_size], metadatas[i:i + batch_size])
+        for doc_id, metadata in zip(doc_ids, metadatas[i:i + batch_size]):
+            identifiers.add(doc_id, metadata)
+    return report
+
+
+if __name__ == '__main__':
+    raise Exception("This file isn't intended to be run directly")
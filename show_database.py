@@ -1,5 +1,10 @@
+import argparse
+
+import faiss
+import numpy as np
 from termcolor import colored
 from codes import file_helper as fh
+from codes import index_helper as ih
 
 
 def load_faiss_catalog_file():
@@ -20,6 +25,9 @@ def print_formatted_info(info):
         print(f"  Type: {'Project' if details['type'] == 'project' else 'Project group'}")
         print(f"  Workitem Types: {', '.join(details['workitem_type'])}")
         print(f"  Last Updated: {details['last_update']}")
+        index = details.get("index", {"type": "flat"})
+        parameters = ", ".join(f"{key}={value}" for key, value in index.items() if key != "type")
+        print(f"  Index: {index['type']}" + (f" ({parameters})" if parameters else ""))
         print("-" * 45)
 
 
@@ -38,6 +46,55 @@ def show_database():
         print(colored("Your database seems empty.\nYou can create databases with 'py ./run_polarion.py' command.", "yellow"))
 
 
+def benchmark_database(db_choice: str, k: int, queries: int):
+    """
+    Measure the recall@k of the faiss index of a database against an exact search, with its p50/p95 query latency.
+    A compressed index is compared with its exact vectors, and re-ranks its candidates with them if it was built so.
+    The queries are stored chunks of the database moved towards a random direction (see index_helper.perturbed_queries),
+    and the approximate indexes are measured for several values of their search parameter (nprobe for IVF, efSearch
+    for HNSW).
+    :param db_choice: The number of the database in the catalog, or its ID
+    :param k: The number of neighbours searched
+    :param queries: The number of queries
+    """
+    infos = load_faiss_catalog_file()
+    db_ids = list(infos.keys())
+    db_id = db_ids[int(db_choice) - 1] if db_choice.isdigit() and int(db_choice) <= len(db_ids) else db_choice
+    if db_id not in infos:
+        raise ValueError(f"Unknown database {db_choice}, run 'py ./show_database.py' to list them.")
+    index = faiss.read_index(str(fh.get_db_files_path(db_id) / "index.faiss"))
+    exact_vectors = fh.get_db_files_path(db_id) / "vectors.npy"
+    if exact_vectors.exists():  # The index is compressed
+        vectors = np.load(exact_vectors, mmap_mode="r")
+    else:
+        vectors = ih.reconstruct_vectors(index)
+    rerank = infos[db_id].get("index", {}).get("rerank", 0)
+    sample = np.random.default_rng(0).choice(len(vectors), min(queries, len(vectors)), replace=False)
+    query_vectors = ih.perturbed_queries(vectors, np.sort(sample))
+    description = ih.describe_index(index)
+    print(colored(f"Database ID: {db_id}", 'green'))
+    print(f"  {index.ntotal} vectors of {index.d} dimensions, {description['type']} index, "
+          f"{description['compression']} compression, {len(sample)} queries, k={k}"
+          + (f", {rerank * k} candidates re-ranked" if rerank and exact_vectors.exists() else ""))
+    for parameter in ih.search_parameter_values(index):
+        result = ih.benchmark_index(index, query_vectors, k, parameter, vectors if exact_vectors.exists()
+                                    else None, rerank * k)
+        name = {"ivf": "nprobe", "hnsw": "efSearch"}.get(description["type"])
+        label = f"{name}={parameter}" if name else "exact"
+        saved = " (saved)" if name and description[name] == parameter else ""
+        print(f"  {label:<14} recall@{k} {result['recall']:.3f}, "
+              f"p50 {result['p50_ms']:.3f} ms, p95 {result['p95_ms']:.3f} ms{saved}")
+
+
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Show the databases of the faiss catalog")
+    parser.add_argument("--benchmark", metavar="DATABASE",
+                        help="Number or ID of a database whose index recall and latency are measured")
+    parser.add_argument("--k", type=int, default=10, help="Neighbours searched by the benchmark")
+    parser.add_argument("--queries", type=int, default=200, help="Queries of the benchmark")
+    args = parser.parse_args()
     fh.delete_uncatalogued_db()
-    show_database()
+    if args.benchmark:
+        benchmark_database(args.benchmark, args.k, args.queries)
+    else:
+        show_database()